@@ -0,0 +1 @@
+from .network import NetworkBenchmark, latency_summary, benchmark_targets
@@ -0,0 +1,274 @@
+""" Network throughput benchmarks for the commune server and the receptor pool.
+
+Every target starts a stub server in-process on localhost, so the benchmark runs offline and only
+measures serialization and transport. Run it before and after a serializer or transport change
+and compare the frames.
+"""
+
+import time
+import asyncio
+import itertools
+from typing import Dict, List, Any, Optional
+
+import numpy as np
+import pandas as pd
+import torch
+from loguru import logger
+
+
+def latency_summary(latencies: List[float], successes: List[bool], bytes_out: int, bytes_in: int, elapsed_time: float) -> Dict[str, float]:
+    r""" Summarizes the calls of one benchmark trial.
+        Args:
+            latencies (:obj:`List[float]`, `required`):
+                Wall time of every call in seconds.
+            successes (:obj:`List[bool]`, `required`):
+                Whether every call succeeded.
+            bytes_out (:obj:`int`, `required`):
+                Payload bytes sent by the successful calls.
+            bytes_in (:obj:`int`, `required`):
+                Payload bytes received by the successful calls.
+            elapsed_time (:obj:`float`, `required`):
+                Wall time of the whole trial in seconds.
+    """
+    latencies = np.asarray(latencies, dtype=np.float64)
+    successes = np.asarray(successes, dtype=bool)
+    success_latencies = latencies[successes] if successes.any() else latencies
+    p50, p95, p99 = np.percentile(success_latencies, [50, 95, 99]) if len(success_latencies) > 0 else (np.nan, np.nan, np.nan)
+    return dict(
+        num_calls = len(latencies),
+        num_successes = int(successes.sum()),
+        success_rate = float(successes.mean()) if len(successes) > 0 else 0.0,
+        latency_p50 = float(p50),
+        latency_p95 = float(p95),
+        latency_p99 = float(p99),
+        latency_mean = float(success_latencies.mean()) if len(success_latencies) > 0 else np.nan,
+        calls_per_second = len(latencies) / elapsed_time,
+        bytes_out_per_second = bytes_out / elapsed_time,
+        bytes_in_per_second = bytes_in / elapsed_time,
+        elapsed_time = elapsed_time,
+    )
+
+
+class EchoModule:
+    r""" Stub module for the ServerModule, returns the request data untouched.
+    """
+    def __call__(self, data, metadata:dict) -> dict:
+        return {'data': data, 'metadata': {}}
+
+
+class BenchmarkTarget:
+    r""" A stub server and a client to it.
+
+        Subclasses implement start, stop, make_payload and call. call returns
+        (success, bytes_out, bytes_in) for a single request.
+    """
+
+    def __init__(self, compression: Optional[str] = None, ip: str = '127.0.0.1', port: int = 8091):
+        self.compression = compression
+        self.ip = ip
+        self.port = port
+
+    async def start(self):
+        raise NotImplementedError
+
+    async def stop(self):
+        raise NotImplementedError
+
+    def make_payload(self, batch_size: int, payload_size: int) -> torch.Tensor:
+        raise NotImplementedError
+
+    async def call(self, payload: torch.Tensor, timeout: float):
+        raise NotImplementedError
+
+
+class ServerTarget(BenchmarkTarget):
+    r""" ServerModule serving an EchoModule, queried through a ServerClientModule.
+    """
+
+    async def start(self):
+        from commune.server.server_module import ServerModule
+        from commune.server.server_client_module import ServerClientModule
+        self.server = ServerModule(module=EchoModule(), ip=self.ip, port=self.port, compression=self.compression)
+        self.server.start()
+        # the aio channel binds to the running loop, so the client is created inside it
+        self.client = ServerClientModule(ip=self.ip, port=self.port, compression=self.compression)
+
+    async def stop(self):
+        await self.client.channel.close()
+        self.server.stop()
+
+    def make_payload(self, batch_size: int, payload_size: int) -> torch.Tensor:
+        return torch.rand(batch_size, payload_size)
+
+    async def call(self, payload: torch.Tensor, timeout: float):
+        response = await self.client.async_forward(data=payload, timeout=timeout)
+        success = isinstance(response, dict)
+        num_bytes = payload.element_size() * payload.nelement()
+        return success, num_bytes, num_bytes if success else 0
+
+
+class ReceptorPoolTarget(BenchmarkTarget):
+    r""" bittensor axon with zero-output synapse callbacks, queried through a ReceptorPool.
+
+        The pool sees num_endpoints endpoints with distinct hotkeys that all point at the stub axon,
+        so calls are spread over num_endpoints receptors like they are on the network.
+    """
+
+    def __init__(self, compression: Optional[str] = None, ip: str = '127.0.0.1', port: int = 8092,
+                 wallet: 'bittensor.Wallet' = None, num_endpoints: int = 16, synapse: str = 'TextLastHiddenState'):
+        super().__init__(compression=compression, ip=ip, port=port)
+        self.wallet = wallet
+        self.num_endpoints = num_endpoints
+        self.synapse = synapse
+        self.call_count = 0
+
+    def resolve_wallet(self) -> 'bittensor.Wallet':
+        import bittensor
+        if self.wallet == None:
+            self.wallet = bittensor.wallet(name='benchmark', hotkey='benchmark')
+            self.wallet.create_if_non_existent(coldkey_use_password=False, hotkey_use_password=False)
+        return self.wallet
+
+    async def start(self):
+        import bittensor
+        from commune.model.moe.receptor.receptor_pool import ReceptorPool
+        wallet = self.resolve_wallet()
+
+        def forward_hidden_state(inputs_x, synapse, model_output=None):
+            return None, model_output, torch.zeros(*inputs_x.shape, bittensor.__network_dim__)
+
+        def forward_causal_lm(inputs_x, synapse, model_output=None):
+            return None, model_output, torch.zeros(*inputs_x.shape, bittensor.__vocab_size__)
+
+        self.axon = bittensor.axon(
+            wallet = wallet,
+            ip = self.ip,
+            port = self.port,
+            compression = self.compression,
+            synapse_checks = lambda synapse, hotkey: True,
+            synapse_last_hidden = forward_hidden_state,
+            synapse_causal_lm = forward_causal_lm,
+        ).start()
+
+        self.receptor_pool = ReceptorPool(wallet=wallet, max_active_receptors=0, compression=self.compression, rpc_logging=False)
+        self.endpoints = [
+            bittensor.endpoint(
+                version = bittensor.__version_as_int__,
+                uid = uid,
+                hotkey = f'benchmark-{uid}',
+                ip = self.ip,
+                ip_type = 4,
+                port = self.port,
+                modality = 0,
+                coldkey = wallet.coldkeypub.ss58_address,
+            )
+            for uid in range(self.num_endpoints)
+        ]
+        self.synapses = [getattr(bittensor.synapse, self.synapse)()]
+
+    async def stop(self):
+        self.receptor_pool.receptors.clear()
+        self.axon.stop()
+
+    def make_payload(self, batch_size: int, payload_size: int) -> torch.Tensor:
+        # payload_size is the sequence length of the token batch
+        return torch.randint(0, 50000, (batch_size, payload_size), dtype=torch.int64)
+
+    async def call(self, payload: torch.Tensor, timeout: float):
+        endpoint = self.endpoints[self.call_count % len(self.endpoints)]
+        self.call_count += 1
+        outputs, codes, times = await self.receptor_pool.async_forward(
+            endpoints = [endpoint],
+            synapses = self.synapses,
+            inputs = [payload],
+            timeout = timeout,
+            min_successes = 1,
+        )
+        success = len(codes) > 0 and codes[0][0] == 1
+        bytes_in = outputs[0][0].element_size() * outputs[0][0].nelement() if success else 0
+        return success, payload.element_size() * payload.nelement(), bytes_in
+
+
+benchmark_targets = {
+    'server': ServerTarget,
+    'receptor_pool': ReceptorPoolTarget,
+}
+
+
+class NetworkBenchmark:
+    r""" Sweeps concurrency, payload size, compression and batch size against a target.
+
+        Example:
+            df = NetworkBenchmark(target='server').run(params=dict(concurrency=[1, 16], payload_size=[64, 4096]))
+    """
+
+    default_params = dict(
+        concurrency = [1, 8, 32],
+        payload_size = [64, 1024, 16384],
+        compression = [None, 'gzip'],
+        batch_size = [1, 8],
+    )
+
+    def __init__(self, target: str = 'server', num_calls: int = 256, timeout: float = 10, warmup_calls: int = 8, target_kwargs: dict = {}):
+        assert target in benchmark_targets, f'target must be one of {list(benchmark_targets.keys())}'
+        self.target_class = benchmark_targets[target]
+        self.target = target
+        self.num_calls = num_calls
+        self.timeout = timeout
+        self.warmup_calls = warmup_calls
+        self.target_kwargs = target_kwargs
+
+    async def async_run_trial(self, target: BenchmarkTarget, concurrency: int, payload_size: int, batch_size: int) -> Dict[str, float]:
+        payload = target.make_payload(batch_size=batch_size, payload_size=payload_size)
+        semaphore = asyncio.Semaphore(concurrency)
+
+        async def timed_call():
+            async with semaphore:
+                start_time = time.perf_counter()
+                try:
+                    success, bytes_out, bytes_in = await target.call(payload=payload, timeout=self.timeout)
+                except Exception as e:
+                    logger.debug(f'benchmark call failed: {e}')
+                    success, bytes_out, bytes_in = False, 0, 0
+                return time.perf_counter() - start_time, success, bytes_out, bytes_in
+
+        await asyncio.gather(*[timed_call() for _ in range(self.warmup_calls)])
+
+        start_time = time.perf_counter()
+        results = await asyncio.gather(*[timed_call() for _ in range(self.num_calls)])
+        elapsed_time = time.perf_counter() - start_time
+
+        latencies, successes, bytes_out, bytes_in = zip(*results)
+        return latency_summary(latencies=latencies, successes=successes,
+                               bytes_out=sum(bytes_out), bytes_in=sum(bytes_in), elapsed_time=elapsed_time)
+
+    async def async_run(self, params: Dict[str, List[Any]] = None) -> pd.DataFrame:
+        params = {**self.default_params, **(params or {})}
+        rows = []
+        # the transport compression is fixed per server, so each compression gets its own target
+        for compression in params['compression']:
+            target = self.target_class(compression=compression, **self.target_kwargs)
+            await target.start()
+            try:
+                for concurrency, payload_size, batch_size in itertools.product(params['concurrency'], params['payload_size'], params['batch_size']):
+                    trial = dict(target=self.target, compression=str(compression), concurrency=concurrency,
+                                 payload_size=payload_size, batch_size=batch_size)
+                    metrics = await self.async_run_trial(target=target, concurrency=concurrency, payload_size=payload_size, batch_size=batch_size)
+                    logger.info(f'{trial} p50={metrics["latency_p50"]:.4f}s p99={metrics["latency_p99"]:.4f}s success_rate={metrics["success_rate"]:.2f}')
+                    rows.append({**trial, **metrics})
+            finally:
+                await target.stop()
+        return pd.DataFrame(rows)
+
+    def run(self, params: Dict[str, List[Any]] = None) -> pd.DataFrame:
+        return asyncio.run(self.async_run(params=params))
+
+    @staticmethod
+    def compare(baseline: pd.DataFrame, candidate: pd.DataFrame, metrics: List[str] = ['latency_p50', 'latency_p95', 'latency_p99', 'calls_per_second', 'success_rate']) -> pd.DataFrame:
+        r""" Joins two benchmark frames on the trial parameters and adds the candidate/baseline ratio of every metric.
+        """
+        keys = ['target', 'compression', 'concurrency', 'payload_size', 'batch_size']
+        df = baseline[keys + metrics].merge(candidate[keys + metrics], on=keys, suffixes=('_baseline', '_candidate'))
+        for metric in metrics:
+            df[f'{metric}_ratio'] = df[f'{metric}_candidate'] / df[f'{metric}_baseline']
+        return df
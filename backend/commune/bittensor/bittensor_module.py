@@ -27,6 +27,8 @@ from commune import Module
 from tqdm import tqdm
 from plotly.subplots import make_subplots
 from commune.ray.utils import kill_actor, create_actor
+from commune.model.moe.receptor.sampler import resolve_endpoint_sampler, resolve_stake_weight
+from commune.bittensor.metagraph_store import MetagraphStore, sparsify_state, densify_state
 from ray.util.queue import Queue
 import itertools
 # from commune .process.extract.crypto.utils import run_query
@@ -101,13 +103,33 @@ class BittensorModule(Module):
             num_endpoints =self.num_endpoints
 
         if random_sample == True:
-            endpoint_index_list = list(np.random.randint(0, self.n, (num_endpoints)))
-            selected_endpoints = [endpoints[idx] for idx in endpoint_index_list]
+            stake = self.metagraph.stake.numpy() if self.stake_weight is not None else None
+            selected_endpoints = self.endpoint_sampler.sample(endpoints, num_endpoints, stake=stake)
         else:
             selected_endpoints = endpoints[:num_endpoints]
         return selected_endpoints
 
 
+    @property
+    def stake_weight(self):
+        return resolve_stake_weight(self.config.get('stake_weighted_sampling', False))
+
+    @property
+    def endpoint_sampler(self):
+        if not hasattr(self, '_endpoint_sampler'):
+            self._endpoint_sampler = resolve_endpoint_sampler(self.config.get('endpoint_sampler', 'scored'), stake_weight=self.stake_weight)
+        return self._endpoint_sampler
+
+    @endpoint_sampler.setter
+    def endpoint_sampler(self, endpoint_sampler):
+        self._endpoint_sampler = resolve_endpoint_sampler(endpoint_sampler, stake_weight=self.stake_weight)
+
+    def set_receptor_pool(self, receptor_pool):
+        # share the pool's sampler, it is the one updated with the latency and success of every forward
+        self.receptor_pool = receptor_pool
+        self.endpoint_sampler = receptor_pool.endpoint_sampler
+        return self.receptor_pool
+
     @property
     def block(self):
         if not hasattr(self, '_block'):
@@ -323,17 +345,44 @@ class BittensorModule(Module):
 
 
 
+    @property
+    def metagraph_store(self):
+        path = os.path.join(self.tmp_dir, 'metagraph', self.network)
+        if getattr(self, '_metagraph_store', None) == None or self._metagraph_store.path != path:
+            self._metagraph_store = MetagraphStore(path=path, keep=self.config.get('metagraph_snapshots', 5))
+        return self._metagraph_store
+
     @property
     def metagraph_path(self):
-        return f'backend/{self.network}B{self.block}.pth'
+        return self.metagraph_store.snapshot_path(self.block)
 
 
     def set_metagraph_state(self, sample_n=None, sample_mode='rank', **kwargs):
-        metagraph_state = self.metagraph.state_dict()
+        # weights and bonds are kept as sparse COO, use dense_metagraph_state for a dense view
+        self.full_metagraph_state = metagraph_state = sparsify_state(self.metagraph.state_dict())
+        # everything derived from the previous state is stale
+        self._metagraph_memo = {}
         if sample_n != None:
             metagraph_state =  self.sample_metagraph_state(metagraph_state=metagraph_state, sample_n=sample_n, sample_mode=sample_mode, **kwargs)
         self.metagraph_state = metagraph_state
 
+    @property
+    def metagraph_state_key(self):
+        return (self.block, self.sample_n, self.sample_mode, self.sample_metric, self.sample_descending)
+
+    def memoize(self, name, fn:Callable, *args, **kwargs):
+        '''
+        fn(*args, **kwargs) computed once per metagraph state (block and sample params), so streamlit
+        reruns reuse the dataframes, reductions and figures. set_metagraph_state clears the memo.
+        The memo lives on the module, which the streamlit app keeps in st.session_state across reruns.
+        The results are shared, do not modify them in place.
+        '''
+        key = (self.metagraph_state_key, name, args, tuple(sorted(kwargs.items())))
+        memo = self.__dict__.setdefault('_metagraph_memo', {})
+        if key not in memo:
+            memo[key] = fn(*args, **kwargs)
+        return memo[key]
+
 
     sample_n = 400
     sample_mode = 'rank'
@@ -369,27 +418,34 @@ class BittensorModule(Module):
             elif (len(v.shape) == 1 and v.shape[0] == self.n) or k in ['endpoints'] :
                 sampled_metagraph_state[k] = v[sampled_uid_indices]
             elif len(v.shape) == 2 and v.shape[0] == self.n and v.shape[1] == self.n:
-                sampled_metagraph_state[k] = v[sampled_uid_indices]
-                sampled_metagraph_state[k] = sampled_metagraph_state[k][:, sampled_uid_indices]
+                # index_select works on the sparse form without densifying
+                index = torch.as_tensor(sampled_uid_indices)
+                sampled_metagraph_state[k] = v.index_select(0, index).index_select(1, index)
             else:
                 sampled_metagraph_state[k] = v
             
         return sampled_metagraph_state
 
     def argsort_uids(self, metric='rank', descending=True):
+        return self.memoize('argsort_uids', self._argsort_uids, metric=metric, descending=descending)
+
+    def _argsort_uids(self, metric='rank', descending=True):
         prohibited_params = ['endpoints', 'uids', 'version']
 
         if metric in prohibited_params:
             return None
 
-        metric_tensor = getattr(self.metagraph, metric, None)
+        metric_tensor = getattr(self, 'full_metagraph_state', {}).get(metric, getattr(self.metagraph, metric, None))
 
-        if metric_tensor == None :
+        if metric_tensor is None :
             return None
         else:
             metric_shape  = metric_tensor.shape
             if len(metric_shape) == 2 and metric_shape[0] == self.n:
-                metric_tensor = torch.einsum('ij->i', metric_tensor)
+                if metric_tensor.is_sparse:
+                    metric_tensor = torch.sparse.sum(metric_tensor, dim=1).to_dense()
+                else:
+                    metric_tensor = torch.einsum('ij->i', metric_tensor)
             if metric_shape[0] == self.n:
                 return torch.argsort(metric_tensor, descending=descending, dim=0).tolist()    
     @property
@@ -410,7 +466,114 @@ class BittensorModule(Module):
 
 
 
-    def set_network(self,  network:Optional[str]=None, block:Optional[int]=None, subtensor:Optional[str]=None,  **kwargs):
+    # subtensor events that name the neuron they changed, by uid or by hotkey
+    uid_events = ['NeuronRegistered', 'WeightsSet', 'AxonServed']
+    hotkey_events = ['StakeAdded', 'StakeRemoved']
+
+    def changed_uids(self, start_block:int, end_block:int) -> Optional[List[int]]:
+        '''
+        uids of the neurons touched by subtensor events in blocks (start_block, end_block].
+        Returns None if an event cannot be attributed to a neuron, the caller then needs a full sync.
+        '''
+        hotkey2uid = {hotkey:uid for uid, hotkey in enumerate(self.metagraph.hotkeys)}
+        substrate = self.subtensor.substrate
+        uids = set()
+        try:
+            for block in range(start_block+1, end_block+1):
+                for event in substrate.get_events(block_hash=substrate.get_block_hash(block)):
+                    event = event.value.get('event', event.value)
+                    if event.get('module_id') != 'SubtensorModule':
+                        continue
+                    attributes = event.get('attributes')
+                    attributes = list(attributes.values()) if isinstance(attributes, dict) else list(attributes or [])
+                    if event['event_id'] in self.uid_events:
+                        uids.add(int(attributes[0]))
+                    elif event['event_id'] in self.hotkey_events and attributes[0] in hotkey2uid:
+                        uids.add(hotkey2uid[attributes[0]])
+                    else:
+                        return None
+        except Exception:
+            return None
+        return sorted(uids)
+
+    # metagraph state key -> neuron field
+    neuron_fields = dict(stake='stake', ranks='rank', trust='trust', consensus='consensus', incentive='incentive',
+                         dividends='dividends', emission='emission', active='active', last_update='last_update')
+
+    def patch_metagraph_state(self, state_dict:Dict[str, torch.Tensor], neurons:list, block:int) -> Dict[str, torch.Tensor]:
+        '''
+        Writes the rows of the given neurons into a metagraph state_dict in place.
+        Bonds are left to the next full sync.
+        '''
+        for neuron in neurons:
+            uid = neuron.uid
+            for key, field in self.neuron_fields.items():
+                state_dict[key][uid] = getattr(neuron, field)
+            weights = torch.zeros_like(state_dict['weights'][uid])
+            if len(neuron.weights) > 0:
+                weight_uids, weight_values = zip(*neuron.weights)
+                weights[list(weight_uids)] = torch.tensor(weight_values, dtype=weights.dtype)
+                weights = weights / weights.sum().clamp(min=1e-12)
+            state_dict['weights'][uid] = weights
+            state_dict['endpoints'][uid] = bittensor.endpoint.from_neuron(neuron).to_tensor()
+        state_dict['block'] = torch.tensor(block, dtype=state_dict['block'].dtype)
+        return state_dict
+
+    @property
+    def blocks_per_epoch(self) -> Optional[int]:
+        blocks_per_epoch = self.config.get('blocks_per_epoch')
+        if blocks_per_epoch == None:
+            blocks_per_epoch = getattr(self.subtensor, 'blocks_per_epoch', None)
+        return blocks_per_epoch
+
+    def crosses_epoch(self, start_block:int, end_block:int) -> bool:
+        '''
+        Whether an epoch ends in blocks (start_block, end_block], True if the epoch length is unknown.
+        '''
+        blocks_per_epoch = self.blocks_per_epoch
+        if not blocks_per_epoch:
+            return True
+        return start_block // blocks_per_epoch != end_block // blocks_per_epoch
+
+    def sync_metagraph(self, block:Optional[int]=None, force_sync:bool=False) -> 'bittensor.Metagraph':
+        '''
+        Brings the metagraph to block (default the current block) with as little chain traffic as possible.
+
+        The latest snapshot at or before block is loaded from the metagraph store. If it is within
+        blocks_behind_sync_threshold it is used as is. Otherwise only the neurons touched since then are
+        fetched, as long as the last full sync is within max_incremental_blocks and no epoch ended in
+        between: the epoch updates stake, ranks, emission and the other consensus fields of every neuron
+        without an event. In any other case, or if the changes cannot be attributed, the metagraph is
+        fully synced. Every sync is saved as a new snapshot along with the block of its last full sync.
+        '''
+        block = self.current_block if block == None else block
+        cached_block = None if force_sync else self.metagraph_store.latest(max_block=block)
+        full_sync_block = None
+
+        if cached_block != None:
+            self.metagraph.load_from_state_dict(densify_state(self.metagraph_store.load(cached_block)))
+            if block - cached_block <= self.blocks_behind_threshold:
+                return self.metagraph
+            full_sync_block = self.metagraph_store.full_sync_block(cached_block)
+
+        uids = None
+        if full_sync_block != None and block - full_sync_block <= self.config.get('max_incremental_blocks', 100) \
+                and not self.crosses_epoch(cached_block, block) \
+                and self.subtensor.get_n(block=block) == self.metagraph.n.item():
+            uids = self.changed_uids(start_block=cached_block, end_block=block)
+
+        if uids == None:
+            self.metagraph.sync(block=block)
+            full_sync_block = block
+        else:
+            neurons = [self.subtensor.neuron_for_uid(uid=uid, block=block) for uid in uids]
+            state_dict = self.patch_metagraph_state(self.metagraph.state_dict(), neurons=neurons, block=block)
+            self.metagraph.load_from_state_dict(state_dict)
+
+        self.metagraph_store.save(block, self.metagraph.state_dict(), full_sync_block=full_sync_block)
+        return self.metagraph
+
+    def set_network(self,  network:Optional[str]=None, block:Optional[int]=None, subtensor:Optional[str]=None, force_sync:bool=False, **kwargs):
         '''
         The subtensor.network should likely be one of the following choices:
             -- local - (your locally running node)
@@ -421,23 +584,29 @@ class BittensorModule(Module):
         self.subtensor = subtensor if subtensor else bittensor.subtensor(network=network, **kwargs)
         
         
-        # Load the metagraph
+        # Load the metagraph from the local snapshots, syncing only what changed since
         self.metagraph = bittensor.metagraph(network=self.network, subtensor=self.subtensor)
-        self.metagraph.load()
-
-        sync_metagraph_bool = self.sync_metagraph_bool or force_sync
-        if sync_metagraph_bool:
-            self.metagraph.sync(block=block)
-
-        self.metagraph.save()
+        self.sync_metagraph(block=block, force_sync=force_sync)
         self.set_metagraph_state()
     
     
-    def adjacency(mode='W', ):
-        return torch.nonzero(self.metagraph.weights)
+    def adjacency(self, mode='weights'):
+        '''
+        [num_edges, 2] (i, j) uid pairs of the nonzero weights (W) or bonds (B).
+        '''
+        mode = dict(W='weights', B='bonds').get(mode, mode)
+        matrix = self.full_metagraph_state[mode]
+        return matrix.indices().T if matrix.is_sparse else torch.nonzero(matrix)
+
+    def dense_metagraph_state(self, key:str, sampled:bool=True) -> torch.Tensor:
+        '''
+        Dense view of a metagraph state tensor, e.g. for plotting the weights.
+        '''
+        tensor = (self.metagraph_state if sampled else self.full_metagraph_state)[key]
+        return tensor.to_dense() if tensor.is_sparse else tensor
 
     def describe_metagraph_state(self, shape=True):
-        return {k:dict(shape=v.shape, type=v.dtype ) for k,v in  self.metagraph_state.items()}
+        return self.memoize('describe_metagraph_state', lambda: {k:dict(shape=v.shape, type=v.dtype ) for k,v in  self.metagraph_state.items()})
 
 
     @property
@@ -445,8 +614,10 @@ class BittensorModule(Module):
         return self.metagraph_state.keys()
 
     def agg_param(self, param='rank', agg='sum', decimals=2):
-        param_tensor = getattr(self.metagraph, param)
-        return round(getattr(torch,agg)(param_tensor).item(), decimals)
+        def _agg_param(param, agg, decimals):
+            param_tensor = getattr(self.metagraph, param)
+            return round(getattr(torch,agg)(param_tensor).item(), decimals)
+        return self.memoize('agg_param', _agg_param, param, agg, decimals)
 
 
     @property
@@ -580,19 +751,29 @@ class BittensorModule(Module):
     def st_relationmap(self):
         with st.expander('Relation Map'):
             metric = st.selectbox('Select a Matric', ['weights', 'bonds'], 0)
-            z = self.metagraph_state[metric]
-            # z[torch.nonzero(z==1)] = 0
             cols =st.columns([1,5,1])
 
-            fig = self.plot.imshow(z, text_auto=True, title=f'Relation Map of {metric.upper()}')
-            fig.update_layout(autosize=True, width=800, height=800)
-            cols[1].write(fig)
+            def relationmap(metric):
+                z = self.dense_metagraph_state(metric)
+                # z[torch.nonzero(z==1)] = 0
+                fig = self.plot.imshow(z, text_auto=True, title=f'Relation Map of {metric.upper()}')
+                fig.update_layout(autosize=True, width=800, height=800)
+                return fig
+            cols[1].write(self.memoize('relationmap', relationmap, metric))
+    @staticmethod
+    def df_key(df:pd.DataFrame):
+        '''
+        Hashable fingerprint of a dataframe (columns and content), to memoize figures of it.
+        '''
+        return (tuple(df.columns), int(pd.util.hash_pandas_object(df, index=True).sum()))
+
     def st_distributions(self, df):
         plot_columns = [c for c in df.columns if c not in ['uid', 'active']]
-
+        df_key = self.df_key(df)
 
         with st.expander('Distibutions'):
-            fn_list = [lambda col: st.write(self.plot.histogram(df, x=col, title=f'Distribution of {col.upper()}', color_discrete_sequence=random.sample(px.colors.qualitative.Plotly,1)))]*len(plot_columns)
+            histogram = lambda col: self.plot.histogram(df, x=col, title=f'Distribution of {col.upper()}', color_discrete_sequence=random.sample(px.colors.qualitative.Plotly,1))
+            fn_list = [lambda col: st.write(self.memoize(('histogram', df_key), histogram, col))]*len(plot_columns)
             fn_args_list = [[col,] for col in plot_columns]
             row_column_bundles(fn_list=fn_list, fn_args_list=fn_args_list)
 
@@ -601,15 +782,17 @@ class BittensorModule(Module):
 
     def st_scatter(self, df):
         plot_columns = ['stake', 'rank', 'trust', 'consensus', 'incentive', 'dividends', 'emission']
+        df_key = self.df_key(df)
         
         with st.expander('Scatter'):
+            scatter = lambda col_x, col_y: self.plot.scatter(df, x=col_x, y=col_y, title=f'{col_x.upper()} vs {col_y.upper()}', color_discrete_sequence=random.sample(px.colors.qualitative.Plotly,1))
             fn_list = []
             fn_args_list = []
             for col_x in plot_columns:
                 for col_y in ['rank']:
                     if col_x != col_y:
 
-                        fn_list += [lambda col_x, col_y: st.write(self.plot.scatter(df, x=col_x, y=col_y, title=f'{col_x.upper()} vs {col_y.upper()}', color_discrete_sequence=random.sample(px.colors.qualitative.Plotly,1)))]
+                        fn_list += [lambda col_x, col_y: st.write(self.memoize(('scatter', df_key), scatter, col_x, col_y))]
                         fn_args_list += [[col_x,col_y]]
         
             row_column_bundles(fn_list=fn_list, fn_args_list=fn_args_list)
@@ -632,21 +815,28 @@ class BittensorModule(Module):
 
 
 
-    def metagraph_df(self):
-        df_dict= {
-                'uid': self.metagraph_state['uids'],
-                'active': self.metagraph_state['active'],             
-                'stake': self.metagraph_state['stake'],             
-                'rank': self.metagraph_state['ranks'],            
-                'trust': self.metagraph_state['trust'],             
-                'consensus': self.metagraph_state['consensus'],             
-                'incentive': self.metagraph_state['incentive'],             
-                'dividends': self.metagraph_state['dividends'],          
-                'emission': self.metagraph_state['emission']
+    # dataframe column -> metagraph state key
+    metagraph_df_columns = {
+                'uid': 'uids',
+                'active': 'active',
+                'stake': 'stake',
+                'rank': 'ranks',
+                'trust': 'trust',
+                'consensus': 'consensus',
+                'incentive': 'incentive',
+                'dividends': 'dividends',
+                'emission': 'emission'
             }
 
+    def metagraph_column(self, column:str) -> np.ndarray:
+        return self.memoize('metagraph_column', lambda column: self.metagraph_state[self.metagraph_df_columns[column]].numpy(), column)
 
-        return pd.DataFrame(df_dict)
+    def metagraph_df(self, columns:Optional[List[str]]=None):
+        '''
+        Dataframe of the per uid metagraph values, only the requested columns are converted.
+        '''
+        columns = tuple(columns) if columns != None else tuple(self.metagraph_df_columns.keys())
+        return self.memoize('metagraph_df', lambda columns: pd.DataFrame({c: self.metagraph_column(c) for c in columns}), columns)
 
     def st_sample_params(self):
         with st.sidebar.form("sample_n_form"):
@@ -723,7 +913,10 @@ if __name__ == '__main__':
 
     actor = {'gpu': 0.2, 'cpu':1, 'name': 'bittensor_module-0', 'refresh': False, 'wrap': True}
     actor = False
-    module = BittensorModule(hotkey=f'hotkey-{args.index}')
+    # streamlit reruns the script on every interaction, the module (and its memo) is kept for the session
+    if 'bittensor_module' not in st.session_state:
+        st.session_state['bittensor_module'] = BittensorModule(hotkey=f'hotkey-{args.index}')
+    module = st.session_state['bittensor_module']
     module.wallet.create_new_hotkey(use_password=False, overwrite=False)
     st.write(module.register(dev_id=list(range(8))))
 
@@ -0,0 +1,237 @@
+import json
+import queue
+import inspect
+import functools
+import asyncio
+import threading
+import time
+import torch
+from collections import deque
+from concurrent.futures import Future
+from typing import Callable, List, Optional
+from loguru import logger
+
+
+class InferenceRequest:
+    def __init__( self, fn: Callable, args: tuple = (), kwargs: dict = {}, token_batch: torch.Tensor = None, batchable: bool = False ):
+        self.fn = fn
+        self.args = args
+        self.kwargs = kwargs
+        self.token_batch = token_batch
+        self.future = Future()
+        self.batch_key = self.get_batch_key() if batchable else None
+
+    def get_batch_key( self ) -> Optional[tuple]:
+        r""" Requests with the same key are stacked into one model call, None never batches.
+        """
+        if self.token_batch is None or self.kwargs.get( 'model_output' ) is not None:
+            return None
+        try:
+            params = json.dumps( { k: v for k, v in self.kwargs.items() if k != 'model_output' }, sort_keys = True )
+        except TypeError:
+            # params that are not plain values (e.g. a tokenizer) are not compared
+            return None
+        # bound methods of the same forward and nucleus compare equal, their ids do not
+        return ( self.fn, tuple( self.token_batch.shape[1:] ), self.token_batch.dtype, self.token_batch.device, params )
+
+
+class InferenceScheduler:
+    r""" Single worker thread in front of the model, replacing the mutex the axon threads used to queue on.
+
+        Synapse callbacks submit their forward and get a future back. The worker takes the next request and
+        collects for up to max_wait seconds the queued requests with the same forward, params and sequence length,
+        runs them as one batch of at most max_batch_size rows and splits the response rows back to each future.
+        Only forwards registered with register_batchable are stacked, and only for the requests their check
+        accepts: a row must get the same response whatever it is batched with, so e.g. token remapping that
+        pads rows to the longest one in the batch rules batching out. Everything else runs one request at a time.
+        Anything else that must not overlap with inference (training steps, optimizer steps) goes through call
+        and runs on the worker between batches. Requests made from the worker itself run inline.
+
+        Usage:
+            scheduler = InferenceScheduler( max_batch_size = 32, max_wait = 0.005 )
+            scheduler.register_batchable( forward, check )
+            message, model_output, response = scheduler.forward( forward, token_batch, topk = 4096 )
+            scheduler.call( optimizer.step ).result()
+
+        The nucleus encode_forward* methods are decorated with scheduled, so calling them submits to the nucleus scheduler.
+    """
+
+    def __init__( self, max_batch_size: int = 32, max_wait: float = 0.005, name: str = 'inference_scheduler' ):
+        self.max_batch_size = max_batch_size
+        self.max_wait = max_wait
+        self.queue = queue.Queue()
+        # requests taken off the queue while collecting a batch they did not fit into
+        self.backlog = deque()
+        self.stats = dict( requests = 0, batches = 0, rows = 0 )
+        # forward -> check( token_batch, **kwargs ) of the requests it can be batched for
+        self.batchable = {}
+        self.running = True
+        self.worker = threading.Thread( target = self.run, name = name, daemon = True )
+        self.worker.start()
+
+    def put( self, request: InferenceRequest ) -> Future:
+        if threading.current_thread() is self.worker:
+            # e.g. a synapse callback inside a call job, queueing it would wait on itself
+            self.run_batch( [ request ] )
+        else:
+            self.queue.put( request )
+        return request.future
+
+    def register_batchable( self, fn: Callable, check: Callable = None ):
+        r""" Allows requests of fn to be stacked into one call.
+            Args:
+                fn ( :obj:`Callable`, `required`):
+                    Forward returning ( message, model_output, response ) with one response row per input row,
+                    each row computed from its own input row only.
+                check ( :obj:`Callable`, `optional`):
+                    check( token_batch, **kwargs ) -> bool, narrows batching to the requests it holds for.
+        """
+        self.batchable[fn] = check
+
+    def can_batch( self, fn: Callable, token_batch: torch.Tensor, **kwargs ) -> bool:
+        if fn not in self.batchable:
+            return False
+        check = self.batchable[fn]
+        return check is None or bool( check( token_batch, **kwargs ) )
+
+    def submit( self, fn: Callable, token_batch: torch.Tensor, **kwargs ) -> Future:
+        r""" Queues fn( token_batch, **kwargs ), which returns ( message, model_output, response ).
+        """
+        batchable = self.can_batch( fn, token_batch, **kwargs )
+        return self.put( InferenceRequest( fn = fn, args = ( token_batch, ), kwargs = kwargs, token_batch = token_batch, batchable = batchable ) )
+
+    def forward( self, fn: Callable, token_batch: torch.Tensor, **kwargs ):
+        return self.submit( fn, token_batch, **kwargs ).result()
+
+    async def async_forward( self, fn: Callable, token_batch: torch.Tensor, **kwargs ):
+        return await asyncio.wrap_future( self.submit( fn, token_batch, **kwargs ) )
+
+    def call( self, fn: Callable, *args, **kwargs ) -> Future:
+        r""" Runs fn( *args, **kwargs ) on the worker on its own, never batched.
+        """
+        return self.put( InferenceRequest( fn = fn, args = args, kwargs = kwargs ) )
+
+    def next_request( self, timeout: Optional[float] = None ) -> Optional[InferenceRequest]:
+        if len( self.backlog ) > 0:
+            return self.backlog.popleft()
+        try:
+            return self.queue.get( timeout = timeout )
+        except queue.Empty:
+            return None
+
+    def collect( self, first: InferenceRequest ) -> List[InferenceRequest]:
+        r""" The first request and the queued requests that can run in the same batch.
+        """
+        batch = [ first ]
+        if first.batch_key is None:
+            return batch
+        rows = first.token_batch.size( 0 )
+
+        # requests skipped earlier may fit this batch
+        for request in list( self.backlog ):
+            if request.batch_key == first.batch_key and rows + request.token_batch.size( 0 ) <= self.max_batch_size:
+                self.backlog.remove( request )
+                batch.append( request )
+                rows += request.token_batch.size( 0 )
+
+        deadline = time.monotonic() + self.max_wait
+        while rows < self.max_batch_size:
+            timeout = deadline - time.monotonic()
+            if timeout <= 0:
+                break
+            try:
+                request = self.queue.get( timeout = timeout )
+            except queue.Empty:
+                break
+            if request is None:
+                # stop was called, finish this batch first
+                self.running = False
+                break
+            if request.batch_key == first.batch_key and rows + request.token_batch.size( 0 ) <= self.max_batch_size:
+                batch.append( request )
+                rows += request.token_batch.size( 0 )
+            else:
+                self.backlog.append( request )
+        return batch
+
+    def run_batch( self, batch: List[InferenceRequest] ):
+        live_batch = [ request for request in batch if request.future.set_running_or_notify_cancel() ]
+        if len( live_batch ) == 0:
+            return
+        try:
+            if len( live_batch ) == 1:
+                request = live_batch[0]
+                request.future.set_result( request.fn( *request.args, **request.kwargs ) )
+                return
+
+            first = live_batch[0]
+            sizes = [ request.token_batch.size( 0 ) for request in live_batch ]
+            token_batch = torch.cat( [ request.token_batch for request in live_batch ], dim = 0 )
+            message, _, response = first.fn( token_batch, **first.kwargs )
+            if response.size( 0 ) != token_batch.size( 0 ):
+                raise ValueError( '{} is registered as batchable but returned {} rows for {} inputs'.format( first.fn, response.size( 0 ), token_batch.size( 0 ) ) )
+            # the model output belongs to the stacked batch, so it is not handed out to the synapse chain
+            for request, response_rows in zip( live_batch, torch.split( response, sizes, dim = 0 ) ):
+                request.future.set_result( ( message, None, response_rows ) )
+        except Exception as e:
+            for request in live_batch:
+                if not request.future.done():
+                    request.future.set_exception( e )
+
+    def run( self ):
+        while self.running:
+            request = self.next_request()
+            if request is None:
+                continue
+            batch = self.collect( request )
+            self.stats['requests'] += len( batch )
+            self.stats['batches'] += 1
+            self.stats['rows'] += sum( r.token_batch.size( 0 ) for r in batch if r.token_batch is not None )
+            try:
+                self.run_batch( batch )
+            except Exception as e:
+                logger.error( 'Inference scheduler error: {}', e )
+
+    def check_batching( self, fn: Callable, token_batches: List[torch.Tensor], rtol: float = 1e-4, atol: float = 1e-5, **kwargs ) -> bool:
+        r""" True if the stacked call of fn gives every token batch the response of its own call.
+            Runs on the worker. Float kernels may pick other reductions for other batch sizes,
+            so responses are compared up to rtol and atol.
+        """
+        def check():
+            with torch.no_grad():
+                single = [ fn( token_batch, **kwargs )[2] for token_batch in token_batches ]
+                _, _, stacked = fn( torch.cat( token_batches, dim = 0 ), **kwargs )
+            rows = torch.split( stacked, [ token_batch.size( 0 ) for token_batch in token_batches ], dim = 0 )
+            return all( response.shape == row.shape and torch.allclose( response.float(), row.float(), rtol = rtol, atol = atol )
+                        for response, row in zip( single, rows ) )
+        return self.call( check ).result()
+
+    def stop( self ):
+        self.running = False
+        # wake the worker up
+        self.queue.put( None )
+
+    def __len__( self ) -> int:
+        return self.queue.qsize() + len( self.backlog )
+
+
+def scheduled( forward: Callable ) -> Callable:
+    r""" Decorator for the nucleus encode_forward* methods, runs them on self.scheduler (inline when there is none).
+
+        The undecorated forward is kept as .unscheduled, that is what the scheduler stacks for batchable requests
+        (see InferenceScheduler.register_batchable), so decorators applied on top, e.g. cached_response, see each
+        request on its own rather than the stacked batch.
+    """
+    signature = inspect.signature( forward )
+
+    @functools.wraps( forward )
+    def wrapper( self, *args, **kwargs ):
+        scheduler = getattr( self, 'scheduler', None )
+        if scheduler is None:
+            return forward( self, *args, **kwargs )
+        params = signature.bind( self, *args, **kwargs ).arguments
+        params.pop( 'self' )
+        token_batch = params.pop( next( iter( params ) ) )
+        return scheduler.forward( forward.__get__( self ), token_batch, **params )
+    wrapper.unscheduled = forward
+    return wrapper
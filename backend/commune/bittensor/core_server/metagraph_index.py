@@ -0,0 +1,91 @@
+""" Constant time lookups for the per-request axon checks.
+"""
+import time
+from threading import Lock
+from collections import OrderedDict
+from typing import Optional
+
+
+class MetagraphIndex:
+    r""" hotkey -> uid dict, a plain stake list and the weights set on the server, built from the metagraph.
+
+        The priority, blacklist and synapse checks run on every request in the axon thread pool, so they
+        look hotkeys up here instead of scanning metagraph.hotkeys. Call rebuild after every metagraph sync.
+        The lookups are swapped in as one tuple, so readers never see a half rebuilt index.
+
+        Args:
+            metagraph ( :obj:`bittensor.Metagraph`, `optional`):
+                Metagraph to index.
+            hotkey ( str, `optional`):
+                Hotkey of the server, for the weights the other neurons set on it.
+    """
+
+    def __init__( self, metagraph: 'bittensor.Metagraph' = None, hotkey: str = None ):
+        self.hotkey = hotkey
+        self.state = ( {}, [], [] )
+        if metagraph != None:
+            self.rebuild( metagraph )
+
+    def rebuild( self, metagraph: 'bittensor.Metagraph' ) -> 'MetagraphIndex':
+        hotkey2uid = { hotkey: uid for uid, hotkey in enumerate( metagraph.hotkeys ) }
+        stake = metagraph.S.detach().cpu().tolist() if len( hotkey2uid ) > 0 else []
+        # column of the server in W, the weight each neuron sets on it
+        own_uid = hotkey2uid.get( self.hotkey )
+        weight = metagraph.W[:, own_uid].detach().cpu().tolist() if own_uid != None else []
+        self.state = ( hotkey2uid, stake, weight )
+        return self
+
+    def __contains__( self, hotkey: str ) -> bool:
+        return hotkey in self.state[0]
+
+    def __len__( self ) -> int:
+        return len( self.state[0] )
+
+    def uid( self, hotkey: str ) -> Optional[int]:
+        return self.state[0].get( hotkey )
+
+    def stake( self, hotkey: str, default: float = 0.0 ) -> float:
+        r""" Stake of the hotkey, default if it is not registered.
+        """
+        hotkey2uid, stake, _ = self.state
+        uid = hotkey2uid.get( hotkey )
+        return stake[uid] if uid != None else default
+
+    def weight( self, hotkey: str, default: float = 0.0 ) -> float:
+        r""" Weight the neuron of hotkey sets on the server, default if either is not registered.
+        """
+        hotkey2uid, _, weight = self.state
+        uid = hotkey2uid.get( hotkey )
+        return weight[uid] if uid != None and uid < len( weight ) else default
+
+
+class TimeCheck:
+    r""" Per hotkey rate limiter, rejects a hotkey seen again within min_interval seconds.
+
+        Entries are kept in last-seen order, so entries older than min_interval (which can no longer
+        reject anything) are dropped from the front, and the total is bounded by max_size.
+        Like the dict it replaces, every request refreshes the hotkey's time, rejected or not.
+    """
+
+    def __init__( self, min_interval: float, max_size: int = 100000 ):
+        self.min_interval = min_interval
+        self.max_size = max_size
+        self.last_seen = OrderedDict()
+        self.lock = Lock()
+
+    def __len__( self ) -> int:
+        return len( self.last_seen )
+
+    def check( self, hotkey: str ) -> bool:
+        r""" Records the request and returns True if it is allowed.
+        """
+        now = time.monotonic()
+        with self.lock:
+            prev_time = self.last_seen.pop( hotkey, None )
+            self.last_seen[hotkey] = now
+            while len( self.last_seen ) > 0:
+                oldest_hotkey, oldest_time = next( iter( self.last_seen.items() ) )
+                if now - oldest_time < self.min_interval and len( self.last_seen ) <= self.max_size:
+                    break
+                self.last_seen.popitem( last=False )
+        return prev_time == None or now - prev_time >= self.min_interval
@@ -15,7 +15,11 @@ from loguru import logger; logger = logger.opt(colors=True)
 import sys
 import time
 import datetime
-from threading import Lock
+from commune.utils.tokenizer import TokenizerCache
+from commune.bittensor.core_server.token_translation import TokenTranslator
+from commune.bittensor.core_server.metagraph_index import MetagraphIndex, TimeCheck
+from commune.bittensor.core_server.response_cache import ResponseCache, cached_response
+from commune.bittensor.core_server.inference_scheduler import InferenceScheduler, scheduled
 from datetime import datetime,timedelta
 import wandb
 import pandas
@@ -86,9 +90,16 @@ class RemoteNucleus(torch.nn.Module):
             self.tokenizer = AutoTokenizer.from_pretrained(self.tokenizer)
 
         self.tokenizer = prep_tokenizer(self.tokenizer, self.std_tokenizer)
+        # remapping retokenizes the same validator texts over and over, so both tokenizers are cached
+        self.tokenizer_cache = TokenizerCache(self.tokenizer, fast=False)
+        self.std_tokenizer_cache = TokenizerCache(self.std_tokenizer, fast=False)
+        # id to id remapping when both tokenizers share a tokenization model
+        self.token_translator = TokenTranslator(self.std_tokenizer, self.tokenizer)
         self.to_translation_map = get_translation_map(self.tokenizer, self.std_tokenizer)
         self.from_translation_map = get_translation_map(self.std_tokenizer, self.tokenizer)
         self.split_map_cache = {}
+        # deterministic forwards, so repeated validator batches are answered without the model
+        self.response_cache = ResponseCache(max_bytes=int(config.neuron.response_cache_mb * 2 ** 20)) if config.neuron.response_cache_mb > 0 else None
 
         #parameters of the models
         self.final_dim =  bittensor.__network_dim__
@@ -124,6 +135,8 @@ class RemoteNucleus(torch.nn.Module):
         # Load/Sync/Save our metagraph.
         self.metagraph = metagraph if metagraph else bittensor.metagraph ( subtensor = subtensor)
         self.metagraph.load().sync().save()
+        self.metagraph_index = MetagraphIndex(self.metagraph, hotkey=self.wallet.hotkey.ss58_address)
+        self.timecheck = TimeCheck(min_interval=self.config.neuron.blacklist.time)
 
         # Create our optimizer.
         self.optimizer = torch.optim.SGD(
@@ -131,7 +144,16 @@ class RemoteNucleus(torch.nn.Module):
             lr = config.neuron.learning_rate,
             momentum = config.neuron.momentum,
         )
-        self.mutex = Lock()
+        # axon threads queue their forwards on the scheduler's worker instead of a lock
+        self.scheduler = InferenceScheduler(max_batch_size=config.neuron.scheduler.max_batch_size,
+                                            max_wait=config.neuron.scheduler.max_wait)
+        # the scheduler stacks the undecorated forwards, so the response cache is looked up per request before queueing.
+        # causallmnext compacts its phrases into one 1-D tensor, so it has no rows to split and is never batched
+        for forward in [self.encode_forward, self.encode_forward_causallm]:
+            self.scheduler.register_batchable(forward.unscheduled.__get__(self), self.batchable)
+        if self.checking and not self.check_batching():
+            logger.warning('Stacked forwards do not match single forwards, requests are not batched')
+            self.scheduler.batchable.clear()
 
  
  
@@ -155,7 +177,7 @@ class RemoteNucleus(torch.nn.Module):
 
 
  
-    def remapping_token(self, token_batch, std_tokenizer=None, return_offsets_mapping=False):
+    def remapping_token(self, token_batch, std_tokenizer=None, return_offsets_mapping=False, direct=True):
         r""" Tokenizer remapping; decodes the message and then remaps the message using a new tokenizer
             Args:
                 token_batch ( :obj:`torch.LongTensor`, `required`):
@@ -164,20 +186,36 @@ class RemoteNucleus(torch.nn.Module):
                     The standard tokenizer which was used to tokenize the input.
                 return_offsets_mapping ( :obj:`bool`, `required`):
                     Return offsets_mapping in tokenization to delineate token segment positions.
+                direct ( :obj:`bool`, `optional`):
+                    Translate ids through the token translation table where possible.
         """
-        if std_tokenizer is None:
+        if std_tokenizer is None or std_tokenizer is self.std_tokenizer:
             std_tokenizer = self.std_tokenizer
+            std_tokenizer_cache = self.std_tokenizer_cache
+
+            # translate ids through the precomputed table, only unmappable rows take the text round trip
+            if direct and self.token_translator.direct and not return_offsets_mapping:
+                input_ids, mappable = self.token_translator.translate(token_batch)
+                if not mappable.all():
+                    fallback_rows = (~mappable).nonzero().squeeze(1)
+                    fallback_tokens = self.remapping_token(token_batch[fallback_rows], std_tokenizer=std_tokenizer, direct=False)
+                    input_ids, attention_mask = self.merge_remapped_rows(input_ids, mappable, fallback_rows, fallback_tokens)
+                else:
+                    attention_mask = torch.ones_like(input_ids)
+                return {'input_ids': input_ids.to(self.device), 'attention_mask': attention_mask.to(self.device)}
+        else:
+            std_tokenizer_cache = std_tokenizer
 
         text_batch = std_tokenizer.batch_decode(token_batch)  # decode tokens to original text
         result = translate_special_token_text(text_batch, std_tokenizer, self.tokenizer)  # translate special tokens
         to_text_batch, from_offsets_batch, to_offsets_batch, pad_offsets_batch = result
 
-        tokens = self.tokenizer(to_text_batch, padding=True, truncation=True, max_length=token_batch.size(1), return_tensors='pt',
+        tokens = self.tokenizer_cache(to_text_batch, padding=True, truncation=True, max_length=token_batch.size(1), return_tensors='pt',
                                 add_special_tokens=False).to(self.device)  # assume tokenizer.padding_side = 'left'
 
         if return_offsets_mapping:  # get offsets_mapping in tokenization to delineate token segment positions
-            server_tokens = self.tokenizer(to_text_batch, return_offsets_mapping=True, add_special_tokens=False)
-            std_tokens = std_tokenizer(text_batch, return_offsets_mapping=True)  # encode again to get offsets mapping
+            server_tokens = self.tokenizer_cache(to_text_batch, return_offsets_mapping=True, add_special_tokens=False)
+            std_tokens = std_tokenizer_cache(text_batch, return_offsets_mapping=True)  # encode again to get offsets mapping
 
             # pad offsets so that special token offset widths match for continued correct alignment
             tokens['offset_mapping'] = pad_offsets(server_tokens['offset_mapping'], to_offsets_batch, pad_offsets_batch)
@@ -189,6 +227,101 @@ class RemoteNucleus(torch.nn.Module):
 
 
 
+    def merge_remapped_rows(self, input_ids, mappable, fallback_rows, fallback_tokens):
+        r""" Combines directly translated rows with rows remapped through text, left padding to a common length.
+            Args:
+                input_ids ( :obj:`torch.LongTensor`, `required`):
+                    Translated ids, [batch_size, sequence_len], valid on the mappable rows.
+                mappable ( :obj:`torch.BoolTensor`, `required`):
+                    Rows that were translated directly, [batch_size].
+                fallback_rows ( :obj:`torch.LongTensor`, `required`):
+                    Indices of the remaining rows.
+                fallback_tokens ( :obj:`dict`, `required`):
+                    Text remapped tokens of the fallback rows, at most sequence_len long (truncated).
+        """
+        fallback_ids = fallback_tokens['input_ids'].cpu()
+        fallback_mask = fallback_tokens['attention_mask'].cpu()
+        seq_len = max(input_ids.size(1), fallback_ids.size(1))
+        merged_ids = torch.full((input_ids.size(0), seq_len), self.tokenizer.pad_token_id, dtype=torch.long)
+        merged_mask = torch.zeros((input_ids.size(0), seq_len), dtype=torch.long)
+        merged_ids[mappable, seq_len - input_ids.size(1):] = input_ids[mappable]
+        merged_mask[mappable, seq_len - input_ids.size(1):] = 1
+        merged_ids[fallback_rows, seq_len - fallback_ids.size(1):] = fallback_ids
+        merged_mask[fallback_rows, seq_len - fallback_ids.size(1):] = fallback_mask
+        return merged_ids, merged_mask
+
+    def batchable(self, token_batch, tokenizer=None, **kwargs):
+        r""" True if the rows of token_batch can be stacked with other requests without changing their responses.
+             That holds when every row takes the direct id translation: the server ids keep the sequence length
+             and nothing is padded, so a stacked row sees the same ids, positions and (full) attention mask
+             as it does on its own. Rows remapped through text are left padded to the longest row of the batch.
+
+            Args:
+                token_batch ( :obj:`torch.LongTensor`, `required`):
+                    torch inputs of the request, [batch_size, sequence_len]
+                tokenizer ( huggingface.tokenizer, `optional`):
+                    The tokenizer which was used to tokenize the inputs
+        """
+        return (tokenizer is None or tokenizer is self.std_tokenizer) and self.token_remap == self.remapping_token \
+               and bool(self.token_translator.mappable_rows(token_batch).all())
+
+    def check_batching(self, batch_size=2, sequence_len=16):
+        r""" Checks that stacked requests get the responses of single requests for the batchable forwards,
+             on random token batches of directly translated ids.
+        """
+        if not self.token_translator.direct:
+            return True
+        mappable_ids = self.token_translator.mappable.nonzero().squeeze(1)
+        token_batches = [mappable_ids[torch.randint(len(mappable_ids), (batch_size, sequence_len))].to(self.device) for _ in range(2)]
+        # the registered forwards are undecorated, so the check does not go through the response cache
+        return all(self.scheduler.check_batching(forward, token_batches) for forward in list(self.scheduler.batchable))
+
+    def shared_forward(self, token_batch, tokenizer=None, model_output=None, attention_mask=True):
+        r""" Backbone forward shared by the synapses of one request.
+             The returned model_output carries the remapped tokens it was computed from. The axon threads it from
+             one synapse callback to the next, so the following synapses of the request reuse it instead of running
+             the model again. It is only reused for the same token batch and tokenizer, and for a different
+             attention_mask setting only when nothing is padded (so the mask makes no difference).
+
+            Args:
+                token_batch ( :obj:`torch.LongTensor`, `required`):
+                    torch inputs to be forward processed, [batch_size, sequence_len]
+                tokenizer ( huggingface.tokenizer, `optional`):
+                    The tokenizer which was used to tokenize the inputs
+                model_output (:obj:`transformers.modeling_outputs.BaseModelOutputWithCrossAttentions`, `optional`):
+                    The output of a previous synapse of the request.
+                attention_mask ( :obj:`bool`, `optional`):
+                    Pass the attention mask of the remapped tokens to the model.
+
+            Returns:
+                tokens (:obj:`dict`, `required`):
+                    Remapped server tokens, with offsets mappings unless the ids were translated directly.
+                model_output (:obj:`transformers.modeling_outputs.BaseModelOutputWithCrossAttentions`, `required`):
+                    The output of huggingface auto model, with hidden states.
+        """
+        if tokenizer is self.std_tokenizer:
+            tokenizer = None
+
+        context = getattr(model_output, 'forward_context', None)
+        same_batch = context is not None and context['tokenizer'] is tokenizer and torch.equal(context['token_batch'], token_batch)
+        if same_batch and (context['attention_mask'] == attention_mask or context['full_mask']):
+            return context['tokens'], model_output
+
+        if same_batch:
+            tokens, direct = context['tokens'], context['direct']
+        else:
+            # with a direct id translation the offsets are not needed
+            direct = tokenizer is None and self.token_remap == self.remapping_token \
+                     and bool(self.token_translator.mappable_rows(token_batch).all())
+            tokens = self.token_remap(token_batch, std_tokenizer=tokenizer, return_offsets_mapping=not direct)  # remap to server tokenizer
+
+        model_output = self.pre_model(input_ids=tokens['input_ids'],
+                                      attention_mask=tokens['attention_mask'] if attention_mask else None,
+                                      output_hidden_states=True)
+        model_output.forward_context = dict(token_batch=token_batch, tokenizer=tokenizer, tokens=tokens, direct=direct,
+                                            attention_mask=attention_mask, full_mask=bool(tokens['attention_mask'].all()))
+        return tokens, model_output
+
     def forward(self, inputs, tokenizer=None):
         """
             Forward pass through the whole server model. Returns the loss and decoded predictions.
@@ -248,6 +381,8 @@ class RemoteNucleus(torch.nn.Module):
 
         return None, model_output, model_output.logits
     
+    @cached_response('lasthidden')
+    @scheduled
     def encode_forward(self,inputs,tokenizer=None, model_output = None):
         r""" Forward pass through the pretrained model and possible mappings between hidden units. 
              The response tensor should be the hidden units computed using the local context and with shape: [batch_size, sequence_len, __network_dim__].
@@ -271,11 +406,7 @@ class RemoteNucleus(torch.nn.Module):
         transformers.enable_full_determinism(0)
 
         sen_len = inputs.size()
-        tokens = self.token_remap(inputs, tokenizer)  # remap to server tokenizer
-
-        model_output = self.model(input_ids=tokens['input_ids'],
-                                        attention_mask=tokens['attention_mask'],
-                                        output_hidden_states=True)
+        tokens, model_output = self.shared_forward(inputs, tokenizer, model_output)
 
         pre_hidden = model_output.hidden_states[-1]
 
@@ -295,6 +426,8 @@ class RemoteNucleus(torch.nn.Module):
 
         return None, model_output, encoded_hidden
 
+    @cached_response('causallm')
+    @scheduled
     def encode_forward_causallm(self, token_batch, tokenizer=None, encode_len=bittensor.__network_dim__, model_output=None):
         r""" Forward pass through the pretrained model and possible mappings between hidden units.
              The response tensor should be the hidden units computed using the local context and
@@ -320,22 +453,22 @@ class RemoteNucleus(torch.nn.Module):
         transformers.set_seed(0)
         transformers.enable_full_determinism(0)
 
-        tokens = self.token_remap(token_batch, std_tokenizer=tokenizer, return_offsets_mapping=True)  # remap to server tokenizer
-
         def _forward(_model_output=model_output):
-            if _model_output is None:
-                # transformer models like gerpt2 typically perform worse with left-side attention mask, so turning it off
-                _model_output = self.pre_model(input_ids=tokens['input_ids'],
-                                                #attention_mask=tokens['attention_mask'],
-                                               output_hidden_states=True)
+            # transformer models like gerpt2 typically perform worse with left-side attention mask, so turning it off
+            tokens, _model_output = self.shared_forward(token_batch, tokenizer, _model_output, attention_mask=False)
+            # with a direct id translation the probabilities are a gather instead of an offset alignment
+            direct = _model_output.forward_context['direct']
             pre_logits = _model_output.logits  # [batch_size, sequence_len, self.tokenizer.vocab_len]
 
-            probs_std = translate_logits_to_probs_std(pre_logits,
-                                                      tokens['offset_mapping'], tokens['offset_mapping_std'],
-                                                      self.tokenizer, self.std_tokenizer,
-                                                      self.split_map_cache,
-                                                      self.to_translation_map, self.from_translation_map,
-                                                      tokens['input_ids'], token_batch)
+            if direct:
+                probs_std = self.token_translator.translate_probs(torch.softmax(pre_logits, dim=-1))
+            else:
+                probs_std = translate_logits_to_probs_std(pre_logits,
+                                                          tokens['offset_mapping'], tokens['offset_mapping_std'],
+                                                          self.tokenizer, self.std_tokenizer,
+                                                          self.split_map_cache,
+                                                          self.to_translation_map, self.from_translation_map,
+                                                          tokens['input_ids'], token_batch)
             probs_std = probs_std.to(self.device)
             logits_std = torch.log(probs_std + 1e-40)
 
@@ -352,6 +485,8 @@ class RemoteNucleus(torch.nn.Module):
         with torch.no_grad():
             return _forward()  # no gradients
 
+    @cached_response('causallmnext')
+    @scheduled
     def encode_forward_causallmnext(self, token_batch, std_tokenizer=None, topk: int = 4096, model_output=None):
         r"""
         Forward pass through the pretrained model and select topk tokenizer logits and retokenize with std_tokenizer,
@@ -393,13 +528,7 @@ class RemoteNucleus(torch.nn.Module):
         if std_tokenizer is None:
             std_tokenizer = self.std_tokenizer
 
-        tokens = self.token_remap(token_batch, std_tokenizer)
-
-
-        if _model_output is None:
-            _model_output = self.pre_model(input_ids=tokens['input_ids'],
-                                            attention_mask=tokens['attention_mask'],
-                                            output_hidden_states=True)
+        tokens, _model_output = self.shared_forward(token_batch, std_tokenizer, model_output)
 
         # model_output.logits: [batch_size, sequence_len, server_vocab_size]
         last_logits = _model_output.logits[:, -1, :]  # [batch_size] server prediction of continuation, right-aligned
@@ -476,6 +605,9 @@ class RemoteNucleus(torch.nn.Module):
         parser.add_argument('--neuron.disable_blacklist', action='store_true', help='Turns off blacklisting', default=False)
         parser.add_argument('--neuron.disable_priority', action='store_true', help='Turns off priority threadpool', default=False)
         parser.add_argument('--neuron.num_remote_loss', type=int, help='Number of past remote loss to keep in stat.', default=20)
+        parser.add_argument('--neuron.scheduler.max_batch_size', type=int, help='Most rows the inference worker stacks into one forward', default=32)
+        parser.add_argument('--neuron.scheduler.max_wait', type=float, help='Seconds the inference worker waits for more requests to batch', default=0.005)
+        parser.add_argument('--neuron.response_cache_mb', type=float, help='Memory budget (MB) of the forward response cache, 0 turns it off', default=1024)
 
         # Synapse Arguements
         parser.add_argument('--neuron.lasthidden', action='store_false', help='To turn off last hidden synapse', default=True)
@@ -514,25 +646,28 @@ class RemoteNucleus(torch.nn.Module):
 
         """
         ## Uid that sent the request
-        incoming_uid = metagraph.hotkeys.index(hotkey)
+        incoming_uid = self.metagraph_index.uid(hotkey)
+        if incoming_uid == None:
+            return False
+        incoming_stake = self.metagraph_index.stake(hotkey)
         if synapse.synapse_type == bittensor.proto.Synapse.SynapseType.TEXT_LAST_HIDDEN_STATE:
             
-            if metagraph.S[incoming_uid] < self.config.neuron.lasthidden_stake:
+            if incoming_stake < self.config.neuron.lasthidden_stake:
                 return False
             
         elif synapse.synapse_type == bittensor.proto.Synapse.SynapseType.TEXT_CAUSAL_LM:
 
-            if metagraph.S[incoming_uid] < self.config.neuron.causallm_stake:
+            if incoming_stake < self.config.neuron.causallm_stake:
                 return False
 
         elif synapse.synapse_type == bittensor.proto.Synapse.SynapseType.TEXT_CAUSAL_LM_NEXT:
 
-            if metagraph.S[incoming_uid] < self.config.neuron.causallmnext_stake:
+            if incoming_stake < self.config.neuron.causallmnext_stake:
                 return False
 
         elif synapse.synapse_type == bittensor.proto.Synapse.SynapseType.TEXT_SEQ_2_SEQ:
 
-            if (metagraph.S[incoming_uid] < self.config.neuron.seq2seq_stake) and (metagraph.S[incoming_uid,  uid]):
+            if (incoming_stake < self.config.neuron.seq2seq_stake) and (self.metagraph_index.weight(hotkey) > 0):
                 return False     
         else:
             return False
@@ -550,29 +685,26 @@ class RemoteNucleus(torch.nn.Module):
                 request_type ( bittensor.proto.RequestType, `required`):
                     the request type ('FORWARD' or 'BACKWARD').
         """
-        try:        
-            uid = self.metagraph.hotkeys.index(pubkey)
-            priority = self.metagraph.S[uid].item()
-        
-        except:
-            # zero priority for those who are not registered.
-            priority =  0
-
-        return priority
+        # zero priority for those who are not registered.
+        return self.metagraph_index.stake(pubkey, default=0)
 
 
     def forward_casual_lm_next(self, inputs_x: torch.FloatTensor, synapse, model_output=None):
-        with self.mutex:
-            message, model_output, topk_token_phrases = self.encode_forward_causallmnext(inputs_x,
-                                                                                        topk=synapse.topk,
-                                                                                        model_output=model_output)
+        message, model_output, topk_token_phrases = self.encode_forward_causallmnext(inputs_x,
+                                                                             topk=synapse.topk,
+                                                                             model_output=model_output)
         # topk_token_phrases: [sum_b(sum_k(len(phrase_k) + 1)_b)] contains topk token phrases and probabilities
         #   Compacted 1-D tensor >= batch_size * (2 * topk + 1)
         return message, model_output, topk_token_phrases
 
     def optimizer_step(self):
-        self.optimizer.step()
-        self.optimizer.zero_grad()
+        def step():
+            self.optimizer.step()
+            self.optimizer.zero_grad()
+            if self.response_cache is not None:
+                self.response_cache.clear()
+        # between batches, never in the middle of a forward
+        self.scheduler.call(step).result()
 
     def blacklist(self, pubkey:str, request_type:bittensor.proto.RequestType) -> bool:
         r"""Axon security blacklisting, used to blacklist message from low stake members
@@ -586,7 +718,7 @@ class RemoteNucleus(torch.nn.Module):
 
         def registration_check():
             # If we allow non-registered requests return False = not blacklisted.
-            is_registered = pubkey in self.metagraph.hotkeys
+            is_registered = pubkey in self.metagraph_index
             if not is_registered:
                 if self.config.neuron.blacklist_allow_non_registered:
                     return False
@@ -596,26 +728,15 @@ class RemoteNucleus(torch.nn.Module):
         # Check for stake
         def stake_check() -> bool:
             # Check stake.
-            uid = self.metagraph.hotkeys.index(pubkey)
-            if self.metagraph.S[uid].item() < self.config.neuron.blacklist.stake:
+            if self.metagraph_index.stake(pubkey) < self.config.neuron.blacklist.stake:
 
                 raise Exception('Stake blacklist')
             return False
 
         # Check for time
         def time_check():
-            current_time = datetime.now()
-            # Only check if the request are forward requests
-            if pubkey in timecheck.keys():
-                prev_time = timecheck[pubkey]
-                if current_time - prev_time >= timedelta(seconds=config.neuron.blacklist.time):
-                    timecheck[pubkey] = current_time
-                else:
-                    timecheck[pubkey] = current_time
-
-                    raise Exception('Time blacklist')
-            else:
-                timecheck[pubkey] = current_time
+            if not self.timecheck.check(pubkey):
+                raise Exception('Time blacklist')
         
             return False
 
@@ -669,6 +790,7 @@ class RemoteNucleus(torch.nn.Module):
             if current_block - last_set_block > blocks_per_set_weights:
                 bittensor.__console__.print('[green]Current Status:[/green]', {**wandb_data, **local_data})
                 self.metagraph.sync()
+                self.metagraph_index.rebuild(self.metagraph)
                 last_set_block = current_block
                 if not self.config.neuron.no_set_weights:
                     try: 
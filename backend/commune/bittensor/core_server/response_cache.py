@@ -0,0 +1,124 @@
+import json
+import hashlib
+import inspect
+import functools
+import torch
+from threading import Lock
+from collections import OrderedDict
+from typing import Callable, Optional, Tuple
+
+
+class ResponseCache:
+    r""" LRU cache of nucleus responses under a memory budget.
+
+        The encode_forward* methods seed and force determinism, so the same synapse, params and token batch
+        always produce the same response. Validators resend the same batches a lot, a hit returns the stored
+        (message, response) without touching the model. Entries are evicted least recently used first until
+        the stored response tensors fit in max_bytes. Clear it whenever the model weights change.
+    """
+
+    def __init__( self, max_bytes: int = 2 ** 30 ):
+        self.max_bytes = max_bytes
+        self.cache = OrderedDict()
+        self.nbytes = 0
+        self.lock = Lock()
+        self.stats = dict( hits = 0, misses = 0, evictions = 0 )
+        # bumped by clear, so responses computed before a weight update are not stored after it
+        self.generation = 0
+
+    @staticmethod
+    def key( synapse_type: str, token_batch: torch.Tensor, **params ) -> str:
+        r""" Hash of the synapse type, its params and the token batch (shape, dtype and content).
+        """
+        token_batch = token_batch.detach().cpu().contiguous()
+        digest = hashlib.sha1( json.dumps( [ synapse_type, params, list( token_batch.shape ), str( token_batch.dtype ) ], sort_keys = True, default = str ).encode() )
+        digest.update( token_batch.numpy().tobytes() )
+        return digest.hexdigest()
+
+    @staticmethod
+    def response_bytes( response: torch.Tensor ) -> int:
+        return response.element_size() * response.nelement()
+
+    def get( self, key: str ) -> Optional[ Tuple[ str, torch.Tensor ] ]:
+        with self.lock:
+            entry = self.cache.get( key )
+            if entry is None:
+                self.stats['misses'] += 1
+                return None
+            self.cache.move_to_end( key )
+            self.stats['hits'] += 1
+            return entry
+
+    def put( self, key: str, message: str, response: torch.Tensor, generation: int = None ):
+        response = response.detach()
+        nbytes = self.response_bytes( response )
+        # a response bigger than the whole budget would only flush the cache
+        if nbytes > self.max_bytes:
+            return
+        with self.lock:
+            if generation is not None and generation != self.generation:
+                return
+            if key in self.cache:
+                self.nbytes -= self.response_bytes( self.cache.pop( key )[1] )
+            self.cache[key] = ( message, response )
+            self.nbytes += nbytes
+            while self.nbytes > self.max_bytes:
+                _, ( _, evicted ) = self.cache.popitem( last = False )
+                self.nbytes -= self.response_bytes( evicted )
+                self.stats['evictions'] += 1
+
+    @property
+    def hit_rate( self ) -> float:
+        total = self.stats['hits'] + self.stats['misses']
+        return self.stats['hits'] / total if total > 0 else 0.0
+
+    def metrics( self ) -> dict:
+        r""" Counters for logging, keys are prefixed with response_cache/.
+        """
+        return { 'response_cache/{}'.format( k ): v for k, v in { **self.stats, 'hit_rate': self.hit_rate, 'entries': len( self.cache ), 'bytes': self.nbytes }.items() }
+
+    def clear( self ):
+        with self.lock:
+            self.cache.clear()
+            self.nbytes = 0
+            self.generation += 1
+
+    def __len__( self ) -> int:
+        return len( self.cache )
+
+
+def cached_response( synapse_type: str ) -> Callable:
+    r""" Decorator for the nucleus encode_forward* methods, serves repeated requests from self.response_cache.
+
+        The cache is skipped when the nucleus has no response_cache, when remote training needs the model output
+        and gradients, or when a param is not a plain value (e.g. a custom tokenizer) and so cannot be part of the key.
+        Hits pass the given model_output through, so the next synapse of the request can still share it.
+        Apply it on top of scheduled, so the lookup happens per request before the scheduler stacks requests.
+    """
+    def decorator( forward: Callable ) -> Callable:
+        signature = inspect.signature( forward )
+
+        @functools.wraps( forward )
+        def wrapper( self, *args, **kwargs ):
+            cache = getattr( self, 'response_cache', None )
+            params = signature.bind( self, *args, **kwargs )
+            params.apply_defaults()
+            params = dict( params.arguments )
+            params.pop( 'self' )
+            model_output = params.pop( 'model_output', None )
+            token_batch = params.pop( next( iter( params ) ) )
+            if cache is None or self.config.neuron.remote_train \
+                    or not all( v is None or isinstance( v, ( bool, int, float, str ) ) for v in params.values() ):
+                return forward( self, *args, **kwargs )
+
+            key = cache.key( synapse_type, token_batch, **params )
+            entry = cache.get( key )
+            if entry is not None:
+                message, response = entry
+                return message, model_output, response
+            generation = cache.generation
+            message, model_output, response = forward( self, *args, **kwargs )
+            cache.put( key, message, response, generation = generation )
+            return message, model_output, response
+        return wrapper
+    return decorator
@@ -25,7 +25,7 @@ import bittensor
 import sys
 import time
 import datetime
-from threading import Lock
+from commune.bittensor.core_server.metagraph_index import MetagraphIndex, TimeCheck
 from datetime import datetime,timedelta
 from loguru import logger; logger = logger.opt(colors=True)
 from torch.nn.utils.rnn import pad_sequence
@@ -66,6 +66,7 @@ def serve(
         )
     
     metagraph.load().sync().save()
+    metagraph_index = MetagraphIndex( metagraph, hotkey = wallet.hotkey.ss58_address )
 
     # Create our optimizer.
     optimizer = torch.optim.SGD(
@@ -73,7 +74,9 @@ def serve(
         lr = config.neuron.learning_rate,
         momentum = config.neuron.momentum,
     )
-    mutex = Lock()
+    # forwards, training steps and optimizer steps all run on the worker of the model's scheduler,
+    # which holds the batchable forwards that passed the model's batching check
+    scheduler = model.scheduler
 
     # --- Setup prometheus summaries.
     # These will not be posted if the user passes --prometheus.level OFF
@@ -96,7 +99,7 @@ def serve(
     except ValueError as e:
         pass
 
-    timecheck_dicts = {bittensor.proto.RequestType.FORWARD:{}, bittensor.proto.RequestType.BACKWARD:{}}
+    timecheck_dicts = {request_type: TimeCheck( min_interval = config.neuron.blacklist.time ) for request_type in [bittensor.proto.RequestType.FORWARD, bittensor.proto.RequestType.BACKWARD]}
     n_topk_peer_weights = subtensor.min_allowed_weights
 
     def priority(pubkey:str, request_type:bittensor.proto.RequestType, inputs_x) -> float:
@@ -109,15 +112,8 @@ def serve(
                 request_type ( bittensor.proto.RequestType, `required`):
                     the request type ('FORWARD' or 'BACKWARD').
         """
-        try:        
-            uid = metagraph.hotkeys.index(pubkey)
-            priority = metagraph.S[uid].item()
-        
-        except:
-            # zero priority for those who are not registered.
-            priority =  0
-
-        return priority
+        # zero priority for those who are not registered.
+        return metagraph_index.stake( pubkey, default = 0 )
 
     def forward_generate( inputs_x:torch.FloatTensor, synapse, model_output = None):
         tokens = model.token_remap(inputs_x.to(model.device))
@@ -142,28 +138,32 @@ def serve(
         bittensor_output = pad_sequence(tokens, batch_first=True)
         return None, model_output, bittensor_output
 
+    # the encode_forward* methods are scheduled, they look up the response cache and then queue on model.scheduler
     def forward_hidden_state(inputs_x:torch.FloatTensor, synapse, model_output = None):
-        with mutex:
-            message, model_output, hidden = model.encode_forward(inputs_x.to(model.device), model_output=model_output)
+        message, model_output, hidden = model.encode_forward( inputs_x.to(model.device), model_output=model_output )
         return message, model_output, hidden
 
     def forward_casual_lm(inputs_x:torch.FloatTensor, synapse, model_output = None):
-        with mutex:
-            message, model_output, logits = model.encode_forward_causallm(inputs_x.to(model.device), model_output=model_output)
+        message, model_output, logits = model.encode_forward_causallm( inputs_x.to(model.device), model_output=model_output )
         return message, model_output, logits
 
     def forward_casual_lm_next(inputs_x: torch.FloatTensor, synapse, model_output=None):
-        with mutex:
-            message, model_output, topk_token_phrases = model.encode_forward_causallmnext(inputs_x.to(model.device),
-                                                                                        topk=synapse.topk,
-                                                                                        model_output=model_output)
+        message, model_output, topk_token_phrases = model.encode_forward_causallmnext( inputs_x.to(model.device),
+                                                                                     topk=synapse.topk,
+                                                                                     model_output=model_output )
         # topk_token_phrases: [sum_b(sum_k(len(phrase_k) + 1)_b)] contains topk token phrases and probabilities
         #   Compacted 1-D tensor >= batch_size * (2 * topk + 1)
         return message, model_output, topk_token_phrases
 
     def optimizer_step():
-        optimizer.step()
-        optimizer.zero_grad()
+        def step():
+            optimizer.step()
+            optimizer.zero_grad()
+            # cached responses came from the old weights
+            if getattr( model, 'response_cache', None ) != None:
+                model.response_cache.clear()
+        # between batches, never in the middle of a forward
+        scheduler.call( step ).result()
 
     def blacklist(pubkey:str, request_type:bittensor.proto.RequestType) -> bool:
         r"""Axon security blacklisting, used to blacklist message from low stake members
@@ -177,7 +177,7 @@ def serve(
 
         def registration_check():
             # If we allow non-registered requests return False = not blacklisted.
-            is_registered = pubkey in metagraph.hotkeys
+            is_registered = pubkey in metagraph_index
             if not is_registered:
                 if config.neuron.blacklist_allow_non_registered:
                     return False
@@ -189,8 +189,7 @@ def serve(
         # Check for stake
         def stake_check() -> bool:
             # Check stake.
-            uid = metagraph.hotkeys.index(pubkey)
-            if metagraph.S[uid].item() < config.neuron.blacklist.stake:
+            if metagraph_index.stake( pubkey ) < config.neuron.blacklist.stake:
                 prometheus_counters.labels("blacklisted.stake").inc()
 
                 raise Exception('Stake blacklist')
@@ -198,20 +197,10 @@ def serve(
 
         # Check for time
         def time_check():
-            current_time = datetime.now()
-            # Only check if the request are forward requests
-            timecheck = timecheck_dicts[request_type]
-            if pubkey in timecheck.keys():
-                prev_time = timecheck[pubkey]
-                if current_time - prev_time >= timedelta(seconds=config.neuron.blacklist.time):
-                    timecheck[pubkey] = current_time
-                else:
-                    timecheck[pubkey] = current_time
-                    prometheus_counters.labels("blacklisted.time").inc()
+            if not timecheck_dicts[request_type].check( pubkey ):
+                prometheus_counters.labels("blacklisted.time").inc()
 
-                    raise Exception('Time blacklist')
-            else:
-                timecheck[pubkey] = current_time
+                raise Exception('Time blacklist')
         
             return False
 
@@ -239,25 +228,28 @@ def serve(
 
         """
         ## Uid that sent the request
-        incoming_uid = metagraph.hotkeys.index(hotkey)
+        incoming_uid = metagraph_index.uid( hotkey )
+        if incoming_uid == None:
+            return False
+        incoming_stake = metagraph_index.stake( hotkey )
         if synapse.synapse_type == bittensor.proto.Synapse.SynapseType.TEXT_LAST_HIDDEN_STATE:
             
-            if metagraph.S[incoming_uid] < config.neuron.lasthidden_stake:
+            if incoming_stake < config.neuron.lasthidden_stake:
                 return False
             
         elif synapse.synapse_type == bittensor.proto.Synapse.SynapseType.TEXT_CAUSAL_LM:
 
-            if metagraph.S[incoming_uid] < config.neuron.causallm_stake:
+            if incoming_stake < config.neuron.causallm_stake:
                 return False
 
         elif synapse.synapse_type == bittensor.proto.Synapse.SynapseType.TEXT_CAUSAL_LM_NEXT:
 
-            if metagraph.S[incoming_uid] < config.neuron.causallmnext_stake:
+            if incoming_stake < config.neuron.causallmnext_stake:
                 return False
 
         elif synapse.synapse_type == bittensor.proto.Synapse.SynapseType.TEXT_SEQ_2_SEQ:
 
-            if (metagraph.S[incoming_uid] < config.neuron.seq2seq_stake) and (metagraph.S[incoming_uid,  uid]):
+            if (incoming_stake < config.neuron.seq2seq_stake) and (metagraph_index.weight( hotkey ) > 0):
                 return False     
         else:
             return False
@@ -293,35 +285,38 @@ def serve(
             return response_tensors, response_codes, response_messages
 
         # --- calling attached synapses ---
-        with mutex and torch.enable_grad() and torch.autograd.set_detect_anomaly(True):
-            for index, synapse in enumerate(synapses):
-                try:
-                    if synapse.synapse_type in axon.synapse_callbacks and axon.synapse_callbacks[synapse.synapse_type] != None:
-                        message, model_output, response_tensor = axon.synapse_callbacks[synapse.synapse_type](inputs_x[index], synapse)
-                        grads_dy_norm = grads_dy[index]/(grads_dy[index].sum() + 0.00001)
-                        torch.autograd.backward (
-                            tensors = [ response_tensor ],
-                            grad_tensors = [ grads_dy_norm ],
-                            retain_graph=True
-                        )
-                        # Only consider loss from causal LM next.
-                        if synapse.synapse_type == bittensor.proto.Synapse.SynapseType.TEXT_CAUSAL_LM_NEXT:
-                            model.remote_losses.append(model_output.loss)
-                            model.remote_losses = model.remote_losses[-config.neuron.num_remote_loss:] if len(model.remote_losses) > config.neuron.num_remote_loss else model.remote_losses
-                        model.backward_gradients_count += inputs_x[index].size(0)
-                        response_tensors.append(None)
-                        response_codes.append(bittensor.proto.ReturnCode.Success)
-                        response_messages.append('Success')
+        # on the scheduler's worker, so no forward runs while the gradients are accumulated
+        def call_synapses():
+            with torch.enable_grad() and torch.autograd.set_detect_anomaly(True):
+                for index, synapse in enumerate(synapses):
+                    try:
+                        if synapse.synapse_type in axon.synapse_callbacks and axon.synapse_callbacks[synapse.synapse_type] != None:
+                            message, model_output, response_tensor = axon.synapse_callbacks[synapse.synapse_type](inputs_x[index], synapse)
+                            grads_dy_norm = grads_dy[index]/(grads_dy[index].sum() + 0.00001)
+                            torch.autograd.backward (
+                                tensors = [ response_tensor ],
+                                grad_tensors = [ grads_dy_norm ],
+                                retain_graph=True
+                            )
+                            # Only consider loss from causal LM next.
+                            if synapse.synapse_type == bittensor.proto.Synapse.SynapseType.TEXT_CAUSAL_LM_NEXT:
+                                model.remote_losses.append(model_output.loss)
+                                model.remote_losses = model.remote_losses[-config.neuron.num_remote_loss:] if len(model.remote_losses) > config.neuron.num_remote_loss else model.remote_losses
+                            model.backward_gradients_count += inputs_x[index].size(0)
+                            response_tensors.append(None)
+                            response_codes.append(bittensor.proto.ReturnCode.Success)
+                            response_messages.append('Success')
                         
-                    else:
+                        else:
+                            response_tensors.append(None)
+                            response_codes.append(bittensor.proto.ReturnCode.NotImplemented)
+                            response_messages.append('Not Implemented')
+                    except Exception as e:
+                        # --- Exception Hit in Synapse ---
                         response_tensors.append(None)
-                        response_codes.append(bittensor.proto.ReturnCode.NotImplemented)
-                        response_messages.append('Not Implemented')
-                except Exception as e:
-                    # --- Exception Hit in Synapse ---
-                    response_tensors.append(None)
-                    response_codes.append(bittensor.proto.ReturnCode.UnknownException)
-                    response_messages.append(str(e))
+                        response_codes.append(bittensor.proto.ReturnCode.UnknownException)
+                        response_messages.append(str(e))
+        scheduler.call( call_synapses ).result()
 
         return response_tensors, response_codes, response_messages
 
@@ -376,21 +371,20 @@ def serve(
             # --- Training step.
             while end_block >= current_block:
                 if current_block != subtensor.get_current_block() and axon.priority_threadpool.is_empty:
-                    with mutex:
-                        logger.info(f'local training\titeration: {iteration}\tstart')
-                        loss, _ = model( next(dataset).to(model.device) )
-                        if iteration > 0 : 
-                            losses += loss
-                        else:
-                            losses = loss
-                        iteration += 1
-                        current_block = subtensor.get_current_block()
-                        logger.info(f'local training\titeration: {iteration}\tloss: {loss}')
+                    logger.info(f'local training\titeration: {iteration}\tstart')
+                    loss, _ = scheduler.call( model, next(dataset).to(model.device) ).result()
+                    if iteration > 0 : 
+                        losses += loss
+                    else:
+                        losses = loss
+                    iteration += 1
+                    current_block = subtensor.get_current_block()
+                    logger.info(f'local training\titeration: {iteration}\tloss: {loss}')
                 else:
                     time.sleep(1)
             
             if iteration != 0:
-                (losses/iteration).backward()
+                scheduler.call( (losses/iteration).backward ).result()
         
         else:
             while end_block >= current_block:
@@ -406,10 +400,14 @@ def serve(
                 optimizer.param_groups[0]['lr'] =  0.1
 
             logger.info('Optmization Started')
-            with mutex:
+            def optimizer_step():
                 clip_grad_norm_(model.parameters(), 1.0)
                 optimizer.step()
                 optimizer.zero_grad()
+                # cached responses came from the old weights
+                if getattr(model, 'response_cache', None) != None:
+                    model.response_cache.clear()
+            scheduler.call( optimizer_step ).result()
             logger.info('Optimization Successful: Model updated')
 
             if (config.neuron.local_train and iteration > 0):
@@ -439,6 +437,8 @@ def serve(
             'incentive': nn.incentive,
             'emission': nn.emission,
         }
+        if getattr( model, 'response_cache', None ) != None:
+            wandb_data.update( model.response_cache.metrics() )
         
         if config.wandb.api_key != 'default':
 
@@ -458,10 +458,14 @@ def serve(
         prometheus_guages.labels("consensus").set( nn.consensus )
         prometheus_guages.labels("incentive").set( nn.incentive )
         prometheus_guages.labels("emission").set( nn.emission )
+        if getattr( model, 'response_cache', None ) != None:
+            for name, value in model.response_cache.metrics().items():
+                prometheus_guages.labels( name ).set( value )
 
         if current_block - last_set_block > blocks_per_set_weights:
             bittensor.__console__.print('[green]Current Status:[/green]', {**wandb_data, **local_data})
             metagraph.sync()
+            metagraph_index.rebuild( metagraph )
             last_set_block = current_block
             if not config.neuron.no_set_weights:
                 try: 
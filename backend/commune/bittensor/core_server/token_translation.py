@@ -0,0 +1,74 @@
+import json
+import torch
+from typing import Tuple
+
+
+class TokenTranslator:
+    r""" Precomputed token id table from the standard (validator) tokenizer to the server tokenizer.
+
+        When both tokenizers share the same tokenization model (vocab, merges, normalizer and pre-tokenizer,
+        e.g. gpt2 and gpt-neo) a std token id maps to exactly one server id, so remapping is an index lookup
+        instead of a batch_decode and re-tokenization. Special tokens map by role (pad, eos, bos, unk).
+        Rows holding ids without a server equivalent (-1 in the table) still go through the text round trip.
+        Tokenizers with different models never take the direct path.
+    """
+
+    special_token_roles = ['pad_token_id', 'eos_token_id', 'bos_token_id', 'unk_token_id']
+
+    def __init__( self, std_tokenizer: 'PreTrainedTokenizerBase', server_tokenizer: 'PreTrainedTokenizerBase' ):
+        self.std_vocab_size = len(std_tokenizer)
+        self.server_vocab_size = len(server_tokenizer)
+        self.pad_token_id = server_tokenizer.pad_token_id
+        self.direct = self.same_tokenization( std_tokenizer, server_tokenizer )
+
+        table = torch.full( (self.std_vocab_size,), -1, dtype=torch.long )
+        if self.direct:
+            server_vocab = server_tokenizer.get_vocab()
+            for token, std_id in std_tokenizer.get_vocab().items():
+                if std_id < self.std_vocab_size:
+                    table[std_id] = server_vocab.get( token, -1 )
+            for role in self.special_token_roles:
+                std_id, server_id = getattr( std_tokenizer, role, None ), getattr( server_tokenizer, role, None )
+                if std_id is not None and server_id is not None:
+                    table[std_id] = server_id
+        self.table = table
+        self.mappable = table >= 0
+
+    @staticmethod
+    def same_tokenization( a: 'PreTrainedTokenizerBase', b: 'PreTrainedTokenizerBase' ) -> bool:
+        r""" True if both tokenizers split any text into the same tokens.
+        """
+        if getattr( a, 'is_fast', False ) and getattr( b, 'is_fast', False ):
+            a_state, b_state = json.loads( a.backend_tokenizer.to_str() ), json.loads( b.backend_tokenizer.to_str() )
+            return all( a_state.get(k) == b_state.get(k) for k in ['normalizer', 'pre_tokenizer', 'model'] )
+        return type(a) == type(b) and a.get_vocab() == b.get_vocab() and getattr( a, 'bpe_ranks', None ) == getattr( b, 'bpe_ranks', None )
+
+    def mappable_rows( self, token_batch: torch.LongTensor ) -> torch.BoolTensor:
+        r""" [batch_size] mask of the rows which translate without a text round trip.
+        """
+        if not self.direct:
+            return torch.zeros( token_batch.size(0), dtype=torch.bool )
+        token_batch = token_batch.cpu()
+        in_range = ( token_batch >= 0 ) & ( token_batch < self.std_vocab_size )
+        return ( in_range & self.mappable[ token_batch.clamp( 0, self.std_vocab_size - 1 ) ] ).all( dim=1 )
+
+    def translate( self, token_batch: torch.LongTensor ) -> Tuple[ torch.LongTensor, torch.BoolTensor ]:
+        r""" Translates std token ids to server token ids.
+            Returns:
+                input_ids (:obj:`torch.LongTensor`, [batch_size, sequence_len]):
+                    Server token ids, only valid on the mappable rows.
+                mappable (:obj:`torch.BoolTensor`, [batch_size]):
+                    Rows which translated directly.
+        """
+        mappable = self.mappable_rows( token_batch )
+        input_ids = self.table[ token_batch.cpu().clamp( 0, self.std_vocab_size - 1 ) ]
+        return input_ids, mappable
+
+    def translate_probs( self, probs: torch.FloatTensor ) -> torch.FloatTensor:
+        r""" Gathers server token probabilities [batch_size, sequence_len, server_vocab] into the std vocab
+            [batch_size, sequence_len, std_vocab]. Server tokens without a std equivalent are dropped and
+            the result is renormalized.
+        """
+        table = self.table.to( probs.device )
+        probs_std = probs[ ..., table.clamp( min=0 ) ] * self.mappable.to( probs.device )
+        return probs_std / probs_std.sum( dim=-1, keepdim=True ).clamp( min=1e-40 )
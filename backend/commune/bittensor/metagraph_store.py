@@ -0,0 +1,149 @@
+import os
+import json
+import hashlib
+import numpy as np
+import torch
+from typing import Dict, List, Optional
+
+
+# n x n metagraph matrices, mostly zeros
+sparse_keys = ['weights', 'bonds']
+
+
+def sparsify_state(state_dict:Dict[str, torch.Tensor], keys:List[str]=sparse_keys) -> Dict[str, torch.Tensor]:
+    '''
+    Copy of the state_dict with the n x n matrices as coalesced sparse COO tensors.
+    '''
+    return {k: v.to_sparse().coalesce() if k in keys and not v.is_sparse else v for k,v in state_dict.items()}
+
+
+def densify_state(state_dict:Dict[str, torch.Tensor]) -> Dict[str, torch.Tensor]:
+    '''
+    Copy of the state_dict with every sparse tensor dense, e.g. for metagraph.load_from_state_dict.
+    '''
+    return {k: v.to_dense() if v.is_sparse else v for k,v in state_dict.items()}
+
+
+class MetagraphStore:
+    '''
+    Versioned metagraph snapshots on disk, one per block.
+
+    Every tensor of a metagraph state_dict is written once as a raw .npy blob named by the hash of its
+    content (sparse tensors as an indices and a values blob), and a snapshot is a small manifest mapping
+    state keys to blobs. Tensors that did not change between two snapshots (e.g. the weights of an
+    incremental sync that touched a few neurons) share a blob.
+    Blobs are memory-mapped (copy on write) on load, so only the pages that are read come off disk.
+
+    Files under path:
+        blobs/<sha1>.npy        tensor contents
+        snapshots/<block>.json  {full_sync_block, state: {key: {blob, dtype}}} of the state_dict at that block,
+                                sparse entries hold {indices, values, shape, dtype}. full_sync_block is the
+                                block of the last full sync the snapshot derives from.
+    '''
+
+    def __init__(self, path:str, keep:int=5):
+        self.path = path
+        self.keep = keep
+        os.makedirs(os.path.join(path, 'blobs'), exist_ok=True)
+        os.makedirs(os.path.join(path, 'snapshots'), exist_ok=True)
+
+    def blob_path(self, blob:str) -> str:
+        return os.path.join(self.path, 'blobs', f'{blob}.npy')
+
+    def snapshot_path(self, block:int) -> str:
+        return os.path.join(self.path, 'snapshots', f'{block}.json')
+
+    def blocks(self) -> List[int]:
+        return sorted(int(f[:-len('.json')]) for f in os.listdir(os.path.join(self.path, 'snapshots')) if f.endswith('.json'))
+
+    def latest(self, max_block:Optional[int]=None) -> Optional[int]:
+        '''
+        The most recent snapshot block, at or before max_block if it is given.
+        '''
+        blocks = [b for b in self.blocks() if max_block is None or b <= max_block]
+        return blocks[-1] if len(blocks) > 0 else None
+
+    def save_blob(self, tensor:torch.Tensor) -> str:
+        array = tensor.detach().cpu().numpy()
+        blob = hashlib.sha1(str((array.dtype.str, array.shape)).encode() + np.ascontiguousarray(array).tobytes()).hexdigest()
+        if not os.path.exists(self.blob_path(blob)):
+            tmp_path = self.blob_path(blob) + '.tmp'
+            with open(tmp_path, 'wb') as f:
+                np.save(f, array)
+            os.replace(tmp_path, self.blob_path(blob))
+        return blob
+
+    def load_blob(self, blob:str) -> torch.Tensor:
+        array = np.load(self.blob_path(blob), mmap_mode='c')
+        return torch.from_numpy(array) if array.ndim > 0 else torch.tensor(array.item())
+
+    def load_manifest(self, block:int) -> dict:
+        with open(self.snapshot_path(block)) as f:
+            manifest = json.load(f)
+        # snapshots written before full_sync_block was recorded count as never fully synced
+        return manifest if 'state' in manifest else dict(full_sync_block=None, state=manifest)
+
+    def full_sync_block(self, block:int) -> Optional[int]:
+        '''
+        The block of the last full sync behind the snapshot at block, None if unknown.
+        '''
+        if not os.path.exists(self.snapshot_path(block)):
+            return None
+        return self.load_manifest(block)['full_sync_block']
+
+    def save(self, block:int, state_dict:Dict[str, torch.Tensor], full_sync_block:Optional[int]=None) -> str:
+        '''
+        Saves the state_dict as the snapshot at block. full_sync_block is the block of the last full sync
+        it derives from (block itself for a full sync).
+        '''
+        manifest = {}
+        for key, tensor in sparsify_state(state_dict).items():
+            dtype = str(tensor.dtype).replace('torch.', '')
+            if tensor.is_sparse:
+                manifest[key] = dict(indices=self.save_blob(tensor.indices()), values=self.save_blob(tensor.values()),
+                                     shape=list(tensor.shape), dtype=dtype)
+            else:
+                manifest[key] = dict(blob=self.save_blob(tensor), dtype=dtype)
+
+        # the manifest goes last, so a snapshot is only listed once all of its blobs exist
+        tmp_path = self.snapshot_path(block) + '.tmp'
+        with open(tmp_path, 'w') as f:
+            json.dump(dict(full_sync_block=full_sync_block, state=manifest), f)
+        os.replace(tmp_path, self.snapshot_path(block))
+        self.prune()
+        return self.snapshot_path(block)
+
+    def load(self, block:Optional[int]=None) -> Optional[Dict[str, torch.Tensor]]:
+        '''
+        The state_dict of the snapshot at block (default the latest), None if there is none.
+        The weights and bonds come back sparse.
+        '''
+        block = self.latest() if block is None else block
+        if block is None or not os.path.exists(self.snapshot_path(block)):
+            return None
+        manifest = self.load_manifest(block)['state']
+        state_dict = {}
+        for key, entry in manifest.items():
+            dtype = getattr(torch, entry['dtype'])
+            if 'blob' in entry:
+                state_dict[key] = self.load_blob(entry['blob']).to(dtype)
+            else:
+                state_dict[key] = torch.sparse_coo_tensor(self.load_blob(entry['indices']), self.load_blob(entry['values']).to(dtype),
+                                                          size=entry['shape'], is_coalesced=True, check_invariants=False)
+        return state_dict
+
+    def prune(self):
+        '''
+        Keeps the latest keep snapshots and deletes the blobs no snapshot refers to.
+        '''
+        blocks = self.blocks()
+        for block in blocks[:-self.keep] if self.keep > 0 else []:
+            os.remove(self.snapshot_path(block))
+
+        referenced = set()
+        for block in self.blocks():
+            for entry in self.load_manifest(block)['state'].values():
+                referenced.update(entry[k] for k in ['blob', 'indices', 'values'] if k in entry)
+        for f in os.listdir(os.path.join(self.path, 'blobs')):
+            if f.endswith('.npy') and f[:-len('.npy')] not in referenced:
+                os.remove(os.path.join(self.path, 'blobs', f))
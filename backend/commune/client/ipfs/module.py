@@ -2,6 +2,9 @@ import io
 import os
 import time
 import weakref
+import threading
+import tarfile
+import tempfile
 import copy
 import asyncio
 import aiohttp
@@ -12,7 +15,6 @@ import streamlit as st
 import logging
 from glob import glob
 from typing import *
-from ipfshttpclient.multipart import stream_directory, stream_files 
 
 
 logger = logging.getLogger("ipfsspec")
@@ -27,11 +29,38 @@ class IPFSModule:
                 ipfs_urls = {'get': f'http://{IPFSHTTP_LOCAL_HOST}:8080', 
                              'post': f'http://{IPFSHTTP_LOCAL_HOST}:5001'},
                 loop=None,
-                client_kwargs={}):
+                client_kwargs={},
+                connection_limit:int=100,
+                connection_limit_per_host:int=32,
+                keepalive_timeout:float=60,
+                max_concurrency:int=32):
+        '''
+        Args:
+            ipfs_urls (dict):
+                Urls of the gateway (get) and of the rpc api (post).
+            loop (asyncio.loop):
+                Event loop already running in another thread, one is started in a background thread otherwise.
+            client_kwargs (dict):
+                Extra kwargs of the aiohttp.ClientSession.
+            connection_limit (int):
+                Max open connections of the session.
+            connection_limit_per_host (int):
+                Max open connections to the same host.
+            keepalive_timeout (float):
+                Seconds an idle connection is kept open for reuse.
+            max_concurrency (int):
+                Max requests in flight for the bulk calls (add_many, pin_many).
+        '''
         self.sync_the_async()
         self.ipfs_url = ipfs_urls
+        self.client_kwargs = client_kwargs
+        self.connector_kwargs = dict(limit=connection_limit, limit_per_host=connection_limit_per_host,
+                                     keepalive_timeout=keepalive_timeout)
+        self.max_concurrency = max_concurrency
+        self.session = None
+        self.loop_thread = None
+        self.loop = loop if loop != None else self.start_loop()
         self.path2hash = self.load_path2hash()
-        self.loop = asyncio.set_event_loop(asyncio.new_event_loop())
 
 
     @classmethod
@@ -42,10 +71,78 @@ class IPFSModule:
 
     @staticmethod
     def sync_wrapper(fn):
-        def wrapper_fn(*args, **kwargs):
-            return asyncio.run(fn(*args, **kwargs))
+        def wrapper_fn(self, *args, **kwargs):
+            return self.run_coroutine(fn(self, *args, **kwargs))
         return  wrapper_fn
 
+    def start_loop(self) -> 'asyncio.loop':
+        '''
+        Start the event loop of the module in a daemon thread. The session and its 
+        connection pool live on this loop, so every sync call reuses them instead of
+        setting up a new loop (asyncio.run) and new connections.
+
+        Returns (asyncio.loop)
+        '''
+        loop = asyncio.new_event_loop()
+        self.loop_thread = threading.Thread(target=loop.run_forever, name='ipfs_loop', daemon=True)
+        self.loop_thread.start()
+        return loop
+
+    def run_coroutine(self, coroutine, timeout:float=None):
+        '''
+        Run a coroutine on the module loop and wait for its result.
+
+        Args:
+            coroutine (Coroutine):
+                Coroutine to run.
+            timeout (float):
+                Seconds to wait for the result.
+        '''
+        assert threading.current_thread() is not self.loop_thread, \
+            'sync calls inside the ipfs loop would wait on themselves, await the async_ version instead'
+        return asyncio.run_coroutine_threadsafe(coroutine, self.loop).result(timeout=timeout)
+
+    async def get_session(self) -> 'aiohttp.ClientSession':
+        '''
+        The long lived session of the module, created on first use.
+        Connections are kept alive and reused across requests.
+        '''
+        if self.session == None or self.session.closed:
+            connector = aiohttp.TCPConnector(**self.connector_kwargs)
+            self.session = aiohttp.ClientSession(connector=connector, **self.client_kwargs)
+        return self.session
+
+    def close(self):
+        '''
+        Close the session and stop the loop if the module started it.
+        '''
+        if self.session != None and not self.session.closed:
+            self.run_coroutine(self.session.close())
+        self.session = None
+        if self.loop_thread != None:
+            self.loop.call_soon_threadsafe(self.loop.stop)
+            self.loop_thread.join()
+            self.loop_thread = None
+
+    async def bounded_gather(self, jobs:List['Coroutine'], max_concurrency:int=None, return_exceptions:bool=False) -> list:
+        '''
+        asyncio.gather with at most max_concurrency jobs running at once.
+
+        Args:
+            jobs (List[Coroutine]):
+                Coroutines to run.
+            max_concurrency (int):
+                Max running jobs, defaults to self.max_concurrency.
+            return_exceptions (bool):
+                Return the exceptions of failed jobs in place of their results instead of raising.
+        Returns (list)
+        '''
+        semaphore = asyncio.Semaphore(max_concurrency if max_concurrency != None else self.max_concurrency)
+        async def bounded_job(job):
+            async with semaphore:
+                return await job
+        return await asyncio.gather(*[bounded_job(job) for job in jobs], return_exceptions=return_exceptions)
+
     async def async_api_post(self, 
                       endpoint:str, 
                       params:dict = {} ,
@@ -81,21 +178,16 @@ class IPFSModule:
         return_result = None
         # we need to  set the 
         timeout = aiohttp.ClientTimeout(sock_connect=10, sock_read=10)
-        async with aiohttp.ClientSession( timeout=timeout) as session:
-            async with session.post(url,params=params,headers=headers, data=data) as res:
-                if return_json: 
-                    return_result = await res.json(content_type=content_type)
-                else:
-                    return_result = res
-
-                # if num_chunks != None
-                if num_chunks:
-                    return_result = b''
-                    async for data in res.content.iter_chunked(chunk_size):
-                        return_result += data
-                        num_chunks-= 1
-                        if num_chunks == 0:
-                            break
+        session = await self.get_session()
+        async with session.post(url,params=params,headers=headers, data=data, timeout=timeout) as res:
+            if return_json: 
+                return_result = await res.json(content_type=content_type)
+            else:
+                return_result = res
+
+            # if num_chunks != None
+            if num_chunks:
+                return_result = await self.read_chunks(res, chunk_size=chunk_size, num_chunks=num_chunks)
         return return_result
 
     async def async_api_get(self, 
@@ -127,22 +219,32 @@ class IPFSModule:
         url = os.path.join(self.ipfs_url['get'],'api/v0', endpoint)
     
         return_result = None
-        async with aiohttp.ClientSession(loop=self.loop) as session:
-            async with session.get(url,params=params,headers=headers) as res:
-                if return_json: 
-                    return_result = await res.json(content_type=content_type)
-                else:
-                    return_result = res
-
-                if chunk_size:
-                    return_result = b''
-                    async for data in res.content.iter_chunked(chunk_size):
-                        return_result += data
-                        num_chunks-= 1
-                        if num_chunks == 0:
-                            break
+        session = await self.get_session()
+        async with session.get(url,params=params,headers=headers) as res:
+            if return_json: 
+                return_result = await res.json(content_type=content_type)
+            else:
+                return_result = res
+
+            if chunk_size:
+                return_result = await self.read_chunks(res, chunk_size=chunk_size, num_chunks=num_chunks)
         return return_result
 
+    @staticmethod
+    async def read_chunks(res:'aiohttp.ClientResponse', chunk_size:int=-1, num_chunks:int=None) -> bytes:
+        '''
+        Read up to num_chunks chunks of the response body (all of it if None) into one
+        bytearray, appending in place rather than concatenating bytes per chunk.
+        '''
+        buffer = bytearray()
+        async for data in res.content.iter_chunked(chunk_size):
+            buffer.extend(data)
+            if num_chunks != None:
+                num_chunks -= 1
+                if num_chunks == 0:
+                    break
+        return bytes(buffer)
+
     async def async_version(self, session):
         res = await self.async_api_get("version")
         return rest
@@ -168,23 +270,73 @@ class IPFSModule:
         '''
         params = dict(arg=cid, **kwargs)
         if isinstance(output_path, str):
-            params['output'] =  output_path
+            return await self.async_get_to_path(cid=cid, output_path=output_path, **kwargs)
         res = await self.async_api_get('get', params=params , return_json=False)
         return res
         
 
-    async def async_pin(self, session, cid, recursive=False, progress=False, **kwargs):
-        kwargs['params'] = kwargs.get('params', {})
-        kwargs['params'] = dict(arg=cid, recursive= recursive,progress= progress)
-        res = await self.async_api_post(endpoint='pin/add', arg=cid, recursive= recursive,  **kwargs)
-        return bool(cid in pinned_cid_list)
+    async def async_pin(self, cid, recursive=True, progress=False, **kwargs):
+        params = dict(arg=cid, recursive='true' if recursive else 'false', progress='true' if progress else 'false', **kwargs)
+        res = await self.async_api_post(endpoint='pin/add', params=params)
+        return bool(cid in res.get('Pins', []))
 
+    async def async_pin_many(self, cids:List[str], recursive=True, max_concurrency:int=None, **kwargs) -> Dict[str, bool]:
+        '''
+        Pin many cids concurrently over the pooled session.
+
+        Args:
+            cids (List[str]):
+                Cids to pin.
+            recursive (bool):
+                Recursively pin the objects linked to by the cids.
+            max_concurrency (int):
+                Max pin requests in flight, defaults to self.max_concurrency.
+        Returns (Dict[str, Union[bool, Exception]])
+            Whether each cid is pinned, or the exception of its failed request.
+        '''
+        jobs = [self.async_pin(cid=cid, recursive=recursive, **kwargs) for cid in cids]
+        responses = await self.bounded_gather(jobs, max_concurrency=max_concurrency, return_exceptions=True)
+        cid2pinned = dict(zip(cids, responses))
+        failed = [cid for cid, r in cid2pinned.items() if isinstance(r, Exception)]
+        if len(failed) > 0:
+            logger.warning(f'failed to pin {len(failed)}/{len(cids)} cids: {failed[:10]}')
+        return cid2pinned
+
+    async def async_add_many(self, paths:List[str], pin=True, chunker=262144, max_concurrency:int=None, update_path2hash:bool=True) -> Dict[str, dict]:
+        '''
+        Add many files concurrently over the pooled session.
+
+        Args:
+            paths (List[str]):
+                Paths of the files to add.
+            pin (bool):
+                Pin the added files.
+            chunker (int):
+                Chunk size of the ipfs chunker.
+            max_concurrency (int):
+                Max uploads in flight, defaults to self.max_concurrency.
+            update_path2hash (bool):
+                Record the added files in path2hash.
+        Returns (Dict[str, Union[dict, Exception]])
+            The add response of each path, or the exception of its failed upload.
+        '''
+        jobs = [self.async_add_file(path=fp, pin=pin, chunker=chunker) for fp in paths]
+        responses = await self.bounded_gather(jobs, max_concurrency=max_concurrency, return_exceptions=True)
+        path2hash = dict(zip(paths, responses))
+        failed = [fp for fp, r in path2hash.items() if isinstance(r, Exception)]
+        if len(failed) > 0:
+            logger.warning(f'failed to add {len(failed)}/{len(paths)} files: {failed[:10]}')
+        if update_path2hash:
+            # only the files which were added
+            self.path2hash.update({fp: r for fp, r in path2hash.items() if not isinstance(r, Exception)})
+            await self.async_save_path2hash()
+        return path2hash
 
 
     async def async_add(self,
             path,
             pin=True,
-            chunker=262144 , include_root=True):
+            chunker=262144 , include_root=True, max_concurrency:int=None):
         path = self.resolve_absolute_path(path, include_root=include_root)
         self.path2hash = await self.async_load_path2hash()
         file_paths=[]
@@ -205,13 +357,7 @@ class IPFSModule:
 
         assert len(file_paths) > 0
     
-        jobs = asyncio.gather(*[self.async_add_file(path=fp, pin=pin, chunker=chunker) for fp in file_paths])
-        responses = await jobs
-        path2hash =  dict(zip(file_paths,responses))
-        self.path2hash.update(path2hash)
-        await self.async_save_path2hash()
-
-        return dict(zip(file_paths,responses))
+        return await self.async_add_many(file_paths, pin=pin, chunker=chunker, max_concurrency=max_concurrency)
 
 
     async def async_rm(self, path):
@@ -227,7 +373,7 @@ class IPFSModule:
                 file_meta = self.path2hash[fp]
                 tasks.append(self.async_pin_rm(cid=file_meta['Hash']))
         
-        return_jobs = await asyncio.gather(*tasks)
+        return_jobs = await self.bounded_gather(tasks)
         await self.async_gc()
 
         await self.async_save_path2hash()
@@ -269,25 +415,12 @@ class IPFSModule:
         pin=False,
         chunker=262144, 
         wrap_with_directory=False,
+        progress_callback:Callable=None,
     ):
 
         path = self.resolve_absolute_path(path)
-
-        params = {}
-        params['wrap-with-directory'] = 'true' if wrap_with_directory else 'false'
-        params['chunker'] = f'size-{chunker}'
-        params['pin'] = 'true' if pin else 'false'
-        data, headers = stream_files(path, chunk_size=chunker)
-
-        async def data_gen_wrapper(data):
-            for d in data:
-                yield d
-
-        data = data_gen_wrapper(data=data)   
-             
-        res = await self.async_api_post(endpoint='add',  params=params, data=data, headers=headers)
-        return res
-        # return res
+        return await self.async_add_stream(source=path, name=os.path.basename(path), pin=pin, chunker=chunker,
+                                           wrap_with_directory=wrap_with_directory, progress_callback=progress_callback)
     
 
     async def async_dag_get(self,  **kwargs):
@@ -561,7 +694,235 @@ class IPFSModule:
             length [int64]: Maximum number of bytes to read. Required: no.
             progress [bool]: Stream progress data. Default: true. Required: no.
         '''
-        return await self.async_api_get('cat', params=dict(arg=cid, **kwargs), return_json=False)
+        params = dict(arg=cid, offset=offset, **kwargs)
+        if length != None:
+            params['length'] = length
+        return await self.async_api_get('cat', params=params, return_json=False)
+
+    ##############
+    #   STREAMING
+    ##############
+    stream_chunk_size = 2**20
+    # no total timeout, multi GB transfers only fail when the connection stalls
+    stream_timeout = aiohttp.ClientTimeout(sock_connect=10, sock_read=60)
+
+    async def iter_source(self, source, chunk_size:int=None, progress_callback:Callable=None):
+        '''
+        Chunks of source, read lazily. File reads run in the default executor so they do not block the loop.
+
+        Args:
+            source (Union[str, bytes, BinaryIO, AsyncIterable[bytes], Iterable[bytes]]):
+                Path of a file, bytes, a binary file handle or an (async) iterator of bytes.
+            chunk_size (int):
+                Bytes per read, defaults to self.stream_chunk_size.
+            progress_callback (Callable):
+                Called as progress_callback(bytes_done, total_bytes) after each chunk, total_bytes is None if unknown.
+        '''
+        chunk_size = chunk_size or self.stream_chunk_size
+        loop = asyncio.get_running_loop()
+        total, done = None, 0
+        f = None
+        if isinstance(source, str):
+            total = os.path.getsize(source)
+            source = f = open(source, 'rb')
+        elif isinstance(source, (bytes, bytearray, memoryview)):
+            total = len(source)
+            source = io.BytesIO(source)
+
+        try:
+            if hasattr(source, 'read'):
+                while True:
+                    if isinstance(source, io.BytesIO):
+                        chunk = source.read(chunk_size)
+                    else:
+                        chunk = await loop.run_in_executor(None, source.read, chunk_size)
+                    if not chunk:
+                        break
+                    done += len(chunk)
+                    if progress_callback != None:
+                        progress_callback(done, total)
+                    yield chunk
+            elif hasattr(source, '__aiter__'):
+                async for chunk in source:
+                    done += len(chunk)
+                    if progress_callback != None:
+                        progress_callback(done, total)
+                    yield chunk
+            else:
+                for chunk in source:
+                    done += len(chunk)
+                    if progress_callback != None:
+                        progress_callback(done, total)
+                    yield chunk
+        finally:
+            if f != None:
+                f.close()
+
+    async def async_add_stream(self, 
+                        source, 
+                        name:str='file', 
+                        pin:bool=True, 
+                        chunker:int=262144, 
+                        wrap_with_directory:bool=False, 
+                        chunk_size:int=None, 
+                        progress_callback:Callable=None) -> dict:
+        '''
+        Add a file by streaming it chunk by chunk in a chunked multipart upload, 
+        so only one chunk is in memory at a time.
+
+        Args:
+            source (Union[str, bytes, BinaryIO, AsyncIterable[bytes], Iterable[bytes]]):
+                Path of a file, bytes, a binary file handle or an (async) iterator of bytes.
+            name (str):
+                File name of the upload.
+            pin (bool):
+                Pin the added file.
+            chunker (int):
+                Chunk size of the ipfs chunker.
+            wrap_with_directory (bool):
+                Wrap the file with a directory object.
+            chunk_size (int):
+                Bytes per read of the source.
+            progress_callback (Callable):
+                Called as progress_callback(bytes_sent, total_bytes).
+        Returns (dict)
+            The add response (Name, Hash, Size).
+        '''
+        params = {}
+        params['wrap-with-directory'] = 'true' if wrap_with_directory else 'false'
+        params['chunker'] = f'size-{chunker}'
+        params['pin'] = 'true' if pin else 'false'
+
+        with aiohttp.MultipartWriter('form-data') as writer:
+            part = writer.append(self.iter_source(source, chunk_size=chunk_size, progress_callback=progress_callback),
+                                 {'Content-Type': 'application/octet-stream'})
+            part.set_content_disposition('form-data', name='file', filename=name)
+
+        url = os.path.join(self.ipfs_url['post'],'api/v0', 'add')
+        session = await self.get_session()
+        async with session.post(url, params=params, data=writer, timeout=self.stream_timeout) as res:
+            return await res.json(content_type=None)
+
+    async def iter_response(self, 
+                    endpoint:str, 
+                    params:dict={}, 
+                    chunk_size:int=None, 
+                    progress_callback:Callable=None, 
+                    total:int=None):
+        '''
+        Chunks of the body of a get request, as they arrive.
+
+        Args:
+            endpoint (str):
+                Api endpoint (cat, get).
+            params (dict):
+                Params of the request.
+            chunk_size (int):
+                Max bytes per chunk, defaults to self.stream_chunk_size.
+            progress_callback (Callable):
+                Called as progress_callback(bytes_done, total_bytes) after each chunk.
+            total (int):
+                Expected size, the content length of the response otherwise.
+        '''
+        chunk_size = chunk_size or self.stream_chunk_size
+        url = os.path.join(self.ipfs_url['get'],'api/v0', endpoint)
+        session = await self.get_session()
+        async with session.get(url, params=params, timeout=self.stream_timeout) as res:
+            total = total if total != None else res.content_length
+            done = 0
+            async for chunk in res.content.iter_chunked(chunk_size):
+                done += len(chunk)
+                if progress_callback != None:
+                    progress_callback(done, total)
+                yield chunk
+
+    async def iter_cat(self, cid:str, offset:int=0, length:int=None, chunk_size:int=None, progress_callback:Callable=None):
+        '''
+        Chunks of the file at cid, optionally of the byte range [offset, offset+length).
+        '''
+        params = dict(arg=cid, offset=offset)
+        if length != None:
+            params['length'] = length
+        async for chunk in self.iter_response('cat', params=params, chunk_size=chunk_size,
+                                              progress_callback=progress_callback, total=length):
+            yield chunk
+
+    async def async_cat_to(self, 
+                    cid:str, 
+                    output=None, 
+                    offset:int=0, 
+                    length:int=None, 
+                    chunk_size:int=None, 
+                    progress_callback:Callable=None):
+        '''
+        Stream the file at cid into output chunk by chunk.
+
+        Args:
+            cid (str):
+                Cid of the file.
+            output (Union[str, BinaryIO]):
+                Path or writable binary file handle, a new io.BytesIO if None.
+            offset (int):
+                Byte offset to begin reading from.
+            length (int):
+                Max number of bytes to read.
+            chunk_size (int):
+                Max bytes per chunk.
+            progress_callback (Callable):
+                Called as progress_callback(bytes_done, total_bytes).
+        Returns 
+            The output (path, file handle or io.BytesIO).
+        '''
+        loop = asyncio.get_running_loop()
+        f = output
+        if output == None:
+            output = f = io.BytesIO()
+        elif isinstance(output, str):
+            os.makedirs(os.path.dirname(os.path.abspath(output)), exist_ok=True)
+            f = open(output, 'wb')
+        try:
+            async for chunk in self.iter_cat(cid, offset=offset, length=length, chunk_size=chunk_size, progress_callback=progress_callback):
+                if isinstance(f, io.BytesIO):
+                    f.write(chunk)
+                else:
+                    await loop.run_in_executor(None, f.write, chunk)
+        finally:
+            if isinstance(output, str):
+                f.close()
+        if isinstance(output, io.BytesIO):
+            output.seek(0)
+        return output
+
+    async def async_get_to_path(self, cid:str, output_path:str, chunk_size:int=None, progress_callback:Callable=None, **kwargs) -> str:
+        '''
+        Stream the tar archive of cid (file or directory) to disk next to output_path 
+        and extract it to output_path, without holding it in memory.
+
+        Returns (str)
+            output_path
+        '''
+        output_path = os.path.abspath(output_path)
+        output_dir = os.path.dirname(output_path)
+        os.makedirs(output_dir, exist_ok=True)
+        loop = asyncio.get_running_loop()
+        with tempfile.TemporaryDirectory(dir=output_dir) as tmp_dir:
+            archive_path = os.path.join(tmp_dir, 'archive.tar')
+            with open(archive_path, 'wb') as f:
+                async for chunk in self.iter_response('get', params=dict(arg=cid, **kwargs), chunk_size=chunk_size, progress_callback=progress_callback):
+                    await loop.run_in_executor(None, f.write, chunk)
+
+            extract_dir = os.path.join(tmp_dir, 'extract')
+            def extract():
+                with tarfile.open(archive_path, 'r:*') as tar:
+                    if hasattr(tarfile, 'data_filter'):
+                        tar.extractall(extract_dir, filter='data')
+                    else:
+                        tar.extractall(extract_dir)
+            await loop.run_in_executor(None, extract)
+            # the archive holds a single root entry named after the cid
+            root = os.path.join(extract_dir, os.listdir(extract_dir)[0])
+            os.replace(root, output_path)
+        return output_path
 
     @classmethod
     def test_json(cls):
@@ -0,0 +1,86 @@
+import asyncio
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor, Future
+from typing import Callable, Dict, Any, Optional, Tuple
+
+import numpy as np
+
+
+class PrefetchLoader:
+    '''
+    Keeps up to buffer_size batches in flight on worker threads, so data preparation overlaps
+    with whatever the consumer does between batches (e.g. the RPC fan-out of Sandbox.async_sample).
+
+    Each batch is described by kwargs_fn(rng, batch_index), which runs in the consumer thread when
+    the batch is submitted, and built by sample_fn(**kwargs) on a worker. Batches are returned in
+    submission order and batch i uses an rng seeded with (seed, i), so a seeded loader produces the
+    same batches regardless of worker timing.
+
+    Usage:
+        loader = PrefetchLoader(sample_fn=dataset.sample, kwargs_fn=lambda rng, i: dict(batch_size=8), seed=0)
+        kwargs, batch = next(loader)
+        kwargs, batch = await loader.async_next()
+    '''
+
+    def __init__(self,
+                sample_fn:Callable,
+                kwargs_fn:Callable[[np.random.Generator, int], Dict[str, Any]],
+                buffer_size:int=4,
+                num_workers:int=2,
+                seed:Optional[int]=None,
+                executor:Optional[ThreadPoolExecutor]=None):
+        self.sample_fn = sample_fn
+        self.kwargs_fn = kwargs_fn
+        self.buffer_size = buffer_size
+        self.seed = seed
+        # a shared executor is left running on close
+        self.owns_executor = executor is None
+        self.executor = executor if executor is not None else ThreadPoolExecutor(max_workers=num_workers)
+        self.buffer = deque()
+        self.batch_index = 0
+        self.closed = False
+
+    def rng(self, batch_index:int) -> np.random.Generator:
+        if self.seed is None:
+            return np.random.default_rng()
+        return np.random.default_rng([self.seed, batch_index])
+
+    def _submit(self):
+        kwargs = self.kwargs_fn(self.rng(self.batch_index), self.batch_index)
+        self.batch_index += 1
+        self.buffer.append((kwargs, self.executor.submit(self.sample_fn, **kwargs)))
+
+    def _fill(self):
+        while len(self.buffer) < self.buffer_size:
+            self._submit()
+
+    def _pop(self) -> Tuple[Dict[str, Any], Future]:
+        assert not self.closed, 'loader is closed'
+        self._fill()
+        kwargs, future = self.buffer.popleft()
+        # refill right away so the next batch is prepared while this one is consumed
+        self._fill()
+        return kwargs, future
+
+    def __iter__(self):
+        return self
+
+    def __next__(self) -> Tuple[Dict[str, Any], Any]:
+        kwargs, future = self._pop()
+        return kwargs, future.result()
+
+    async def async_next(self) -> Tuple[Dict[str, Any], Any]:
+        kwargs, future = self._pop()
+        return kwargs, await asyncio.wrap_future(future)
+
+    def close(self):
+        self.closed = True
+        for kwargs, future in self.buffer:
+            future.cancel()
+        self.buffer.clear()
+        if self.owns_executor:
+            self.executor.shutdown(wait=False)
+
+    def __del__(self):
+        if not getattr(self, 'closed', True):
+            self.close()
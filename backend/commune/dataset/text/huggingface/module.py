@@ -1,3 +1,5 @@
+import os
+import threading
 import streamlit as st
 from random import shuffle, seed
 from collections import defaultdict
@@ -23,6 +25,9 @@ from torch import nn
 from commune.ray.actor_pool import ActorPool
 import bittensor
 import datasets
+from commune.dataset.text.huggingface.token_store import TokenStore
+from commune.dataset.prefetch import PrefetchLoader
+from commune.utils.tokenizer import TokenizerCache
 
 class DatasetModule(Module):
     def __init__(self,
@@ -33,12 +38,21 @@ class DatasetModule(Module):
                 config: dict=None, 
                 **kwargs):
         Module.__init__(self, config=config, **kwargs)
+        # the prefetch workers touch the token store first, only one of them may build it
+        self.token_store_lock = threading.RLock()
         self.load_tokenizer(tokenizer=tokenizer)
         self.load_dataset(path=path, name=name, split=split)
 
     def load_tokenizer(self, tokenizer=None): 
         tokenizer = tokenizer if tokenizer else self.config['tokenizer']
         self.tokenizer = self.launch_module(**tokenizer)
+        cache_config = self.config.get('tokenizer_cache', {})
+        self.tokenizer_cache = TokenizerCache(self.tokenizer, **cache_config)
+        # the cache swaps in the fast tokenizer when there is one
+        self.tokenizer = self.tokenizer_cache.tokenizer
+        self.tokenizer_hash = TokenStore.tokenizer_hash(self.tokenizer)
+        # the token store holds the ids of the previous tokenizer
+        self._token_store = None
         return self.tokenizer
 
     def load_dataset(self, path:str=None, name:str=None, split:str=None):
@@ -48,6 +62,8 @@ class DatasetModule(Module):
         kwargs['split'] = split if split  else self.split
 
         self.dataset = self.launch_module(module='datasets.load_dataset', kwargs=kwargs)
+        # the token store belongs to the loaded split
+        self._token_store = None
         return self.dataset
 
     def filter_dataset(self, fn, dataset=None):
@@ -87,7 +103,7 @@ class DatasetModule(Module):
 
     def tokenize(self, text, padding=True, *args, **kwargs):
         device = kwargs.pop('device', self.device)
-        return torch.tensor(self.tokenizer(text=text, padding=padding)['input_ids']).to(device)
+        return torch.tensor(self.tokenizer_cache(text, padding=padding)['input_ids']).to(device)
 
     @property
     def splits(self):
@@ -142,8 +158,47 @@ class DatasetModule(Module):
         final_sample = ' '.join(final_sample.split()[:sequence_length])
         return final_sample
 
-    def sample(self, batch_size=10, sequence_length=16, random=True, idx_list = None, tokenize=False, padding=True)->dict:
+    def token_store_path(self) -> str:
+        # one store per split, text field and tokenizer
+        return os.path.join(self.tmp_dir, 'token_store', f'{self.path}-{self.config_name}-{self.split}-{self.text_field}-{self.tokenizer_hash[:16]}')
+
+    def load_token_store(self, refresh:bool=False) -> TokenStore:
+        '''
+        Loads the pre-tokenized store of the loaded split, tokenizing the split first if there is none
+        or if it was built from another text field or tokenizer.
+        '''
+        with self.token_store_lock:
+            path = self.token_store_path()
+            if not refresh and TokenStore.exists(path):
+                refresh = not TokenStore(path=path).matches(text_field=self.text_field, tokenizer_hash=self.tokenizer_hash)
+            if refresh or not TokenStore.exists(path):
+                self._token_store = TokenStore.build(dataset=self.dataset, text_field=self.text_field, tokenizer=self.tokenizer,
+                                                     path=path, batch_size=self.config.get('token_store_batch_size', 1000))
+            else:
+                self._token_store = TokenStore(path=path)
+            return self._token_store
+
+    @property
+    def token_store(self) -> TokenStore:
+        if getattr(self, '_token_store', None) is None:
+            with self.token_store_lock:
+                # another worker may have loaded it while this one waited
+                if self._token_store is None:
+                    self.load_token_store()
+        return self._token_store
+
+    def sample(self, batch_size=10, sequence_length=16, random=True, idx_list = None, tokenize=False, padding=True, split=None, return_text=True)->dict:
         
+        if tokenize and self.config.get('pretokenized', True):
+            # windows of sequence_length tokens sliced from the token store, no padding needed
+            assert split in [None, self.split], f'{split} is not the loaded split {self.split}'
+            if idx_list == None:
+                idx_list = [self.resolve_idx(idx=None) for i in range(batch_size)]
+            sample_dict = {'input_ids': self.token_store.sample(idx_list=idx_list, sequence_length=sequence_length)}
+            if return_text:
+                sample_dict['text'] = self.tokenizer.batch_decode(sample_dict['input_ids'])
+            return sample_dict
+
         if idx_list == None:
             idx_list = [None for i in range(batch_size)]
 
@@ -151,10 +206,19 @@ class DatasetModule(Module):
 
         sample_dict = {'text': samples}
         if tokenize:
-            sample_dict['input_ids'] = self.tokenizer(sample_dict['text'], padding=padding,  max_length=sequence_length, truncation=True, return_tensors='pt')['input_ids']
+            sample_dict['input_ids'] = self.tokenizer_cache(sample_dict['text'], padding=padding,  max_length=sequence_length, truncation=True, return_tensors='pt')['input_ids']
             
         return sample_dict
     
+    def prefetch(self, batch_size=10, sequence_length=16, buffer_size=4, num_workers=2, seed=None, **kwargs) -> PrefetchLoader:
+        '''
+        Background loader over sample, drawing the indices of each batch from a seeded rng.
+        '''
+        def kwargs_fn(rng, batch_index):
+            idx_list = rng.integers(1, len(self), size=batch_size).tolist()
+            return dict(batch_size=batch_size, sequence_length=sequence_length, idx_list=idx_list, **kwargs)
+        return PrefetchLoader(sample_fn=self.sample, kwargs_fn=kwargs_fn, buffer_size=buffer_size, num_workers=num_workers, seed=seed)
+
     def resolve_device(self, device=None):
         if device == None:
             device = self.device
@@ -317,6 +381,7 @@ class DatasetModule(Module):
     @text_field.setter
     def text_field(self, value):
         self.config['text_field'] = value
+        self._token_store = None
 
     @property
     def config_name(self):
@@ -0,0 +1,113 @@
+import os
+import json
+import hashlib
+import numpy as np
+import torch
+from typing import List
+
+
+class TokenStore:
+    '''
+    A dataset split tokenized once into a flat memory-mapped token array.
+
+    Rows are tokenized in batches and concatenated with a separator (the tokenized newline, which
+    is how __getitem__ joins rows), offsets[i] is where row i starts in the flat array.
+    A window of sequence_length tokens starting at row i is a slice of the memmap, so sampling
+    does no string handling or tokenization at all.
+
+    Files under path:
+        tokens.bin   flat token ids (uint16 when the vocab fits, int32 otherwise)
+        offsets.npy  row start offsets, num_rows + 1 entries
+        meta.json    dtype, sizes and the build arguments (text_field, tokenizer_hash)
+    '''
+
+    def __init__(self, path:str):
+        self.path = path
+        with open(os.path.join(path, 'meta.json')) as f:
+            self.meta = json.load(f)
+        self.tokens = np.memmap(os.path.join(path, 'tokens.bin'), dtype=self.meta['dtype'], mode='r', shape=(self.meta['num_tokens'],))
+        self.offsets = np.load(os.path.join(path, 'offsets.npy'), mmap_mode='r')
+
+    @staticmethod
+    def exists(path:str) -> bool:
+        return all(os.path.exists(os.path.join(path, f)) for f in ['tokens.bin', 'offsets.npy', 'meta.json'])
+
+    @staticmethod
+    def tokenizer_hash(tokenizer:'tokenizer') -> str:
+        '''
+        Fingerprint of the tokenizer's vocab (added tokens included), stores built with another tokenizer hold other ids.
+        '''
+        vocab = sorted(tokenizer.get_vocab().items(), key=lambda item: item[1])
+        return hashlib.sha1(json.dumps([type(tokenizer).__name__, vocab]).encode()).hexdigest()
+
+    def matches(self, text_field:str, tokenizer_hash:str) -> bool:
+        '''
+        Whether the store was built from text_field with the tokenizer of tokenizer_hash.
+        '''
+        return self.meta.get('text_field') == text_field and self.meta.get('tokenizer_hash') == tokenizer_hash
+
+    @classmethod
+    def build(cls, dataset:'datasets.Dataset', text_field:str, tokenizer:'tokenizer', path:str, batch_size:int=1000) -> 'TokenStore':
+        '''
+        Tokenizes every row of the dataset and writes the store to path.
+        '''
+        os.makedirs(path, exist_ok=True)
+        vocab_size = len(tokenizer)
+        dtype = np.uint16 if vocab_size <= np.iinfo(np.uint16).max + 1 else np.int32
+        separator = np.asarray(tokenizer('\n')['input_ids'], dtype=dtype)
+
+        num_rows = len(dataset)
+        offsets = np.zeros(num_rows + 1, dtype=np.int64)
+        num_tokens = 0
+        # write to a temporary file so a crashed build is never loaded
+        tokens_tmp_path = os.path.join(path, 'tokens.bin.tmp')
+        with open(tokens_tmp_path, 'wb') as f:
+            for start in range(0, num_rows, batch_size):
+                texts = dataset[start:start + batch_size][text_field]
+                assert None not in texts, f'Please specify a valid text_field {text_field}'
+                input_ids = tokenizer(texts)['input_ids']
+                chunk = []
+                for i, ids in enumerate(input_ids):
+                    offsets[start + i] = num_tokens
+                    ids = np.asarray(ids, dtype=dtype)
+                    chunk += [ids, separator]
+                    num_tokens += len(ids) + len(separator)
+                np.concatenate(chunk).tofile(f)
+        offsets[num_rows] = num_tokens
+
+        np.save(os.path.join(path, 'offsets.npy'), offsets)
+        with open(os.path.join(path, 'meta.json'), 'w') as f:
+            json.dump(dict(dtype=np.dtype(dtype).name, num_tokens=int(num_tokens), num_rows=num_rows,
+                           vocab_size=vocab_size, text_field=text_field, tokenizer_hash=cls.tokenizer_hash(tokenizer)), f)
+        os.replace(tokens_tmp_path, os.path.join(path, 'tokens.bin'))
+        return cls(path=path)
+
+    @property
+    def num_rows(self) -> int:
+        return self.meta['num_rows']
+
+    @property
+    def num_tokens(self) -> int:
+        return self.meta['num_tokens']
+
+    def __len__(self) -> int:
+        return self.num_rows
+
+    def window(self, idx:int, sequence_length:int) -> np.ndarray:
+        '''
+        The sequence_length tokens starting at row idx, as a view of the memmap.
+        Windows that run past the end wrap around to the start, which needs a copy.
+        '''
+        start = int(self.offsets[idx])
+        end = start + sequence_length
+        if end <= self.num_tokens:
+            return self.tokens[start:end]
+        return np.concatenate([self.tokens[start:], self.tokens[:end - self.num_tokens]])
+
+    def sample(self, idx_list:List[int], sequence_length:int) -> torch.Tensor:
+        '''
+        Gathers the windows of a batch in one vectorized read, returns (batch_size, sequence_length) int64 ids.
+        '''
+        starts = self.offsets[np.asarray(idx_list, dtype=np.int64)]
+        positions = (starts[:, None] + np.arange(sequence_length)[None, :]) % self.num_tokens
+        return torch.from_numpy(self.tokens[positions].astype(np.int64))
@@ -1,2 +1,4 @@
 from .receptor_pool import ReceptorPool as receptor_pool
-from .receptor import Receptor as receptor
\ No newline at end of file
+from .receptor import Receptor as receptor
+from .sampler import EndpointSampler, UniformEndpointSampler, ScoredEndpointSampler, resolve_endpoint_sampler, resolve_stake_weight
+from .rpc_recorder import RPCRecorder, rpc_recorder
@@ -35,6 +35,7 @@ from types import SimpleNamespace
 from typing import Tuple, List, Union
 from loguru import logger
 from grpc import _common
+from .rpc_recorder import RPCRecorder, rpc_recorder
 
 
 
@@ -47,6 +48,7 @@ class Receptor(nn.Module):
             channel: 'grpc._Channel',
             stub: 'bittensor.grpc.BittensorStub',
             max_processes: int,
+            recorder: 'RPCRecorder' = None,
         ):
         r""" Initializes a receptor grpc connection.
 
@@ -59,6 +61,8 @@ class Receptor(nn.Module):
                     grpc TCP channel.
                 endpoint (:obj:`bittensor.grpc.BittensorStub`, `required`):
                     bittensor protocol stub created from channel.
+                recorder (:obj:`RPCRecorder`, `optional`):
+                    buffered rpc event recorder, defaults to the shared rpc_recorder.
         """
         super().__init__()
         self.wallet = wallet # Keypair information
@@ -67,6 +71,7 @@ class Receptor(nn.Module):
         self.stub = stub
         self.receptor_uid = str(uuid.uuid1())
         self.semaphore = threading.Semaphore(max_processes)
+        self.recorder = recorder if recorder != None else rpc_recorder
         self.state_dict = _common.CYGRPC_CONNECTIVITY_STATE_TO_CHANNEL_CONNECTIVITY
         self.stats = SimpleNamespace(
             forward_qps = stat_utils.timed_rolling_avg(0.0, 0.01),
@@ -105,6 +110,61 @@ class Receptor(nn.Module):
             }
         )
 
+    @classmethod
+    def from_endpoint (
+            cls,
+            endpoint: 'bittensor.Endpoint',
+            wallet: 'bittensor.wallet',
+            external_ip: str = None,
+            max_processes: int = 1,
+            compression: str = None,
+            recorder: 'RPCRecorder' = None,
+        ) -> 'Receptor':
+        r""" Opens a grpc channel to the endpoint and wraps it in a receptor, like bittensor.receptor does.
+
+            Args:
+                endpoint (:obj:`bittensor.Endpoint`, `required`):
+                    neuron endpoint descriptor proto.
+                wallet (:obj:`bittensor.Wallet`, `required`):
+                    bittensor wallet with hotkey and coldkeypub.
+                external_ip (:obj:`str`, `optional`):
+                    our external ip, endpoints served from it are reached through localhost.
+                max_processes (:obj:`int`, `optional`):
+                    max number of concurrent calls.
+                compression (:obj:`str`, `optional`):
+                    grpc compression algorithm, one of gzip, deflate or None.
+                recorder (:obj:`RPCRecorder`, `optional`):
+                    buffered rpc event recorder, defaults to the shared rpc_recorder.
+        """
+        if endpoint.ip == external_ip:
+            endpoint_str = "localhost:" + str(endpoint.port)
+        else:
+            endpoint_str = endpoint.ip + ':' + str(endpoint.port)
+
+        if compression == 'gzip':
+            compress_alg = grpc.Compression.Gzip
+        elif compression == 'deflate':
+            compress_alg = grpc.Compression.Deflate
+        else:
+            compress_alg = grpc.Compression.NoCompression
+
+        channel = grpc.aio.insecure_channel(
+            endpoint_str,
+            options=[('grpc.max_send_message_length', -1),
+                     ('grpc.max_receive_message_length', -1),
+                     ('grpc.keepalive_time_ms', 100000)],
+            compression = compress_alg
+        )
+        stub = bittensor.grpc.BittensorStub( channel )
+        return cls(
+            wallet = wallet,
+            endpoint = endpoint,
+            channel = channel,
+            stub = stub,
+            max_processes = max_processes,
+            recorder = recorder
+        )
+
     def __str__ ( self ):
         return "Receptor({})".format(self.endpoint) 
 
@@ -233,6 +293,7 @@ class Receptor(nn.Module):
         synapses: List[ 'bittensor.Synapse' ],
         inputs: torch.Tensor, 
         timeout: int,
+        grpc_request: 'bittensor.proto.TensorMessage' = None,
     ) -> Tuple[ List[ torch.FloatTensor ], List['bittensor.proto.ReturnCode'], List[float] ]:
         r""" Triggers the grpc call to the remote endpoint.
             This triggers the synapse calls with arguments.
@@ -249,6 +310,10 @@ class Receptor(nn.Module):
 
                 timeout (:obj:`int`, `required`):
                     Request max timeout
+
+                grpc_request (:obj:`bittensor.proto.TensorMessage`, `optional`):
+                    Request already serialized from (synapses, inputs) with build_forward_request, shared
+                    between receptors. Only the signed metadata is created per call.
             Returns:
                 outputs (:obj:`List[ Union[torch.FloatTensor, torch.LongTensor] ]`, `required`):
                     outputs.shape = [batch_size, synapse_length, response] 
@@ -291,19 +356,19 @@ class Receptor(nn.Module):
             self.stats.forward_elapsed_time.update( clock.time() - start_time )
             for index, synapse in enumerate( synapses ):
                 self.stats.codes[ synapse_codes[ index ] ] += 1
-                bittensor.logging.rpc_log ( 
-                    axon = False, 
-                    forward = True, 
-                    is_response = synapse_is_response [index], 
-                    code = synapse_codes[ index ], 
-                    call_time = synapse_call_times[ index ], 
-                    pubkey = self.endpoint.hotkey, 
-                    uid = self.endpoint.uid, 
-                    inputs = list(inputs.shape), 
-                    outputs = None if synapse_codes[ index ] != bittensor.proto.ReturnCode.Success else list( synapse_responses[index].shape ), 
-                    message = synapse_messages[ index ],
-                    synapse = synapse.synapse_type
-                )
+                if self.recorder.enabled:
+                    self.recorder.record ( 
+                        forward = True, 
+                        is_response = synapse_is_response [index], 
+                        code = synapse_codes[ index ], 
+                        call_time = synapse_call_times[ index ], 
+                        pubkey = self.endpoint.hotkey, 
+                        uid = self.endpoint.uid, 
+                        inputs_shape = inputs.shape, 
+                        outputs_shape = None if synapse_codes[ index ] != bittensor.proto.ReturnCode.Success else synapse_responses[index].shape, 
+                        message = synapse_messages[ index ],
+                        synapse_type = synapse.synapse_type
+                    )
 
         # ===========================
         # ==== Check inputs size ====
@@ -333,46 +398,15 @@ class Receptor(nn.Module):
             finalize_stats_and_logs()
             return synapse_responses, synapse_codes, synapse_call_times
 
-        # ==========================
-        # ==== Serialize inputs ====
-        # ==========================
-        serialized_forward_tensors = []
-        serialized_synapses = []
-        for index, synapse in enumerate( synapses ):
-            try:
-                serialized_forward_tensors.append( synapse.serialize_forward_request_tensor ( inputs ))
-                serialized_synapses.append(synapse.serialize_to_wire_proto())
-            except Exception as e:
-                synapse_codes [index] = bittensor.proto.ReturnCode.RequestSerializationException
-                synapse_call_times [index] = clock.time() - start_time
-                synapse_messages [index] = 'Input serialization exception with error:{}'.format(str(e))
-        # Check if the call can stop here.
-        if check_if_should_return():
-            finalize_stats_and_logs()
-            return synapse_responses, synapse_codes, synapse_call_times
-            
-        # ============================
-        # ==== Build proto request ====
-        # ============================
-        try: 
-            grpc_request = bittensor.proto.TensorMessage (
-                version = bittensor.__version_as_int__,
-                hotkey = self.wallet.hotkey.ss58_address,
-                tensors = serialized_forward_tensors,
-                synapses = serialized_synapses,
-                requires_grad = True,
-            )
-        except Exception as e:
-            # Synapse request creation failed.
-            code = bittensor.proto.ReturnCode.UnknownException
-            call_time = clock.time() - start_time
-            message = 'Request proto creation failed with error:{}'.format(str(e)) 
-            synapse_codes = [code for _ in synapses ]
-            synapse_call_times = [call_time for _ in synapses ]
-            synapse_messages = [ message for _ in synapses ]
-            finalize_stats_and_logs()
-            return synapse_responses, synapse_codes, synapse_call_times
-
+        # ==========================================
+        # ==== Serialize inputs and build proto ====
+        # ==========================================
+        if grpc_request == None:
+            grpc_request, synapse_codes, synapse_messages = self.build_forward_request( synapses = synapses, inputs = inputs, wallet = self.wallet )
+            if grpc_request == None:
+                synapse_call_times = [ clock.time() - start_time for _ in synapses ]
+                finalize_stats_and_logs()
+                return synapse_responses, synapse_codes, synapse_call_times
 
         # ===============================
         # ==== Fire Asyncio RPC Call ====
@@ -380,7 +414,6 @@ class Receptor(nn.Module):
         try:
             self.stats.forward_qps.update(1)
             self.stats.forward_bytes_out.update( sys.getsizeof( grpc_request ) )
-            finalize_stats_and_logs()
             asyncio_future = self.stub.Forward (
                 request = grpc_request, 
                 timeout = timeout,
@@ -511,6 +544,66 @@ class Receptor(nn.Module):
         finalize_stats_and_logs()
         return synapse_responses, synapse_codes, synapse_call_times  
 
+    @staticmethod
+    def build_forward_request (
+        synapses: List[ 'bittensor.Synapse' ],
+        inputs: torch.Tensor,
+        wallet: 'bittensor.wallet',
+    ) -> Tuple[ 'bittensor.proto.TensorMessage', List['bittensor.proto.ReturnCode'], List[str] ]:
+        r""" Serializes the inputs and synapses into a forward request proto.
+            The proto does not depend on the endpoint, so one request can be sent to many receptors.
+
+            Args:
+                synapses (:obj:`List[ 'bittensor.Synapse' ]` of shape :obj:`(num_synapses)`, `required`):
+                    Bittensor synapse objects with arguments.
+
+                inputs (:obj:`torch.Tensor` of shape :obj:`(shape)`, `required`):
+                    Single torch tensor to be sent to the remote endpoints.
+
+                wallet (:obj:`bittensor.wallet`, `required`):
+                    Wallet whose hotkey is written into the request.
+            Returns:
+                grpc_request (:obj:`bittensor.proto.TensorMessage`):
+                    The request proto or None if serialization failed for every synapse.
+
+                codes (:obj:`bittensor.proto.ReturnCode`, `required`):
+                    Serialization return code per synapse.
+
+                messages (:obj:`List[str]`, `required`):
+                    Serialization message per synapse.
+        """
+        synapse_codes = [ bittensor.proto.ReturnCode.Success for _ in synapses ]
+        synapse_messages = [ "Success" for _ in synapses ]
+        serialized_forward_tensors = []
+        serialized_synapses = []
+        for index, synapse in enumerate( synapses ):
+            try:
+                serialized_forward_tensors.append( synapse.serialize_forward_request_tensor ( inputs ))
+                serialized_synapses.append(synapse.serialize_to_wire_proto())
+            except Exception as e:
+                synapse_codes [index] = bittensor.proto.ReturnCode.RequestSerializationException
+                synapse_messages [index] = 'Input serialization exception with error:{}'.format(str(e))
+        # Check if the call can stop here.
+        if all( code != bittensor.proto.ReturnCode.Success for code in synapse_codes ):
+            return None, synapse_codes, synapse_messages
+
+        try: 
+            grpc_request = bittensor.proto.TensorMessage (
+                version = bittensor.__version_as_int__,
+                hotkey = wallet.hotkey.ss58_address,
+                tensors = serialized_forward_tensors,
+                synapses = serialized_synapses,
+                requires_grad = True,
+            )
+        except Exception as e:
+            # Synapse request creation failed.
+            message = 'Request proto creation failed with error:{}'.format(str(e)) 
+            synapse_codes = [ bittensor.proto.ReturnCode.UnknownException for _ in synapses ]
+            synapse_messages = [ message for _ in synapses ]
+            return None, synapse_codes, synapse_messages
+
+        return grpc_request, synapse_codes, synapse_messages
+
     async def async_backward (
         self, 
         synapses: List[ 'bittensor.Synapse' ],
@@ -577,19 +670,19 @@ class Receptor(nn.Module):
         def finalize_stats_and_logs():
             for index, synapse in enumerate( synapses ):
                 self.stats.codes[ synapse_codes[ index ] ] += 1
-                bittensor.logging.rpc_log ( 
-                    axon = False, 
-                    forward = False, 
-                    is_response = synapse_is_response [index], 
-                    code = synapse_codes[ index ], 
-                    call_time = synapse_call_times[ index ], 
-                    pubkey = self.endpoint.hotkey, 
-                    uid = self.endpoint.uid, 
-                    inputs = list(grads[index].shape), 
-                    outputs = None, 
-                    message = synapse_messages[ index ],
-                    synapse = synapse.synapse_type
-                )
+                if self.recorder.enabled:
+                    self.recorder.record ( 
+                        forward = False, 
+                        is_response = synapse_is_response [index], 
+                        code = synapse_codes[ index ], 
+                        call_time = synapse_call_times[ index ], 
+                        pubkey = self.endpoint.hotkey, 
+                        uid = self.endpoint.uid, 
+                        inputs_shape = grads[index].shape, 
+                        outputs_shape = None, 
+                        message = synapse_messages[ index ],
+                        synapse_type = synapse.synapse_type
+                    )
 
         # ========================
         # ==== Check endpoint ====
@@ -0,0 +1,232 @@
+""" Bounded cache of receptors with heap ordered eviction.
+"""
+# The MIT License (MIT)
+# Copyright © 2021 Yuma Rao
+
+# Permission is hereby granted, free of charge, to any person obtaining a copy of this software and associated
+# documentation files (the “Software”), to deal in the Software without restriction, including without limitation
+# the rights to use, copy, modify, merge, publish, distribute, sublicense, and/or sell copies of the Software,
+# and to permit persons to whom the Software is furnished to do so, subject to the following conditions:
+
+# The above copyright notice and this permission notice shall be included in all copies or substantial portions of
+# the Software.
+
+# THE SOFTWARE IS PROVIDED “AS IS”, WITHOUT WARRANTY OF ANY KIND, EXPRESS OR IMPLIED, INCLUDING BUT NOT LIMITED TO
+# THE WARRANTIES OF MERCHANTABILITY, FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL
+# THE AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER LIABILITY, WHETHER IN AN ACTION
+# OF CONTRACT, TORT OR OTHERWISE, ARISING FROM, OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER
+# DEALINGS IN THE SOFTWARE.
+
+import heapq
+import asyncio
+import itertools
+import time as clock
+from threading import Lock
+from typing import Dict, List
+
+try:
+    from prometheus_client import Gauge
+except ImportError:
+    Gauge = None
+
+_gauges = None
+_gauges_mutex = Lock()
+# names the caches which were not given one, so every pool keeps its own gauge labels
+_cache_ids = itertools.count()
+
+def receptor_pool_gauges() -> 'Gauge':
+    r""" Returns the process wide receptor pool gauge, registered once in the default prometheus registry
+        so it is served by bittensor.prometheus alongside the other metrics. None without prometheus_client.
+    """
+    global _gauges
+    with _gauges_mutex:
+        if _gauges == None and Gauge != None:
+            _gauges = Gauge( 'receptor_pool_gauges', 'Gauge summaries for the receptor pool.', ['receptor_pool', 'receptor_pool_gauges_name'] )
+        return _gauges
+
+
+class ReceptorCache:
+    """ Holds at most max_active_receptors receptors keyed by hotkey.
+
+        Every use pushes (last_used + qps_weight * forward_qps, version, hotkey) onto a heap; stale
+        entries are skipped when popped, so touching and evicting are both O(log n). Receptors with
+        calls in flight are never evicted. Evicted channels are closed on the running event loop
+        instead of blocking the caller.
+    """
+
+    def __init__( self, max_active_receptors: int = 1000, qps_weight: float = 1.0, name: str = None ):
+        r""" Initializes the cache.
+            Args:
+                max_active_receptors (int):
+                    Maximum number of open receptors. 0 or less disables eviction.
+                qps_weight (float):
+                    Seconds of recency credit given per unit of forward qps, so busy receptors outlive idle ones.
+                name (str):
+                    Value of the receptor_pool label of the gauges, defaults to receptor_pool_<n>.
+        """
+        self.max_active_receptors = max_active_receptors
+        self.qps_weight = qps_weight
+        self.name = name if name != None else 'receptor_pool_{}'.format( next( _cache_ids ) )
+        self.receptors = {}
+        self.in_flight = {}
+        self.versions = {}
+        self.heap = []
+        self.mutex = Lock()
+        self.closing_tasks = set()
+        self.stats = dict( created = 0, evicted = 0, closed = 0 )
+        self.gauges = receptor_pool_gauges()
+
+    def __len__( self ):
+        return len(self.receptors)
+
+    def __contains__( self, hotkey: str ):
+        return hotkey in self.receptors
+
+    def __getitem__( self, hotkey: str ) -> 'bittensor.Receptor':
+        return self.receptors[hotkey]
+
+    def __setitem__( self, hotkey: str, receptor: 'bittensor.Receptor' ):
+        self.put( hotkey, receptor )
+
+    def __iter__( self ):
+        return iter(self.receptors)
+
+    def items( self ):
+        return self.receptors.items()
+
+    def values( self ):
+        return self.receptors.values()
+
+    def keys( self ):
+        return self.receptors.keys()
+
+    def _priority( self, receptor: 'bittensor.Receptor' ) -> float:
+        try:
+            qps = receptor.stats.forward_qps.value
+        except AttributeError:
+            qps = 0.0
+        return clock.time() + self.qps_weight * qps
+
+    def _push( self, hotkey: str ):
+        version = self.versions.get(hotkey, 0) + 1
+        self.versions[hotkey] = version
+        heapq.heappush( self.heap, ( self._priority( self.receptors[hotkey] ), version, hotkey ) )
+        # Compact once stale entries dominate the heap.
+        if len(self.heap) > 2 * len(self.receptors) + 64:
+            self.heap = [ entry for entry in self.heap if self.versions.get(entry[2]) == entry[1] ]
+            heapq.heapify(self.heap)
+
+    def put( self, hotkey: str, receptor: 'bittensor.Receptor' ):
+        r""" Adds or replaces the receptor for this hotkey. A replaced receptor is closed.
+        """
+        with self.mutex:
+            previous = self.receptors.get(hotkey)
+            self.receptors[hotkey] = receptor
+            self.in_flight.setdefault(hotkey, 0)
+            self.stats['created'] += 1
+            self._push(hotkey)
+        if previous != None and previous is not receptor:
+            self.close_receptor( previous )
+        self.update_gauges()
+
+    def get( self, hotkey: str, default = None ) -> 'bittensor.Receptor':
+        return self.receptors.get(hotkey, default)
+
+    def acquire( self, hotkey: str ):
+        r""" Marks a call as in flight on the receptor and refreshes its recency.
+        """
+        with self.mutex:
+            if hotkey in self.receptors:
+                self.in_flight[hotkey] = self.in_flight.get(hotkey, 0) + 1
+                self._push(hotkey)
+
+    def release( self, hotkey: str ):
+        r""" Marks an in flight call on the receptor as finished.
+        """
+        with self.mutex:
+            if self.in_flight.get(hotkey, 0) > 0:
+                self.in_flight[hotkey] -= 1
+
+    def evict( self ) -> List['bittensor.Receptor']:
+        r""" Removes idle receptors, least recently used (with qps credit) first, until at most max_active_receptors remain.
+            Returns:
+                evicted (:obj:`List[bittensor.Receptor]`):
+                    The removed receptors. Their channels are being closed.
+        """
+        evicted = []
+        busy = []
+        with self.mutex:
+            if self.max_active_receptors <= 0:
+                return evicted
+            while len(self.receptors) > self.max_active_receptors and len(self.heap) > 0:
+                entry = heapq.heappop(self.heap)
+                priority, version, hotkey = entry
+                if self.versions.get(hotkey) != version:
+                    continue
+                if self.in_flight.get(hotkey, 0) > 0:
+                    busy.append(entry)
+                    continue
+                evicted.append( self.receptors.pop(hotkey) )
+                self.in_flight.pop(hotkey, None)
+                self.versions.pop(hotkey, None)
+            for entry in busy:
+                heapq.heappush(self.heap, entry)
+            self.stats['evicted'] += len(evicted)
+
+        for receptor in evicted:
+            self.close_receptor( receptor )
+        self.update_gauges()
+        return evicted
+
+    def close_receptor( self, receptor: 'bittensor.Receptor' ):
+        r""" Closes the receptor channel without blocking the running event loop.
+        """
+        try:
+            loop = asyncio.get_running_loop()
+        except RuntimeError:
+            loop = None
+
+        if loop != None:
+            task = loop.create_task( self._async_close_receptor( receptor ) )
+            self.closing_tasks.add(task)
+            task.add_done_callback( self.closing_tasks.discard )
+        else:
+            receptor.close()
+            self.stats['closed'] += 1
+
+    async def _async_close_receptor( self, receptor: 'bittensor.Receptor' ):
+        try:
+            await receptor.channel.close()
+        except Exception:
+            pass
+        self.stats['closed'] += 1
+        self.update_gauges()
+
+    def clear( self ):
+        r""" Closes and removes every receptor.
+        """
+        with self.mutex:
+            receptors = list(self.receptors.values())
+            self.receptors, self.in_flight, self.versions, self.heap = {}, {}, {}, []
+        for receptor in receptors:
+            self.close_receptor( receptor )
+        self.update_gauges()
+
+    def gauge_values( self ) -> Dict[str, int]:
+        r""" Returns the current gauge values.
+        """
+        return dict(
+            open_receptors = len(self.receptors),
+            max_active_receptors = self.max_active_receptors,
+            busy_receptors = sum( 1 for v in self.in_flight.values() if v > 0 ),
+            closing_receptors = len(self.closing_tasks),
+            created_receptors = self.stats['created'],
+            evicted_receptors = self.stats['evicted'],
+            closed_receptors = self.stats['closed'],
+        )
+
+    def update_gauges( self ):
+        if self.gauges == None:
+            return
+        for name, value in self.gauge_values().items():
+            self.gauges.labels( self.name, name ).set( value )
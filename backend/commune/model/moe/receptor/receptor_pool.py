@@ -18,8 +18,11 @@
 # DEALINGS IN THE SOFTWARE.
 
 import math
-from typing import Tuple, List, Union
-from threading import Lock
+import functools
+import time as clock
+from collections import deque
+from typing import Callable, Tuple, List, Union
+import numpy as np
 import streamlit as st
 import torch
 import asyncio
@@ -30,6 +33,10 @@ from bittensor._endpoint import endpoint
 import bittensor.utils.networking as net
 from concurrent.futures import ThreadPoolExecutor
 import commune
+from .sampler import EndpointSampler, resolve_endpoint_sampler
+from .receptor_cache import ReceptorCache
+from .receptor import Receptor
+from .rpc_recorder import RPCRecorder, rpc_recorder
 
 logger = logger.opt(colors=True)
 
@@ -42,15 +49,20 @@ class ReceptorPool ( torch.nn.Module):
         wallet: 'bittensor.Wallet',
         max_active_receptors: int = 1000,
         compression: str = None,
+        endpoint_sampler: Union[str, dict, EndpointSampler] = 'scored',
+        rpc_logging: Union[bool, dict, RPCRecorder] = True,
+        name: str = None,
     ):
         super().__init__()
         self.wallet = wallet
         self.max_active_receptors = max_active_receptors
-        self.receptors = {}
-        self.cull_mutex = Lock()
+        self.receptors = ReceptorCache( max_active_receptors = max_active_receptors, name = name )
         self.max_processes = 10
         self.compression = compression
         self.total_requests = 0
+        self.latency_history = deque(maxlen=1000)
+        self.endpoint_sampler = resolve_endpoint_sampler(endpoint_sampler)
+        self.recorder = self.resolve_recorder(rpc_logging)
 
         try:
             self.external_ip = str(net.get_external_ip())
@@ -66,8 +78,22 @@ class ReceptorPool ( torch.nn.Module):
         return self.__str__()
     
     def __exit__(self):
-        for receptor in self.receptors:
-            receptor.__del__()
+        self.receptors.clear()
+
+    @staticmethod
+    def resolve_recorder(rpc_logging: Union[bool, dict, RPCRecorder] = True) -> RPCRecorder:
+        r""" Returns the rpc recorder shared by this pool's receptors.
+            True uses the process wide rpc_recorder, False a disabled recorder and a dict
+            (enabled, sample_rate, buffer_size, flush_interval) a new recorder.
+        """
+        if isinstance(rpc_logging, RPCRecorder):
+            return rpc_logging
+        elif isinstance(rpc_logging, dict):
+            return RPCRecorder(**rpc_logging)
+        elif rpc_logging:
+            return rpc_recorder
+        else:
+            return RPCRecorder(enabled=False)
 
     def get_total_requests(self):
         return self.total_requests
@@ -200,6 +226,9 @@ class ReceptorPool ( torch.nn.Module):
             inputs: List [ torch.Tensor ],
             timeout: int,
             min_successes: int = 20,
+            soft_timeout: float = None,
+            backup_endpoints: List [ 'bittensor.Endpoint' ] = None,
+            hedge_quantile: float = 0.95,
         ) -> Tuple[List[torch.Tensor], List[int], List[float]]:
         r""" Forward tensor inputs to endpoints.
 
@@ -219,6 +248,18 @@ class ReceptorPool ( torch.nn.Module):
                 timeout (int):
                     Request timeout.
 
+                min_successes (int):
+                    Quorum size, see async_forward_quorum.
+
+                soft_timeout (float):
+                    Soft deadline, see async_forward_quorum.
+
+                backup_endpoints (:obj:`List[ bittensor.Endpoint ]`, `optional`):
+                    Hedge endpoints, see async_forward_quorum.
+
+                hedge_quantile (float):
+                    Latency quantile which triggers hedging, see async_forward_quorum.
+
             Returns:
                 forward_outputs (:obj:`List[ List[ torch.FloatTensor ]]` of shape :obj:`(num_endpoints * (num_synapses * (shape)))`, `required`):
                     Output encodings of tensors produced by remote endpoints. Non-responses are zeroes of common shape.
@@ -229,65 +270,291 @@ class ReceptorPool ( torch.nn.Module):
                 forward_times (:obj:`List[ List [float] ]` of shape :obj:`(num_endpoints * ( num_synapses ))`, `required`):
                     dendrite backward call times
         """
-        # Init receptors.
-        receptors = [ self._get_or_create_receptor_for_endpoint( endpoint ) for endpoint in endpoints ]
+        forward_outputs, forward_codes, forward_times, _ = await self.async_forward_quorum(
+            endpoints = endpoints,
+            synapses = synapses,
+            inputs = inputs,
+            timeout = timeout,
+            min_successes = min_successes,
+            soft_timeout = soft_timeout,
+            backup_endpoints = backup_endpoints,
+            hedge_quantile = hedge_quantile
+        )
+        return forward_outputs, forward_codes, forward_times
 
+    async def async_forward_quorum (
+            self, 
+            endpoints: List [ 'bittensor.Endpoint' ],
+            synapses: List[ 'bittensor.Synapse' ],
+            inputs: List [ torch.Tensor ],
+            timeout: int,
+            min_successes: int = 20,
+            soft_timeout: float = None,
+            backup_endpoints: List [ 'bittensor.Endpoint' ] = None,
+            hedge_quantile: float = 0.95,
+            grpc_request: 'bittensor.proto.TensorMessage' = None,
+            max_concurrent_requests: int = None,
+            stats: dict = None,
+        ) -> Tuple[List[torch.Tensor], List[int], List[float], List['bittensor.Endpoint']]:
+        r""" Forward tensor inputs to endpoints and return as soon as a quorum of successes is reached.
+
+            Stragglers are cancelled (and awaited) once the quorum or the soft deadline is hit. When backup endpoints
+            are passed, requests that are still pending after the hedge_quantile of recently observed latencies
+            are duplicated onto a backup endpoint and whichever copy answers first is kept.
 
+            Args:
+                endpoints (:obj:`List[ bittensor.Endpoint ]` of shape :obj:`(num_endpoints)`, `required`):
+                    List of remote endpoints which match length of inputs.
 
-        loop = asyncio.get_event_loop()
-        # Make calls.
-        running_tasks = []
-        st.write(inputs[0].shape, inputs[0].dtype)
-        for index, receptor in enumerate(receptors):
-            task = asyncio.create_task(
-                receptor.async_forward(
-                    synapses = synapses,
-                    inputs = inputs[index], 
-                    timeout = timeout
-                )
-            )
-            running_tasks.append(task)
+                synapses (:obj:`List[ 'bittensor.Synapse' ]` of shape :obj:`(num_synapses)`, `required`):
+                    Bittensor synapse objects with arguments. Responses are packed in this ordering. 
+
+                inputs (:obj:`List[torch.Tensor]` of shape :obj:`(num_endpoints * [shape])`, `required`):
+                    List of tensors to send to corresponsing endpoints.
+
+                timeout (int):
+                    Request timeout.
+
+                min_successes (int):
+                    Number of successful responses after which the call returns. If 0, every response 
+                    (successful or not) is returned and the call waits for all endpoints.
+
+                soft_timeout (float):
+                    Soft deadline in seconds. Once passed, the call returns with whatever has been collected.
+
+                backup_endpoints (:obj:`List[ bittensor.Endpoint ]`, `optional`):
+                    Endpoints used for hedged duplicate requests. Each backup is used at most once.
+
+                hedge_quantile (float):
+                    Quantile of recent successful latencies after which a pending request is hedged.
+
+                grpc_request (:obj:`bittensor.proto.TensorMessage`, `optional`):
+                    Pre-serialized request shared by every endpoint, see async_broadcast_forward.
+
+                max_concurrent_requests (int, `optional`):
+                    Most requests in flight at once, the others wait for a free slot. Unlimited if None.
+
+                stats (dict, `optional`):
+                    Filled with the traffic of this call alone: requests (calls made, hedges included), request_bytes
+                    (serialized request payloads sent) and response_bytes (response tensor payloads received).
+
+            Returns:
+                forward_outputs (:obj:`List[ List[ torch.FloatTensor ]]`, `required`):
+                    Output encodings of tensors produced by the responding endpoints.
+
+                forward_codes (:obj:`List[ List[bittensor.proto.ReturnCodes] ]`, `required`):
+                    Return codes, one list per responding endpoint.
+
+                forward_times (:obj:`List[ List [float] ]`, `required`):
+                    Call times, one list per responding endpoint.
+
+                forward_endpoints (:obj:`List[ bittensor.Endpoint ]`, `required`):
+                    The endpoint which produced each response, aligned with the outputs.
+        """
+        start_time = clock.time()
+        deadline = start_time + soft_timeout if soft_timeout != None else None
+        backup_endpoints = list(backup_endpoints) if backup_endpoints else []
+        hedge_latency = self.latency_quantile(hedge_quantile) if len(backup_endpoints) > 0 else None
 
+        semaphore = asyncio.Semaphore( max_concurrent_requests ) if max_concurrent_requests else None
+        if stats != None:
+            stats.update( requests = 0, request_bytes = 0, response_bytes = 0 )
+
+        # Make calls.
+        task2meta = {}
+        for index, endpoint in enumerate(endpoints):
+            task = self._create_forward_task( endpoint = endpoint, synapses = synapses, inputs = inputs[index], timeout = timeout, grpc_request = grpc_request, semaphore = semaphore, stats = stats )
+            task2meta[task] = dict(index = index, endpoint = endpoint, hedged = False)
+        running_tasks = set(task2meta.keys())
 
         forward_outputs = []
         forward_codes = []
         forward_times = []
+        forward_endpoints = []
+        answered_indices = set()
+
         while len(running_tasks) > 0:
-            
-            finished_tasks, running_tasks  = await asyncio.wait( running_tasks , return_when=asyncio.FIRST_COMPLETED)
-            finished_tasks, running_tasks = list(finished_tasks), list(running_tasks)
+            now = clock.time()
+            wait_until = deadline
+            if hedge_latency != None and len(backup_endpoints) > 0:
+                hedge_time = start_time + hedge_latency
+                if hedge_time > now:
+                    wait_until = hedge_time if wait_until == None else min(wait_until, hedge_time)
+            wait_timeout = None if wait_until == None else max(wait_until - now, 0)
 
-            # st.write(len(finished_tasks), len(running_tasks))
-            # Unpack responses
-            
+            finished_tasks, running_tasks = await asyncio.wait( running_tasks, timeout = wait_timeout, return_when = asyncio.FIRST_COMPLETED )
 
-            responses = await asyncio.gather(*finished_tasks)
-
-            for response in responses:
-                st.write(response[1])
-                if  min_successes > 0:
-                    if  response[1][0] == 1:
-                        forward_outputs.append( response[0] )
-                        forward_codes.append( response[1] )
-                        forward_times.append( response[2] )
-
-                    if len(forward_outputs) >= min_successes :
-                        # cancel the rest of the tasks
-                        [t.cancel() for t in running_tasks]
-                        running_tasks = [t for t in running_tasks if t.cancelled()]
-                        assert len(running_tasks) == 0, f'{len(running_tasks)}'
+            # Unpack responses
+            for task in finished_tasks:
+                meta = task2meta.pop(task)
+                if task.cancelled():
+                    continue
+                if task.exception() != None:
+                    # the receptor raised instead of returning a code, count it as a failure of the endpoint
+                    self.endpoint_sampler.update( meta['endpoint'].uid, success = False )
+                    continue
+                response = task.result()
+                if stats != None:
+                    stats['response_bytes'] += sum( t.element_size() * t.nelement() for t in response[0] if torch.is_tensor(t) )
+                is_success = response[1][0] == bittensor.proto.ReturnCode.Success
+                self.endpoint_sampler.update( meta['endpoint'].uid, success = is_success, latency = response[2][0] )
+                if is_success:
+                    self.latency_history.append( response[2][0] )
+
+                if meta['index'] in answered_indices:
+                    continue
+                if min_successes > 0 and not is_success:
+                    continue
+                answered_indices.add( meta['index'] )
+                forward_outputs.append( response[0] )
+                forward_codes.append( response[1] )
+                forward_times.append( response[2] )
+                forward_endpoints.append( meta['endpoint'] )
+
+            # Drop duplicates of requests that have already been answered.
+            redundant_tasks = [ t for t in running_tasks if task2meta[t]['index'] in answered_indices ]
+            if len(redundant_tasks) > 0:
+                running_tasks = running_tasks - set(redundant_tasks)
+                await self._cancel_tasks( redundant_tasks )
+                for t in redundant_tasks:
+                    task2meta.pop(t)
+
+            if min_successes > 0 and len(forward_outputs) >= min_successes:
+                break
+            if deadline != None and clock.time() >= deadline:
+                break
+
+            # Hedge requests that have exceeded the latency quantile.
+            if hedge_latency != None and clock.time() - start_time >= hedge_latency:
+                for task in list(running_tasks):
+                    if len(backup_endpoints) == 0:
                         break
-                else:
-                    
-                    forward_outputs.append( response[0] )
-                    forward_codes.append( response[1] )
-                    forward_times.append( response[2] )
-
+                    meta = task2meta[task]
+                    if meta['hedged']:
+                        continue
+                    meta['hedged'] = True
+                    backup_endpoint = backup_endpoints.pop(0)
+                    hedge_task = self._create_forward_task( endpoint = backup_endpoint, synapses = synapses, inputs = inputs[meta['index']], timeout = timeout, grpc_request = grpc_request, semaphore = semaphore, stats = stats )
+                    task2meta[hedge_task] = dict(index = meta['index'], endpoint = backup_endpoint, hedged = True)
+                    running_tasks.add(hedge_task)
+                hedge_latency = None
+
+        # ---- Cancel stragglers ----
+        pending_time = clock.time() - start_time
+        for task in running_tasks:
+            self.endpoint_sampler.update( task2meta[task]['endpoint'].uid, latency = pending_time )
+        await self._cancel_tasks( running_tasks )
 
         # ---- Kill receptors ----
-        # self._destroy_receptors_over_max_allowed()
+        self._destroy_receptors_over_max_allowed()
         # ---- Return ----
-        return forward_outputs, forward_codes, forward_times
+        return forward_outputs, forward_codes, forward_times, forward_endpoints
+
+    async def async_broadcast_forward (
+            self, 
+            endpoints: List [ 'bittensor.Endpoint' ],
+            synapses: List[ 'bittensor.Synapse' ],
+            inputs: torch.Tensor,
+            timeout: int,
+            **kwargs
+        ) -> Tuple[List[torch.Tensor], List[int], List[float], List['bittensor.Endpoint']]:
+        r""" Sends the same inputs to every endpoint, serializing the request once.
+
+            The request tensor and synapse protos are built a single time and the resulting proto is
+            shared by every receptor; each call only signs its own metadata.
+
+            Args:
+                endpoints (:obj:`List[ bittensor.Endpoint ]` of shape :obj:`(num_endpoints)`, `required`):
+                    List of remote endpoints.
+
+                synapses (:obj:`List[ 'bittensor.Synapse' ]` of shape :obj:`(num_synapses)`, `required`):
+                    Bittensor synapse objects with arguments. Responses are packed in this ordering. 
+
+                inputs (:obj:`torch.Tensor` of shape :obj:`(shape)`, `required`):
+                    Single tensor sent to every endpoint.
+
+                timeout (int):
+                    Request timeout.
+
+                kwargs:
+                    Quorum options forwarded to async_forward_quorum (min_successes, soft_timeout, backup_endpoints, hedge_quantile,
+                    max_concurrent_requests, stats).
+
+            Returns:
+                See async_forward_quorum.
+        """
+        grpc_request, codes, _ = Receptor.build_forward_request( synapses = synapses, inputs = inputs, wallet = self.wallet )
+        if any( code != bittensor.proto.ReturnCode.Success for code in codes ):
+            # Let each receptor report its own serialization failure.
+            grpc_request = None
+        return await self.async_forward_quorum(
+            endpoints = endpoints,
+            synapses = synapses,
+            inputs = [ inputs for _ in endpoints ],
+            timeout = timeout,
+            grpc_request = grpc_request,
+            **kwargs
+        )
+
+    def _create_forward_task( self, endpoint: 'bittensor.Endpoint', synapses: List[ 'bittensor.Synapse' ], inputs: torch.Tensor, timeout: int, grpc_request: 'bittensor.proto.TensorMessage' = None, semaphore: asyncio.Semaphore = None, stats: dict = None ) -> asyncio.Task:
+        r""" Schedules a forward call on the receptor for this endpoint, once a slot of the semaphore (if any) is free.
+        """
+        receptor = self._get_or_create_receptor_for_endpoint( endpoint )
+        call = functools.partial( receptor.async_forward, synapses = synapses, inputs = inputs, timeout = timeout, grpc_request = grpc_request )
+        request_bytes = 0
+        if stats != None:
+            request_bytes = grpc_request.ByteSize() if grpc_request != None else inputs.element_size() * inputs.nelement()
+        return self._create_call_task( receptor, call, semaphore = semaphore, stats = stats, request_bytes = request_bytes )
+
+    def _create_call_task( self, receptor: 'bittensor.Receptor', call: Callable, semaphore: asyncio.Semaphore = None, stats: dict = None, request_bytes: int = 0 ) -> asyncio.Task:
+        r""" Schedules call() with the receptor marked as in flight from now on, so it cannot be evicted while the call
+             waits for a semaphore slot. The receptor is released once the task is done, even if it is cancelled before it starts.
+        """
+        hotkey = receptor.endpoint.hotkey
+        self.receptors.acquire( hotkey )
+        task = asyncio.create_task( self._track_call( call, semaphore = semaphore, stats = stats, request_bytes = request_bytes ) )
+        task.add_done_callback( lambda _: self.receptors.release( hotkey ) )
+        return task
+
+    async def _track_call( self, call: Callable, semaphore: asyncio.Semaphore = None, stats: dict = None, request_bytes: int = 0 ):
+        r""" Awaits call(), once a slot of the semaphore (if any) is free. Calls that are made are counted into stats.
+        """
+        if semaphore != None:
+            async with semaphore:
+                return await self._track_call( call, stats = stats, request_bytes = request_bytes )
+        if stats != None:
+            stats['requests'] += 1
+            stats['request_bytes'] += request_bytes
+        return await call()
+
+    @staticmethod
+    async def _cancel_tasks( tasks ):
+        r""" Cancels the tasks and waits until every one of them has actually stopped.
+        """
+        tasks = list(tasks)
+        for task in tasks:
+            task.cancel()
+        if len(tasks) > 0:
+            await asyncio.gather( *tasks, return_exceptions = True )
+
+    def sample_endpoints( self, endpoints: List [ 'bittensor.Endpoint' ], n: int, stake: 'np.ndarray' = None ) -> List [ 'bittensor.Endpoint' ]:
+        r""" Selects n endpoints to query using the pool's endpoint sampler, which learns from every forward response.
+            Args:
+                endpoints (:obj:`List[ bittensor.Endpoint ]`, `required`):
+                    Candidate endpoints, usually metagraph.endpoint_objs.
+                n (int):
+                    Number of endpoints to select.
+                stake (:obj:`np.ndarray` of shape :obj:`(num_uids)`, `optional`):
+                    Stake per uid for stake weighted samplers.
+        """
+        return self.endpoint_sampler.sample( endpoints, n, stake = stake )
+
+    def latency_quantile( self, quantile: float = 0.95, min_samples: int = 20 ) -> float:
+        r""" Returns the quantile of recently observed successful forward latencies or None if there are too few samples.
+        """
+        if len(self.latency_history) < min_samples:
+            return None
+        return float(np.quantile( np.array(self.latency_history), quantile ))
 
     async def async_backward(
                 self, 
@@ -334,11 +601,15 @@ class ReceptorPool ( torch.nn.Module):
         calls = []
         for index, receptor in enumerate(receptors):
             calls.append( 
-                receptor.async_backward (
-                    synapses = synapses,
-                    inputs = inputs[index], 
-                    grads = grads[index],
-                    timeout = timeout
+                self._create_call_task(
+                    receptor,
+                    functools.partial(
+                        receptor.async_backward,
+                        synapses = synapses,
+                        inputs = inputs[index], 
+                        grads = grads[index],
+                        timeout = timeout
+                    )
                 )
             )
         responses = await asyncio.gather( *calls )
@@ -358,29 +629,16 @@ class ReceptorPool ( torch.nn.Module):
         return backward_outputs, backward_codes, backward_times
 
     def _destroy_receptors_over_max_allowed( self ):
-        r""" Destroys receptors based on QPS until there are no more than max_active_receptors.
+        r""" Evicts idle receptors, least recently used and lowest QPS first, until there are no more than max_active_receptors.
+            Eviction is O(log n) per receptor and the evicted channels are closed asynchronously.
         """
-        with self.cull_mutex:
-            # ---- Finally: Kill receptors over max allowed ----
-            while len(self.receptors) > self.max_active_receptors:
-                min_receptor_qps = math.inf
-                receptor_to_remove = None
-                for next_receptor in self.receptors.values():
-                    next_qps = next_receptor.stats.forward_qps.value
-                    sema_value = next_receptor.semaphore._value
-                    if (min_receptor_qps > next_qps) and (sema_value == self.max_processes):
-                        receptor_to_remove = next_receptor
-                        min_receptor_qps = next_receptor.stats.forward_qps.value
-                        
-                if receptor_to_remove != None:
-                    try:
-                        bittensor.logging.destroy_receptor_log(receptor_to_remove.endpoint)
-                        self.receptors[ receptor_to_remove.endpoint.hotkey ].close()
-                        del self.receptors[ receptor_to_remove.endpoint.hotkey ]
-                    except KeyError:
-                        pass
-                elif receptor_to_remove == None:
-                    break
+        for receptor in self.receptors.evict():
+            bittensor.logging.destroy_receptor_log( receptor.endpoint )
+
+    def get_receptor_gauges( self ) -> dict:
+        r""" Returns gauges describing the open receptors (open, busy, closing, created, evicted, closed).
+        """
+        return self.receptors.gauge_values()
 
     def _get_or_create_receptor_for_endpoint( self, endpoint: 'bittensor.Endpoint' ) -> 'bittensor.Receptor':
         r""" Finds or creates a receptor TCP connection associated with the passed Neuron Endpoint
@@ -396,23 +654,26 @@ class ReceptorPool ( torch.nn.Module):
             if receptor.endpoint.ip != endpoint.ip or receptor.endpoint.port != endpoint.port:
                 #receptor.close()
                 bittensor.logging.update_receptor_log( endpoint )
-                receptor = bittensor.receptor (
+                receptor = Receptor.from_endpoint (
                     endpoint = endpoint, 
                     wallet = self.wallet,
                     external_ip = self.external_ip,
-                    max_processes = self.max_processes
+                    max_processes = self.max_processes,
+                    compression = self.compression,
+                    recorder = self.recorder
                 )            
                 self.receptors[ receptor.endpoint.hotkey ] = receptor
 
         # ---- Or: Create a new receptor ----
         else:
             bittensor.logging.create_receptor_log( endpoint )
-            receptor = bittensor.receptor (
+            receptor = Receptor.from_endpoint (
                     endpoint = endpoint, 
                     wallet = self.wallet,
                     external_ip = self.external_ip,
                     max_processes = self.max_processes,
-                    compression = self.compression
+                    compression = self.compression,
+                    recorder = self.recorder
             )
             self.receptors[ receptor.endpoint.hotkey ] = receptor
             
@@ -0,0 +1,155 @@
+""" Buffered and sampled recording of receptor RPC events.
+"""
+# The MIT License (MIT)
+# Copyright © 2021 Yuma Rao
+
+# Permission is hereby granted, free of charge, to any person obtaining a copy of this software and associated
+# documentation files (the “Software”), to deal in the Software without restriction, including without limitation
+# the rights to use, copy, modify, merge, publish, distribute, sublicense, and/or sell copies of the Software,
+# and to permit persons to whom the Software is furnished to do so, subject to the following conditions:
+
+# The above copyright notice and this permission notice shall be included in all copies or substantial portions of
+# the Software.
+
+# THE SOFTWARE IS PROVIDED “AS IS”, WITHOUT WARRANTY OF ANY KIND, EXPRESS OR IMPLIED, INCLUDING BUT NOT LIMITED TO
+# THE WARRANTIES OF MERCHANTABILITY, FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL
+# THE AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER LIABILITY, WHETHER IN AN ACTION
+# OF CONTRACT, TORT OR OTHERWISE, ARISING FROM, OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER
+# DEALINGS IN THE SOFTWARE.
+
+import random
+import asyncio
+from collections import deque, defaultdict
+from typing import Callable
+
+
+class RPCRecorder:
+    """ Records receptor RPC events into a ring buffer which a background task flushes to a sink.
+
+        Callers check `recorder.enabled` before building anything, so disabled recording costs one attribute
+        lookup. Every recorded event updates the aggregate counters; only a sample_rate fraction of them is
+        buffered for logging. Shapes are stored as-is and only turned into lists when flushed.
+    """
+
+    def __init__(
+            self,
+            enabled: bool = True,
+            sample_rate: float = 1.0,
+            buffer_size: int = 10000,
+            flush_interval: float = 1.0,
+            sink: Callable = None,
+        ):
+        r""" Initializes the recorder.
+            Args:
+                enabled (bool):
+                    Whether events are recorded at all.
+                sample_rate (float):
+                    Fraction of events buffered for the sink. Counters always see every event.
+                buffer_size (int):
+                    Ring buffer capacity. The oldest events are dropped when it is full.
+                flush_interval (float):
+                    Seconds between background flushes.
+                sink (Callable):
+                    Called with the keyword arguments of bittensor.logging.rpc_log for every flushed event.
+                    Defaults to bittensor.logging.rpc_log.
+        """
+        self.enabled = enabled
+        self.sample_rate = sample_rate
+        self.flush_interval = flush_interval
+        self.sink = sink
+        self.buffer = deque(maxlen=buffer_size)
+        self.counters = defaultdict(int)
+        self.call_time_sums = defaultdict(float)
+        self.flush_task = None
+
+    def record( self, forward: bool, is_response: bool, code: int, call_time: float, pubkey: str, uid: int,
+                inputs_shape, outputs_shape, message: str, synapse_type ):
+        r""" Counts the event and buffers it for the sink if it is sampled.
+        """
+        key = ( forward, code )
+        self.counters[key] += 1
+        self.call_time_sums[key] += call_time
+        if self.sample_rate < 1.0 and random.random() >= self.sample_rate:
+            return
+        if len(self.buffer) == self.buffer.maxlen:
+            self.counters['dropped'] += 1
+        self.buffer.append( ( forward, is_response, code, call_time, pubkey, uid, inputs_shape, outputs_shape, message, synapse_type ) )
+        self._ensure_flush_task()
+
+    def _ensure_flush_task( self ):
+        if self.flush_task != None and not self.flush_task.done():
+            return
+        try:
+            loop = asyncio.get_running_loop()
+        except RuntimeError:
+            # No loop to flush in the background; flush() drains the buffer when called.
+            return
+        self.flush_task = loop.create_task( self._flush_loop() )
+
+    async def _flush_loop( self ):
+        loop = asyncio.get_running_loop()
+        while len(self.buffer) > 0:
+            await asyncio.sleep( self.flush_interval )
+            # The sink is synchronous, write the drained batch off the event loop so in-flight forwards keep running.
+            await loop.run_in_executor( None, self.write, self.drain() )
+
+    def drain( self ) -> list:
+        r""" Pops every buffered event.
+        """
+        events = []
+        while len(self.buffer) > 0:
+            events.append( self.buffer.popleft() )
+        return events
+
+    def write( self, events: list ) -> int:
+        r""" Sends events to the sink.
+            Returns:
+                num_events (int):
+                    Number of written events.
+        """
+        sink = self.sink
+        if sink == None:
+            import bittensor
+            sink = bittensor.logging.rpc_log
+        for forward, is_response, code, call_time, pubkey, uid, inputs_shape, outputs_shape, message, synapse_type in events:
+            sink(
+                axon = False,
+                forward = forward,
+                is_response = is_response,
+                code = code,
+                call_time = call_time,
+                pubkey = pubkey,
+                uid = uid,
+                inputs = list(inputs_shape),
+                outputs = None if outputs_shape == None else list(outputs_shape),
+                message = message,
+                synapse = synapse_type
+            )
+        return len(events)
+
+    def flush( self ) -> int:
+        r""" Sends every buffered event to the sink in the calling thread.
+            Returns:
+                num_events (int):
+                    Number of flushed events.
+        """
+        return self.write( self.drain() )
+
+    def summary( self ) -> dict:
+        r""" Returns the aggregate counters as {'forward'|'backward': {code: {'count', 'mean_call_time'}}, 'dropped': int}.
+        """
+        summary = { 'forward': {}, 'backward': {}, 'dropped': self.counters.get('dropped', 0) }
+        for key, count in self.counters.items():
+            if key == 'dropped':
+                continue
+            forward, code = key
+            summary['forward' if forward else 'backward'][code] = dict( count = count, mean_call_time = self.call_time_sums[key] / count )
+        return summary
+
+    def reset( self ):
+        self.buffer.clear()
+        self.counters.clear()
+        self.call_time_sums.clear()
+
+
+rpc_recorder = RPCRecorder()
@@ -0,0 +1,191 @@
+""" Endpoint samplers which pick which endpoints a ReceptorPool should query.
+"""
+# The MIT License (MIT)
+# Copyright © 2021 Yuma Rao
+
+# Permission is hereby granted, free of charge, to any person obtaining a copy of this software and associated
+# documentation files (the “Software”), to deal in the Software without restriction, including without limitation
+# the rights to use, copy, modify, merge, publish, distribute, sublicense, and/or sell copies of the Software,
+# and to permit persons to whom the Software is furnished to do so, subject to the following conditions:
+
+# The above copyright notice and this permission notice shall be included in all copies or substantial portions of
+# the Software.
+
+# THE SOFTWARE IS PROVIDED “AS IS”, WITHOUT WARRANTY OF ANY KIND, EXPRESS OR IMPLIED, INCLUDING BUT NOT LIMITED TO
+# THE WARRANTIES OF MERCHANTABILITY, FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL
+# THE AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER LIABILITY, WHETHER IN AN ACTION
+# OF CONTRACT, TORT OR OTHERWISE, ARISING FROM, OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER
+# DEALINGS IN THE SOFTWARE.
+
+from typing import List, Union
+from threading import Lock
+import numpy as np
+
+
+class EndpointSampler:
+    """ Base endpoint sampler. Subclasses decide which endpoints to query and learn from the responses.
+    """
+
+    def update( self, uid: int, success: bool = None, latency: float = None ):
+        r""" Records the outcome of a single forward call to the endpoint with this uid.
+            success is None for calls which were cancelled before they answered, in which case
+            latency is the time the call was pending for.
+        """
+        pass
+
+    def sample( self, endpoints: List['bittensor.Endpoint'], n: int, stake: 'np.ndarray' = None ) -> List['bittensor.Endpoint']:
+        r""" Selects n endpoints from endpoints.
+            Args:
+                endpoints (:obj:`List[ bittensor.Endpoint ]`, `required`):
+                    Candidate endpoints.
+                n (int):
+                    Number of endpoints to return.
+                stake (:obj:`np.ndarray` of shape :obj:`(num_uids)`, `optional`):
+                    Stake per uid, used by samplers which weight by stake.
+        """
+        raise NotImplementedError
+
+    def __call__( self, *args, **kwargs ):
+        return self.sample( *args, **kwargs )
+
+
+class UniformEndpointSampler(EndpointSampler):
+    """ Picks endpoints uniformly at random (with replacement), ignoring any feedback.
+    """
+
+    def sample( self, endpoints: List['bittensor.Endpoint'], n: int, stake: 'np.ndarray' = None ) -> List['bittensor.Endpoint']:
+        random_ids = np.random.randint(0, len(endpoints), (n))
+        return [endpoints[i] for i in random_ids]
+
+
+class ScoredEndpointSampler(EndpointSampler):
+    """ Samples endpoints proportionally to a score built from an EWMA of their latency and success rate.
+
+        score = success_ewma / (1 + latency_weight * latency_ewma) * stake_share ** stake_weight
+
+        A fraction epsilon of every sample is drawn uniformly so that unseen or recovering endpoints keep being probed.
+        Endpoints without history start optimistic (success_ewma = 1, latency_ewma = default_latency).
+    """
+
+    def __init__(
+            self,
+            alpha: float = 0.1,
+            epsilon: float = 0.1,
+            latency_weight: float = 1.0,
+            stake_weight: float = 0.0,
+            default_latency: float = 1.0,
+            min_score: float = 1e-4,
+        ):
+        r""" Initializes the sampler.
+            Args:
+                alpha (float):
+                    EWMA smoothing factor applied on every update.
+                epsilon (float):
+                    Fraction of each sample drawn uniformly for exploration.
+                latency_weight (float):
+                    How strongly latency (in seconds) penalizes the score.
+                stake_weight (float):
+                    Exponent applied to the normalized stake. 0 disables stake weighting.
+                default_latency (float):
+                    Latency assumed for endpoints which were never queried.
+                min_score (float):
+                    Floor on every score, relative to the best one, so no endpoint is starved completely.
+        """
+        self.alpha = alpha
+        self.epsilon = epsilon
+        self.latency_weight = latency_weight
+        self.stake_weight = stake_weight
+        self.default_latency = default_latency
+        self.min_score = min_score
+        self.mutex = Lock()
+        self.latency = np.zeros(0)
+        self.success = np.zeros(0)
+
+    def _ensure_capacity( self, size: int ):
+        if size <= len(self.latency):
+            return
+        new_size = max(size, 2 * len(self.latency))
+        self.latency = np.concatenate([ self.latency, np.full(new_size - len(self.latency), self.default_latency) ])
+        self.success = np.concatenate([ self.success, np.ones(new_size - len(self.success)) ])
+
+    def update( self, uid: int, success: bool = None, latency: float = None ):
+        with self.mutex:
+            self._ensure_capacity( uid + 1 )
+            if success is not None:
+                self.success[uid] += self.alpha * ( float(success) - self.success[uid] )
+            # Failed calls usually return early so their latency says nothing about the peer.
+            if latency is not None and success is not False:
+                self.latency[uid] += self.alpha * ( latency - self.latency[uid] )
+
+    def scores( self, uids: 'np.ndarray', stake: 'np.ndarray' = None ) -> 'np.ndarray':
+        r""" Returns the (unnormalized) score of each uid.
+        """
+        uids = np.asarray(uids, dtype=np.int64)
+        with self.mutex:
+            self._ensure_capacity( int(uids.max()) + 1 if len(uids) > 0 else 0 )
+            scores = np.maximum( self.success[uids] / ( 1 + self.latency_weight * self.latency[uids] ), self.min_score )
+        if stake is not None and self.stake_weight > 0:
+            stake = np.asarray(stake, dtype=np.float64)[uids]
+            stake_share = stake / max(stake.sum(), 1e-10)
+            scores = scores * stake_share ** self.stake_weight
+        # relative to the best score, stake shares of thousands of uids are far below any absolute floor
+        return np.maximum(scores, self.min_score * scores.max()) if len(scores) > 0 else scores
+
+    def sample( self, endpoints: List['bittensor.Endpoint'], n: int, stake: 'np.ndarray' = None ) -> List['bittensor.Endpoint']:
+        n = min(n, len(endpoints))
+        if n == 0:
+            return []
+        uids = np.array([ e.uid for e in endpoints ])
+        scores = self.scores( uids, stake = stake )
+
+        num_explore = np.random.binomial( n, self.epsilon ) if self.epsilon > 0 else 0
+        num_exploit = n - num_explore
+
+        selected = np.random.choice( len(endpoints), num_exploit, replace = False, p = scores / scores.sum() )
+        if num_explore > 0:
+            remaining = np.setdiff1d( np.arange(len(endpoints)), selected, assume_unique = True )
+            selected = np.concatenate([ selected, np.random.choice( remaining, num_explore, replace = False ) ])
+        return [ endpoints[i] for i in selected ]
+
+
+endpoint_samplers = {
+    'uniform': UniformEndpointSampler,
+    'scored': ScoredEndpointSampler,
+}
+
+
+def resolve_stake_weight( stake_weighted_sampling: Union[bool, float, None] ) -> Union[float, None]:
+    r""" Returns the stake exponent for a stake_weighted_sampling config flag.
+        False or None turns stake weighting off (returns None), True samples proportionally to stake (1.0)
+        and a number is used as the exponent itself, e.g. 0.5 favours high stake less than proportionally.
+    """
+    if not stake_weighted_sampling:
+        return None
+    elif stake_weighted_sampling is True:
+        return 1.0
+    else:
+        return float(stake_weighted_sampling)
+
+
+def resolve_endpoint_sampler( sampler: Union[str, dict, EndpointSampler] = 'scored', stake_weight: float = None ) -> EndpointSampler:
+    r""" Returns an EndpointSampler from a sampler name, a config dict ({'mode': 'scored', ...kwargs}) or an instance.
+        Args:
+            sampler (:obj:`Union[str, dict, EndpointSampler]`, `optional`):
+                Sampler name, config dict or instance.
+            stake_weight (float, `optional`):
+                Overrides the stake exponent of samplers which weight by stake, None keeps their own.
+    """
+    if isinstance(sampler, EndpointSampler):
+        pass
+    elif isinstance(sampler, str):
+        sampler = endpoint_samplers[sampler]()
+    elif isinstance(sampler, dict):
+        sampler = dict(sampler)
+        mode = sampler.pop('mode', 'scored')
+        sampler = endpoint_samplers[mode](**sampler)
+    else:
+        raise TypeError(f'{type(sampler)} is not a supported endpoint sampler')
+
+    if stake_weight is not None and hasattr(sampler, 'stake_weight'):
+        sampler.stake_weight = stake_weight
+    return sampler
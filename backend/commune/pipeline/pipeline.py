@@ -3,13 +3,45 @@ from munch import Munch
 import commune
 import streamlit as st
 import os
+import queue
+import inspect
+import itertools
+import threading
+from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED
+from typing import Any, Iterable, Iterator, List, Optional
+import ray
 
 # pipeline_config = commune.load_config(os.path.dirname(__file__).replace(os.getenv('PWD'), ''))
 
 
 
 
+class PipelineEnd:
+    '''
+    Marks the end of a stream (error is set if a stage failed).
+    '''
+    def __init__(self, error:Exception=None):
+        self.error = error
+
+
 class Pipeline:
+    '''
+    A DAG of blocks. Each block lists the blocks it reads from in `inputs` (default the previous block),
+    blocks without inputs are sources and blocks nobody reads from are sinks.
+
+    run() calls every block once, running blocks whose inputs are ready concurrently.
+    stream() runs every block as a stage thread connected by bounded queues, so each stage processes
+    item i while its inputs produce item i+1, and the pipeline runs at the speed of its slowest stage.
+    Blocks launched as ray actors run on the actor, the stage thread only waits on the result.
+
+    Block config:
+        module, fn, init_fn, init_kwargs, actor, name, tag: as for commune.launch
+        args, kwargs: extra arguments of each call
+        inputs: names of the blocks whose outputs are the input of this block
+        input_key_map, output_key_map: renames of the input and output dict keys
+        queue_size: bound of the queue in front of this block when streaming (default config.queue_size)
+    '''
+
     def __init__(self, pipeline, config={}):
         self.config = Munch(config)
         self.process_block = Munch({})
@@ -23,7 +55,7 @@ class Pipeline:
         elif isinstance(pipeline_config, dict): 
             keys = list(pipeline_config.keys())
         
-        previous_key = None
+        previous_block = None
         # building the pipeline
         self.pipeline_blocks = []
         for key in keys:
@@ -32,6 +64,8 @@ class Pipeline:
 
             process_block['tag'] = process_block.get('tag', None)
             process_block['name'] = process_block.get('name',  path )
+            if process_block['name'] in self.process_block:
+                process_block['name'] = f"{process_block['name']}-{key}"
             process_block['actor'] = process_block.get('actor',  False )
             launch_kwargs = dict(
                 module = process_block['module'],
@@ -46,37 +80,211 @@ class Pipeline:
 
             self.process_block[process_block['name']] = process_block
 
-            if previous_key != None:
-                input_modules = self.pipeline_blocks[previous_key]
-                if not isinstance(input_modules, list):
-                    input_modules = [input_modules]
-                process_block['input_modules'] = list(map(lambda x: x['name'], input_modules ))
+            # a linear pipeline unless the block says what it reads from
+            if 'inputs' in process_block:
+                inputs = process_block['inputs']
+                process_block['input_modules'] = [inputs] if isinstance(inputs, str) else list(inputs)
+            elif previous_block != None:
+                process_block['input_modules'] = [previous_block['name']]
+            else:
+                process_block['input_modules'] = []
 
-            previous_key = key
+            previous_block = process_block
             self.pipeline_blocks.append(process_block)
-            
 
-    def run(self):
-        input = {}
         for block in self.pipeline_blocks:
-            fn = block.get('function')
-            fn_args = block.get('args', [])
-            fn_kwargs = block.get('kwargs', {})
-            input_key_map = block.get('input_key_map', {})
-            if isinstance(input, dict):
-                input = {input_key_map.get(k, k):v for k,v in input.items()}
-                fn_kwargs.update(input)
-            else:
-                fn_args = [input, *fn_args]
+            for input_module in block['input_modules']:
+                assert input_module in self.process_block, f"{block['name']} reads from unknown block {input_module}"
+        self.pipeline_blocks = self.topological_sort(self.pipeline_blocks)
+
+    @staticmethod
+    def topological_sort(blocks:List[dict]) -> List[dict]:
+        ordered, done = [], set()
+        remaining = list(blocks)
+        while len(remaining) > 0:
+            ready = [b for b in remaining if all(i in done for i in b['input_modules'])]
+            assert len(ready) > 0, f"the pipeline has a cycle between {[b['name'] for b in remaining]}"
+            for block in ready:
+                ordered.append(block)
+                done.add(block['name'])
+                remaining.remove(block)
+        return ordered
+
+    @property
+    def sink_blocks(self) -> List[dict]:
+        consumed = set(i for block in self.pipeline_blocks for i in block['input_modules'])
+        return [block for block in self.pipeline_blocks if block['name'] not in consumed]
+
+    def consumers(self, name:str) -> List[dict]:
+        return [block for block in self.pipeline_blocks if name in block['input_modules']]
+
+    @staticmethod
+    def merge_inputs(inputs:List[Any]) -> Any:
+        '''
+        The input of a block with several input blocks: their dict outputs merged (later ones win),
+        a single non dict output is passed as it is.
+        '''
+        if len(inputs) == 1:
+            return inputs[0]
+        if all(isinstance(input, dict) for input in inputs):
+            return {k:v for input in inputs for k,v in input.items()}
+        return inputs
 
+    @staticmethod
+    def call_block(block:dict, input:Any=None) -> Any:
+        fn = block.get('function')
+        fn_args = list(block.get('args', []))
+        fn_kwargs = dict(block.get('kwargs', {}))
+        input_key_map = block.get('input_key_map', {})
+        if isinstance(input, dict):
+            input = {input_key_map.get(k, k):v for k,v in input.items()}
+            fn_kwargs.update(input)
+        elif input is not None:
+            fn_args = [input, *fn_args]
+
+        if hasattr(fn, 'remote'):
+            # ray actor method, the work happens on the actor
+            output = ray.get(fn.remote(*fn_args, **fn_kwargs))
+        else:
             output = fn(*fn_args, **fn_kwargs)
-            output_key_map = block.get('output_key_map', {})
-            if isinstance(output, dict):
-                output = {output_key_map.get(k, k):v for k,v in output.items()}
-            input = output
 
+        output_key_map = block.get('output_key_map', {})
+        if isinstance(output, dict):
+            output = {output_key_map.get(k, k):v for k,v in output.items()}
         return output
 
+    def run(self, max_workers:Optional[int]=None):
+        '''
+        Calls every block once, blocks run as soon as all of their inputs are done.
+        Returns the output of the sink block, or {name: output} if there are several.
+        '''
+        outputs = {}
+        pending = {block['name']: block for block in self.pipeline_blocks}
+        running = {}
+        max_workers = max_workers if max_workers != None else self.config.get('max_workers', len(pending))
+        with ThreadPoolExecutor(max_workers=max(max_workers, 1)) as executor:
+            while len(pending) > 0 or len(running) > 0:
+                for name, block in list(pending.items()):
+                    if all(i in outputs for i in block['input_modules']):
+                        inputs = [outputs[i] for i in block['input_modules']]
+                        input = self.merge_inputs(inputs) if len(inputs) > 0 else None
+                        running[executor.submit(self.call_block, block, input)] = name
+                        del pending[name]
+                done, _ = wait(list(running.keys()), return_when=FIRST_COMPLETED)
+                for future in done:
+                    outputs[running.pop(future)] = future.result()
+
+        sinks = self.sink_blocks
+        if len(sinks) == 1:
+            return outputs[sinks[0]['name']]
+        return {block['name']: outputs[block['name']] for block in sinks}
+
+    def stream(self, items:Optional[Iterable]=None, num_items:Optional[int]=None, queue_size:Optional[int]=None) -> Iterator[Any]:
+        '''
+        Streams items through the pipeline, yielding the sink output of each item in order
+        ({name: output} if there are several sinks).
+
+        Source blocks are fed from items if given, each source sees every item. Otherwise they are called
+        num_items times (forever if None), or iterated if they return a generator. Every other block is called once per item.
+        '''
+        queue_size = queue_size if queue_size != None else self.config.get('queue_size', 8)
+        stop = threading.Event()
+        # one bounded queue per edge, plus one per sink for the caller
+        edges = {}
+        for block in self.pipeline_blocks:
+            for input_module in block['input_modules']:
+                edges[(input_module, block['name'])] = queue.Queue(maxsize=block.get('queue_size', queue_size))
+        sinks = self.sink_blocks
+        sink_queues = {block['name']: queue.Queue(maxsize=queue_size) for block in sinks}
+        if items is not None:
+            # one copy of the items per source, tee iterators are not thread safe so they are advanced under a lock
+            sources = [block['name'] for block in self.pipeline_blocks if len(block['input_modules']) == 0]
+            source_iterators = dict(zip(sources, itertools.tee(items, len(sources))))
+            items_lock = threading.Lock()
+
+        def put(q:queue.Queue, item:Any):
+            while not stop.is_set():
+                try:
+                    return q.put(item, timeout=0.1)
+                except queue.Full:
+                    continue
+
+        def get(q:queue.Queue) -> Any:
+            while not stop.is_set():
+                try:
+                    return q.get(timeout=0.1)
+                except queue.Empty:
+                    continue
+            return PipelineEnd()
+
+        def source_items(block:dict) -> Iterator[Any]:
+            if items is not None:
+                iterator = source_iterators[block['name']]
+                while True:
+                    with items_lock:
+                        item = next(iterator, PipelineEnd())
+                    if isinstance(item, PipelineEnd):
+                        return
+                    yield self.call_block(block, item)
+            index = 0
+            while num_items is None or index < num_items:
+                output = self.call_block(block)
+                if inspect.isgenerator(output):
+                    yield from output
+                    return
+                yield output
+                index += 1
+
+        def stage(block:dict):
+            out_queues = [edges[(block['name'], b['name'])] for b in self.consumers(block['name'])]
+            if block['name'] in sink_queues:
+                out_queues.append(sink_queues[block['name']])
+            in_queues = [edges[(i, block['name'])] for i in block['input_modules']]
+            end = PipelineEnd()
+            try:
+                if len(in_queues) == 0:
+                    outputs = source_items(block)
+                else:
+                    def stage_outputs():
+                        while True:
+                            inputs = [get(q) for q in in_queues]
+                            ended = [i for i in inputs if isinstance(i, PipelineEnd)]
+                            if len(ended) > 0:
+                                errors = [i.error for i in ended if i.error is not None]
+                                if len(errors) > 0:
+                                    raise errors[0]
+                                return
+                            yield self.call_block(block, self.merge_inputs(inputs))
+                    outputs = stage_outputs()
+                for output in outputs:
+                    if stop.is_set():
+                        break
+                    for q in out_queues:
+                        put(q, output)
+            except Exception as e:
+                end = PipelineEnd(error=e)
+            for q in out_queues:
+                put(q, end)
+
+        threads = [threading.Thread(target=stage, args=(block,), name=f"pipeline-{block['name']}", daemon=True) for block in self.pipeline_blocks]
+        for thread in threads:
+            thread.start()
+        try:
+            while True:
+                outputs = {name: get(q) for name, q in sink_queues.items()}
+                ended = [o for o in outputs.values() if isinstance(o, PipelineEnd)]
+                if len(ended) > 0:
+                    errors = [o.error for o in ended if o.error is not None]
+                    if len(errors) > 0:
+                        raise errors[0]
+                    return
+                yield outputs[sinks[0]['name']] if len(sinks) == 1 else outputs
+        finally:
+            # also stops the stages if the caller stops iterating early
+            stop.set()
+            for thread in threads:
+                thread.join(timeout=1)
+
     @staticmethod
     def test_sequential_pipeline():
         commune.init_ray()
@@ -1,2 +1,2 @@
 from .base import BaseAggregator
-
+from .reducers import OnlineReducer, SumReducer, MeanReducer, TopKReducer, MedianReducer, TrimmedMeanReducer, resolve_reducer, reduce_receptor_responses
@@ -4,11 +4,22 @@ import commune
 import streamlit as st
 import os
 import ray
+import time
+from concurrent.futures import ThreadPoolExecutor, Future, wait, FIRST_COMPLETED
+from typing import Any, Dict, Iterator, List, Optional, Tuple, Union
 
 # pipeline_config = commune.load_config(os.path.dirname(__file__).replace(os.getenv('PWD'), ''))
 import torch 
+from commune.process.aggregator.reducers import OnlineReducer, resolve_reducer
 
 class BaseAggregator:
+    '''
+    Runs the same input through every block and aggregates their dict outputs key by key.
+
+    Blocks run concurrently: ray actor methods are called with .remote, other blocks on a thread pool, and
+    outputs are collected as they arrive. With quorum the call returns once that many blocks answered,
+    with timeout (seconds) it returns whatever answered in time. Both can be set in the config.
+    '''
     def __init__(self, blocks:list=[], config={}):
         self.config = Munch(config)
         self.build_blocks(blocks)
@@ -42,12 +53,92 @@ class BaseAggregator:
         output = fn(*fn_args, **fn_kwargs)      
         return output
         
+    @property
+    def executor(self) -> ThreadPoolExecutor:
+        if getattr(self, '_executor', None) == None or self._executor._max_workers < len(self.blocks):
+            self._executor = ThreadPoolExecutor(max_workers=max(len(self.blocks), 1))
+        return self._executor
+
+    def submit_block(self, block:dict, input:dict={}) -> Future:
+        fn = block.get('function')
+        if hasattr(fn, 'remote'):
+            # ray actor method, the call returns right away and the actor does the work
+            key_map = block.get('key_map', {})
+            input = {key_map.get(k, k):v for k,v in input.items()}
+            return fn.remote(*block.get('args', []), **{**input, **block.get('kwargs', {})}).future()
+        return self.executor.submit(self.run_block, block, input)
+
+    def iter_outputs(self, timeout:Optional[float]=None, quorum:Optional[int]=None, **kwargs) -> Iterator[Tuple[int, Any]]:
+        '''
+        Yields (block index, output) in order of arrival, until every block answered, quorum blocks
+        answered or timeout passed. Blocks that failed are skipped, if all of them fail the first error is raised.
+        '''
+        timeout = timeout if timeout != None else self.config.get('timeout')
+        quorum = quorum if quorum != None else self.config.get('quorum')
+        deadline = time.time() + timeout if timeout != None else None
+
+        futures = {self.submit_block(block, input=kwargs): i for i, block in enumerate(self.blocks)}
+        num_outputs, errors = 0, []
+        while len(futures) > 0 and (quorum == None or num_outputs < quorum):
+            remaining = deadline - time.time() if deadline != None else None
+            if remaining != None and remaining <= 0:
+                break
+            done, _ = wait(list(futures.keys()), timeout=remaining, return_when=FIRST_COMPLETED)
+            for future in done:
+                index = futures.pop(future)
+                try:
+                    output = future.result()
+                except Exception as e:
+                    errors.append(e)
+                    continue
+                if isinstance(output, ray._raylet.ObjectRef):
+                    # a wrapped actor that did not ray.get, wait for the object as well
+                    futures[output.future()] = index
+                    continue
+                num_outputs += 1
+                yield index, output
+
+        for future in futures:
+            future.cancel()
+        if num_outputs == 0 and len(errors) > 0:
+            raise errors[0]
+
     def get_outputs(self, *args,**kwargs):
-        outputs = []
-        for block in self.blocks:
-            output = self.run_block(block)
-            outputs.append(output)
-        return outputs
+        return [output for index, output in sorted(self.iter_outputs(**kwargs), key=lambda x: x[0])]
+
+    def stack_outputs(self, *args, **kwargs) -> Dict[str, Any]:
+        '''
+        Outputs stacked per key in the first dimension, written into a buffer preallocated for all the
+        blocks as they arrive and trimmed to the blocks that answered. Non tensor values are kept as lists.
+        '''
+        buffers, counts, lists = {}, {}, {}
+        for index, output in self.iter_outputs(**kwargs):
+            for k,v in output.items():
+                if not isinstance(v, torch.Tensor) or k in lists:
+                    lists.setdefault(k, []).append(v)
+                    continue
+                if k not in buffers:
+                    buffers[k] = torch.empty((len(self.blocks), *v.shape), dtype=v.dtype, device=v.device)
+                    counts[k] = 0
+                if buffers[k].shape[1:] != v.shape:
+                    # shapes differ between blocks, this key cannot be stacked
+                    lists[k] = [*buffers.pop(k)[:counts.pop(k)], v]
+                    continue
+                buffers[k][counts[k]] = v
+                counts[k] += 1
+        return {**{k: buffers[k][:counts[k]] for k in buffers}, **lists}
+
+    def reduce_outputs(self, reducer:Union[str, dict, OnlineReducer]=None, weights:Optional[List[float]]=None, *args, **kwargs) -> Dict[str, torch.Tensor]:
+        '''
+        Folds the outputs into an online reducer (see reducers.py) as they arrive, without holding them.
+        The weight of a block is weights[index], its 'weight' in the block config, or 1.
+        '''
+        reducer = resolve_reducer(reducer if reducer != None else self.config.get('reducer', 'mean'))
+        reducer.reset()
+        for index, output in self.iter_outputs(**kwargs):
+            weight = weights[index] if weights != None else self.blocks[index].get('weight', 1.0)
+            reducer.update(output, weight=weight)
+        return reducer.result()
 
     @staticmethod
     def aggregate_outputs(outputs):
@@ -71,12 +162,8 @@ class BaseAggregator:
     def __call__(self, blocks:list=[], *args, **kwargs):
         if len(blocks)>0:
             self.blocks = self.build_blocks(blocks)
-        outputs = self.get_outputs(*args , **kwargs)
-        aggregate_outputs = self.aggregate_outputs(outputs)
-        
-
         # stack outputs in 1st dimension
-        outputs = {k:torch.stack(v) for k,v in aggregate_outputs.items()}
+        outputs = self.stack_outputs(*args , **kwargs)
         outputs = {k: torch.mean(v, dim=0) for k,v in outputs.items()}
         return outputs
 
@@ -12,10 +12,8 @@ import torch
 class MeanAggregator(commune.Aggregator):
 
     def run(self, *args, **kwargs):
-        outputs = self.get_outputs(*args , **kwargs)
-        aggregate_outputs = self.aggregate_outputs(outputs)
         # stack outputs in 1st dimension
-        outputs = {k:torch.stack(v) for k,v in aggregate_outputs.items()}
+        outputs = self.stack_outputs(*args , **kwargs)
         outputs = {k: torch.mean(v, dim=0) for k,v in outputs.items()}
         return outputs
 
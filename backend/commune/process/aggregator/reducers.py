@@ -0,0 +1,193 @@
+import torch
+from typing import Dict, List, Optional, Union
+
+
+class OnlineReducer:
+    '''
+    Folds dict outputs (key -> tensor) into a running aggregate as they arrive, so an aggregator
+    never holds the outputs of all of its replicas.
+
+    Usage:
+        reducer = MeanReducer()
+        for output, stake in replies:
+            reducer.update(output, weight=stake)
+        reducer.result()
+    '''
+
+    def __init__(self):
+        self.reset()
+
+    def reset(self):
+        self.state = {}
+        self.count = 0
+
+    def update(self, output:Dict[str, torch.Tensor], weight:float=1.0) -> 'OnlineReducer':
+        for k, v in output.items():
+            self.state[k] = self.update_key(self.state.get(k), v, float(weight))
+        self.count += 1
+        return self
+
+    def update_key(self, state, value:torch.Tensor, weight:float):
+        raise NotImplementedError
+
+    def result_key(self, state) -> torch.Tensor:
+        raise NotImplementedError
+
+    def result(self) -> Dict[str, torch.Tensor]:
+        return {k: self.result_key(state) for k, state in self.state.items()}
+
+
+class SumReducer(OnlineReducer):
+    '''
+    Weighted sum.
+    '''
+    def update_key(self, state, value, weight):
+        value = value * weight
+        return value if state is None else state + value
+
+    def result_key(self, state):
+        return state
+
+
+class MeanReducer(OnlineReducer):
+    '''
+    Weighted mean, e.g. with stake or score weights. Keeps a running weighted sum and total weight.
+    '''
+    def update_key(self, state, value, weight):
+        value = value.float() * weight
+        if state is None:
+            return [value, weight]
+        state[0] += value
+        state[1] += weight
+        return state
+
+    def result_key(self, state):
+        total, weight = state
+        return total / weight if weight != 0 else total
+
+
+class TopKReducer(OnlineReducer):
+    '''
+    Weighted mean of the k outputs with the highest weight (score), e.g. mixture of the top-k experts.
+    Holds at most k outputs per key.
+    '''
+    def __init__(self, k:int=3):
+        self.k = k
+        OnlineReducer.__init__(self)
+
+    def update_key(self, state, value, weight):
+        state = [] if state is None else state
+        if len(state) < self.k:
+            state.append((weight, value))
+        else:
+            # replace the lowest weight if this one is higher
+            lowest = min(range(len(state)), key=lambda i: state[i][0])
+            if weight > state[lowest][0]:
+                state[lowest] = (weight, value)
+        return state
+
+    def result_key(self, state):
+        weights = torch.tensor([w for w, _ in state], dtype=torch.float)
+        values = torch.stack([v.float() for _, v in state])
+        weights = weights.to(values.device).view(-1, *[1] * (values.dim() - 1))
+        total = weights.sum()
+        return (values * weights).sum(dim=0) / total if total != 0 else values.mean(dim=0)
+
+
+class BufferedReducer(OnlineReducer):
+    '''
+    Base for order statistics (median, trimmed mean). These need the values themselves, so each key keeps
+    a buffer of at most max_size outputs, preallocated on the first one. It is exact up to max_size replicas,
+    beyond that the buffer is a uniform reservoir sample, so memory stays bounded by max_size whatever the
+    number of replicas. Weights are ignored.
+    '''
+    def __init__(self, max_size:int=32, seed:Optional[int]=None):
+        self.max_size = max_size
+        self.generator = torch.Generator()
+        if seed is not None:
+            self.generator.manual_seed(seed)
+        OnlineReducer.__init__(self)
+
+    def update_key(self, state, value, weight):
+        if state is None:
+            state = [torch.empty((self.max_size, *value.shape), dtype=torch.float, device=value.device), 0]
+        buffer, seen = state
+        if seen < self.max_size:
+            buffer[seen] = value
+        else:
+            # reservoir sampling, every value seen so far is kept with the same probability
+            index = int(torch.randint(0, seen + 1, (1,), generator=self.generator))
+            if index < self.max_size:
+                buffer[index] = value
+        state[1] = seen + 1
+        return state
+
+    def values(self, state) -> torch.Tensor:
+        buffer, seen = state
+        return buffer[:min(seen, self.max_size)]
+
+
+class MedianReducer(BufferedReducer):
+    '''
+    Elementwise median, robust to a minority of replicas returning garbage.
+    '''
+    def result_key(self, state):
+        return self.values(state).median(dim=0).values
+
+
+class TrimmedMeanReducer(BufferedReducer):
+    '''
+    Elementwise mean after dropping the trim fraction of the lowest and of the highest values.
+    '''
+    def __init__(self, trim:float=0.1, max_size:int=32, seed:Optional[int]=None):
+        assert 0 <= trim < 0.5, f'trim {trim} should be in [0, 0.5)'
+        self.trim = trim
+        BufferedReducer.__init__(self, max_size=max_size, seed=seed)
+
+    def result_key(self, state):
+        values = self.values(state)
+        n = values.size(0)
+        cut = int(n * self.trim)
+        return values.sort(dim=0).values[cut:n - cut].mean(dim=0)
+
+
+reducers = dict(sum=SumReducer, mean=MeanReducer, topk=TopKReducer, median=MedianReducer, trimmed_mean=TrimmedMeanReducer)
+
+
+def resolve_reducer(reducer:Union[str, dict, OnlineReducer]='mean') -> OnlineReducer:
+    '''
+    A reducer from its name ('mean', 'sum', 'topk', 'median', 'trimmed_mean'),
+    a config like {'name': 'topk', 'k': 2} or an instance.
+    '''
+    if isinstance(reducer, OnlineReducer):
+        return reducer
+    if isinstance(reducer, str):
+        reducer = dict(name=reducer)
+    reducer = dict(reducer)
+    name = reducer.pop('name')
+    assert name in reducers, f'{name} is not one of {list(reducers.keys())}'
+    return reducers[name](**reducer)
+
+
+def reduce_receptor_responses(forward_outputs:List[List[torch.Tensor]],
+                              forward_codes:List[List[int]],
+                              reducer:Union[str, dict, OnlineReducer]='mean',
+                              weights:Optional[List[float]]=None,
+                              success_code:int=1) -> List[Optional[torch.Tensor]]:
+    '''
+    Mixture of experts over ReceptorPool.forward results: for every synapse, reduces the responses of the
+    endpoints that succeeded (code == success_code, bittensor.proto.ReturnCode.Success), weighted e.g. by stake.
+    Returns one tensor per synapse, None where no endpoint succeeded.
+    '''
+    num_synapses = len(forward_outputs[0]) if len(forward_outputs) > 0 else 0
+    results = []
+    for synapse_index in range(num_synapses):
+        synapse_reducer = resolve_reducer(reducer)
+        synapse_reducer.reset()
+        for endpoint_index, (outputs, codes) in enumerate(zip(forward_outputs, forward_codes)):
+            if codes[synapse_index] != success_code:
+                continue
+            weight = weights[endpoint_index] if weights is not None else 1.0
+            synapse_reducer.update({'output': outputs[synapse_index]}, weight=weight)
+        results.append(synapse_reducer.result().get('output'))
+    return results
@@ -0,0 +1,82 @@
+import numpy as np
+
+
+class CoverageSampler:
+    '''
+    Samples indices with probability proportional to (max_count - count)**2 + eps,
+    i.e. inversely to how many results each sample index already has.
+
+    The weights live in a Fenwick (binary indexed) tree, so updating the counts of a batch
+    and drawing a batch are O(batch_size * log n). The weights depend on the max count,
+    so the tree is rebuilt (vectorized, O(n)) only when the max count grows.
+    '''
+
+    def __init__(self, counts:np.ndarray, eps:float=1e-10):
+        # counts is shared with the owner, which increments it before calling update
+        self.counts = counts
+        self.n = len(counts)
+        self.eps = eps
+        self.rebuild()
+
+    def weight(self, counts:np.ndarray) -> np.ndarray:
+        return (self.max_count - counts).astype(np.float64)**2 + self.eps
+
+    def rebuild(self):
+        self.max_count = int(self.counts.max()) if self.n > 0 else 0
+        self.weights = self.weight(self.counts)
+        # tree[i] holds the sum of weights[i - lowbit(i), i) for the 1-based index i
+        prefix = np.concatenate([[0.0], np.cumsum(self.weights)])
+        idx = np.arange(1, self.n + 1)
+        self.tree = np.zeros(self.n + 1)
+        self.tree[1:] = prefix[idx] - prefix[idx - (idx & -idx)]
+
+    def _add(self, positions:np.ndarray, deltas:np.ndarray):
+        i = positions + 1
+        while len(i) > 0:
+            np.add.at(self.tree, i, deltas)
+            i = i + (i & -i)
+            mask = i <= self.n
+            i, deltas = i[mask], deltas[mask]
+
+    def update(self, positions:np.ndarray):
+        '''
+        Refreshes the weights of positions after their counts changed.
+        '''
+        positions = np.unique(np.asarray(positions, dtype=np.int64))
+        if len(positions) == 0:
+            return
+        if self.counts[positions].max() > self.max_count:
+            self.rebuild()
+            return
+        new_weights = self.weight(self.counts[positions])
+        deltas = new_weights - self.weights[positions]
+        self.weights[positions] = new_weights
+        self._add(positions, deltas)
+
+    @property
+    def probability(self) -> np.ndarray:
+        return self.weights / self.weights.sum()
+
+    def sample(self, k:int, rng:np.random.Generator=None) -> np.ndarray:
+        '''
+        Draws k positions (with replacement) by descending the tree for all draws at once.
+        '''
+        u = (rng if rng is not None else np.random).random(k) * self._prefix_total()
+        pos = np.zeros(k, dtype=np.int64)
+        step = 1 << (max(self.n, 1).bit_length() - 1)
+        while step > 0:
+            nxt = pos + step
+            mask = nxt <= self.n
+            mask[mask] = self.tree[nxt[mask]] < u[mask]
+            u[mask] -= self.tree[nxt[mask]]
+            pos[mask] = nxt[mask]
+            step >>= 1
+        # pos is the largest 1-based index whose prefix sum is below u, which is the 0-based sampled position
+        return np.minimum(pos, self.n - 1)
+
+    def _prefix_total(self) -> float:
+        total, i = 0.0, self.n
+        while i > 0:
+            total += self.tree[i]
+            i -= i & -i
+        return total
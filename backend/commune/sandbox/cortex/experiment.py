@@ -0,0 +1,109 @@
+import os
+import json
+import random
+import asyncio
+import hashlib
+import itertools
+from glob import glob
+from typing import Dict, List, Any
+
+import pandas as pd
+from loguru import logger
+
+
+class ExperimentRunner:
+    '''
+    Runs a parameter sweep of Sandbox.async_sample trials.
+
+    - trials run concurrently, at most max_concurrent_trials at a time. Concurrent trials share the
+      event loop and the network, so elapsed_time and the rates derived from it are only those of the
+      trial on its own with max_concurrent_trials=1 (the default). Byte counts are always per trial.
+    - every trial is identified by a hash of its parameters; trials already present in the
+      results are skipped, so a crashed sweep resumes where it stopped
+    - receptor pools are shared between trials with the same pool parameters
+    - results are flushed every flush_every trials as parquet part files under path
+    '''
+
+    pool_params = ['max_active_receptors', 'compression']
+
+    def __init__(self, sandbox:'Sandbox', path:str, max_concurrent_trials:int=1, flush_every:int=16):
+        self.sandbox = sandbox
+        self.path = path
+        self.max_concurrent_trials = max_concurrent_trials
+        self.flush_every = flush_every
+        self.pools = {}
+        self.pending_rows = []
+        os.makedirs(self.path, exist_ok=True)
+
+    @staticmethod
+    def trial_grid(params:Dict[str, List[Any]]) -> List[Dict[str, Any]]:
+        keys = list(params.keys())
+        return [dict(zip(keys, values)) for values in itertools.product(*[params[k] for k in keys])]
+
+    @staticmethod
+    def trial_hash(trial:Dict[str, Any]) -> str:
+        return hashlib.sha256(json.dumps(trial, sort_keys=True, default=str).encode()).hexdigest()
+
+    @property
+    def part_paths(self) -> List[str]:
+        return sorted(glob(os.path.join(self.path, 'part-*.parquet')))
+
+    def load(self) -> pd.DataFrame:
+        part_paths = self.part_paths
+        if len(part_paths) == 0:
+            return pd.DataFrame()
+        return pd.concat([pd.read_parquet(p) for p in part_paths], ignore_index=True)
+
+    def completed_hashes(self) -> set:
+        hashes = set()
+        for p in self.part_paths:
+            hashes.update(pd.read_parquet(p, columns=['trial_hash'])['trial_hash'].tolist())
+        return hashes
+
+    def flush(self):
+        if len(self.pending_rows) == 0:
+            return
+        part_path = os.path.join(self.path, f'part-{len(self.part_paths):05d}.parquet')
+        pd.DataFrame(self.pending_rows).to_parquet(part_path, index=False)
+        self.pending_rows = []
+
+    def get_pool(self, pool_kwargs:Dict[str, Any]):
+        pool_key = self.trial_hash(pool_kwargs)
+        if pool_key not in self.pools:
+            self.pools[pool_key] = self.sandbox.build_receptor_pool(name=f'experiment_{pool_key[:8]}', **pool_kwargs)
+        return self.pools[pool_key]
+
+    async def async_run_trial(self, trial:Dict[str, Any], semaphore:asyncio.Semaphore):
+        trial_hash = self.trial_hash(trial)
+        sample_kwargs = {k:v for k,v in trial.items() if k not in self.pool_params}
+        pool_kwargs = {k:v for k,v in trial.items() if k in self.pool_params}
+
+        async with semaphore:
+            try:
+                output = await self.sandbox.async_sample(receptor_pool=self.get_pool(pool_kwargs), success_only=False, **sample_kwargs)
+            except Exception as e:
+                # failed trials are not recorded so they are retried on the next run
+                logger.error(f'trial {trial_hash} {trial} failed: {e}')
+                return
+
+        self.pending_rows.append({**trial, **output.get('info', {}), 'max_concurrent_trials': self.max_concurrent_trials, 'trial_hash': trial_hash})
+        if len(self.pending_rows) >= self.flush_every:
+            self.flush()
+
+    async def async_run(self, params:Dict[str, List[Any]], shuffle:bool=True) -> pd.DataFrame:
+        trials = self.trial_grid(params)
+        completed = self.completed_hashes()
+        trials = [t for t in trials if self.trial_hash(t) not in completed]
+        logger.info(f'{len(completed)} trials already completed, running {len(trials)}')
+        if shuffle:
+            random.shuffle(trials)
+
+        semaphore = asyncio.Semaphore(self.max_concurrent_trials)
+        try:
+            await asyncio.gather(*[self.async_run_trial(trial, semaphore) for trial in trials])
+        finally:
+            self.flush()
+        return self.load()
+
+    def run(self, params:Dict[str, List[Any]], shuffle:bool=True) -> pd.DataFrame:
+        return asyncio.run(self.async_run(params=params, shuffle=shuffle))
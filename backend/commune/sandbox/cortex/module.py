@@ -2,11 +2,12 @@
 ##################
 ##### Import #####
 ##################
+import os
+import math
 import ray
 import torch
 import concurrent.futures
 import time
-import psutil
 import random
 import argparse
 from tqdm import tqdm
@@ -32,6 +33,10 @@ import queue
 from loguru import logger
 
 from commune import Module
+from commune.sandbox.cortex.result_store import SampleResultStore
+from commune.sandbox.cortex.experiment import ExperimentRunner
+from commune.dataset.prefetch import PrefetchLoader
+from commune.model.moe.receptor.sampler import resolve_endpoint_sampler, resolve_stake_weight
 
 
 parser = argparse.ArgumentParser( 
@@ -64,9 +69,11 @@ class Sandbox(Module):
             
         self.dataset_id = '.'.join([self.dataset.path, self.dataset.name, self.split])
 
-        self.sample_ids = [f'{self.dataset_id}.{i}' for i in range(self.idx_bounds[0], self.idx_bounds[1]) ]
-        
-        self.sampleidx2result = {i:[] for i in self.sample_ids}
+        self.result_store = SampleResultStore(idx_bounds=self.idx_bounds)
+        self.sample_loaders = {}
+        self.sample_loader_executor = concurrent.futures.ThreadPoolExecutor(max_workers=self.config.get('prefetch', {}).get('num_workers', 2))
+        # fast tokenizers raise when two threads set padding/truncation at once
+        self.tokenizer_lock = threading.Lock()
         
         
         self.tasks = []
@@ -76,31 +83,27 @@ class Sandbox(Module):
     
     @property
     def sample_probability(self):
-        # sample inversly proportional
-        max_sample_size =self.max_sample_size
-        sample_size_array = self.sample_size_array
-        pre_normalized = (max_sample_size - sample_size_array)**2 +  1e-10
-        normalized = pre_normalized / np.sum(pre_normalized)
-
-        st.write(normalized)
-
-        return normalized
+        # sample inversly proportional, maintained incrementally by the result store
+        return self.result_store.sampler.probability
     
+    @property
+    def sample_ids(self):
+        return [f'{self.dataset_id}.{i}' for i in range(self.idx_bounds[0], self.idx_bounds[1]) ]
+
     @property
     def sampleidx2size(self):
-        x = {k:len(v) for k,v in self.sampleidx2result.items()}
-        return x
+        return dict(zip(self.sample_ids, self.sample_size_array.tolist()))
 
     @property
     def sample_size_array(self):
-        return np.array(list(self.sampleidx2size.values()))
+        return self.result_store.counts
     @property
     def total_sample_size(self):
         return int(np.sum(self.sample_size_array))
 
     @property
     def max_sample_size(self):
-        return int(np.max(self.sample_size_array))
+        return self.result_store.sampler.max_count
 
     @property
     def min_sample_size(self):
@@ -118,15 +121,22 @@ class Sandbox(Module):
         tokenizer = self.launch(**self.config['tokenizer'])
         return tokenizer
 
-    def set_receptor_pool(self, receptor_pool=None, refresh=None, max_active_receptors=0):
-        rp_config = self.config['receptor_pool']
+    def build_receptor_pool(self, max_active_receptors=0, compression=None, name=None):
+        rp_config = deepcopy(self.config['receptor_pool'])
         rp_config['actor'] = rp_config.get('actor', False)
         rp_config['kwargs']['wallet']=self.wallet
         rp_config['kwargs']['max_active_receptors'] = max_active_receptors
-        rp_config['kwargs']['compression'] = None
+        rp_config['kwargs']['compression'] = compression
+        # labels the pool's prometheus gauges
+        rp_config['kwargs']['name'] = name
+        # the stake_weighted_sampling flag sets the stake exponent of the pool's sampler, which get_random_endpoints uses
+        rp_config['kwargs']['endpoint_sampler'] = resolve_endpoint_sampler(rp_config['kwargs'].get('endpoint_sampler', 'scored'),
+                                                    stake_weight=resolve_stake_weight(self.config.get('stake_weighted_sampling', False)))
+        return self.launch_module( **rp_config)
 
+    def set_receptor_pool(self, receptor_pool=None, refresh=None, max_active_receptors=0):
         if receptor_pool == None:
-            receptor_pool = self.launch_module( **rp_config)  
+            receptor_pool = self.build_receptor_pool(max_active_receptors=max_active_receptors)
         self.receptor_pool = receptor_pool
 
         return self.receptor_pool
@@ -200,9 +210,9 @@ class Sandbox(Module):
         return list(map(lambda x: x.uid, self.endpoints))
         
     def get_random_endpoints(self, n = 10 ):
-        endpoints =self.endpoints
-        random_ids =  np.random.randint(0, len(endpoints), (n))
-        return [endpoints[i] for i in random_ids]
+        # the pool's endpoint sampler favours fast and reliable peers based on previous responses
+        stake = self.graph.stake.numpy() if self.config.get('stake_weighted_sampling', False) else None
+        return self.receptor_pool.sample_endpoints(self.endpoints, n, stake=stake)
 
     def get_endpoints(self, n=10, uids:list=[]):
         if len(uids) == 0:
@@ -227,18 +237,18 @@ class Sandbox(Module):
         return code2name_map[code]
 
         
-    async def async_receptor_pool_forward(self, endpoints, inputs, synapses , timeout, min_successes, splits=5):
-        endpoints_split_list = self.chunk(endpoints, num_chunks=splits)
-        kwargs_list = []
-        for endpoints_split in endpoints_split_list:
-            kwargs_list.append(dict(endpoints=endpoints_split, inputs=inputs, synapses=synapses , timeout=timeout, min_successes=min_successes))
-        results_list = await asyncio.gather(*[self.receptor_pool.async_forward(**kwargs) for kwargs in kwargs_list])
-       
-        agg_results = [[],[], []]
-        for results in results_list:
-            for i,result in enumerate(results):
-                agg_results[i].extend(result)
-
+    async def async_receptor_pool_forward(self, endpoints, inputs, synapses , timeout, min_successes, splits=5, soft_timeout=None, receptor_pool=None, stats=None):
+        receptor_pool = receptor_pool if receptor_pool != None else self.receptor_pool
+        # every endpoint gets the same inputs, so one broadcast serializes the request once for the whole fan out,
+        # splits only caps how many requests are in flight at once (len(endpoints) / splits)
+        max_concurrent_requests = math.ceil(len(endpoints) / splits) if splits > 1 else None
+        results = await receptor_pool.async_broadcast_forward(endpoints=endpoints, inputs=inputs, synapses=synapses, timeout=timeout,
+                                                              min_successes=min_successes, soft_timeout=soft_timeout,
+                                                              max_concurrent_requests=max_concurrent_requests, stats=stats)
+        agg_results = [list(result) for result in results]
+
+        # the quorum only returns the endpoints that responded, so map them back to their uids
+        agg_results[3] = [e.uid for e in agg_results[3]]
         return agg_results
 
     def resolve_synapse(self, synapse:str, *args,**kwarga):
@@ -250,6 +260,32 @@ class Sandbox(Module):
         assert idx_bounds[0]>=0
         return idx_bounds
 
+    def sample_inputs(self, batch_size:int, sequence_length:int, split:str, idx_list:list) -> dict:
+        '''
+        Raw text of the dataset rows and its input ids from the sandbox tokenizer, padded or truncated to sequence_length.
+        '''
+        raw_inputs = self.dataset.sample(batch_size=batch_size, idx_list=idx_list, split=split, sequence_length=sequence_length, tokenize=False)['text']
+        with self.tokenizer_lock:
+            inputs = self.tokenizer(raw_inputs, max_length=sequence_length, truncation=True, padding="max_length", return_tensors="pt")["input_ids"]
+        return {'text': raw_inputs, 'input_ids': inputs}
+
+    def get_sample_loader(self, batch_size:int, sequence_length:int, split:str) -> PrefetchLoader:
+        '''
+        Prefetching loader of tokenized batches, one per batch shape, sharing one executor.
+        The sample indices are drawn from the result store when a batch is submitted.
+        '''
+        key = (batch_size, sequence_length, split)
+        if key not in self.sample_loaders:
+            prefetch_config = self.config.get('prefetch', {})
+            def kwargs_fn(rng, batch_index):
+                return dict(batch_size=batch_size, sequence_length=sequence_length, split=split,
+                            idx_list=self.result_store.sample_idx_list(batch_size, rng=rng))
+            self.sample_loaders[key] = PrefetchLoader(sample_fn=self.sample_inputs, kwargs_fn=kwargs_fn,
+                                                      buffer_size=prefetch_config.get('buffer_size', 4),
+                                                      seed=prefetch_config.get('seed'),
+                                                      executor=self.sample_loader_executor)
+        return self.sample_loaders[key]
+
     async def async_sample(self,
             sequence_length = 20,
             batch_size = 10,
@@ -260,14 +296,14 @@ class Sandbox(Module):
             success_only= True,
             split = 'train', 
             splits=1, 
+            soft_timeout=None,
+            receptor_pool=None,
         ):
 
-        idx_list = np.random.choice(np.arange(self.idx_bounds[0], self.idx_bounds[1]), batch_size, p=self.sample_probability).tolist()
-        
-
-        # inputs = torch.zeros([batch_size, sequence_length], dtype=torch.int64)
-        raw_inputs = self.dataset.sample( batch_size=batch_size, idx_list = idx_list, split=split, sequence_length=sequence_length, tokenize= False)['text']
-        inputs = self.tokenizer(raw_inputs, max_length=sequence_length, truncation=True, padding="max_length", return_tensors="pt")["input_ids"]
+        # the next batches are prepared in the background while this one is in flight
+        sample_kwargs, sample_dict = await self.get_sample_loader(batch_size=batch_size, sequence_length=sequence_length, split=split).async_next()
+        idx_list = sample_kwargs['idx_list']
+        raw_inputs, inputs = sample_dict['text'], sample_dict['input_ids']
         synapse_str = deepcopy(synapse)   
         synapse = self.resolve_synapse(synapse)
         endpoints = self.get_random_endpoints(num_endpoints)
@@ -282,9 +318,9 @@ class Sandbox(Module):
         }
 
 
-        io_1 = psutil.net_io_counters()
-        start_bytes_sent, start_bytes_recv = io_1.bytes_sent, io_1.bytes_recv
-
+        # traffic of this sample alone, counted by the pool from the payloads it sends and receives
+        # (process wide network counters would include the other trials running concurrently)
+        stats = {}
         with self.timer() as t:
             
             results = await self.async_receptor_pool_forward(
@@ -292,15 +328,16 @@ class Sandbox(Module):
                                 synapses= [synapse],
                                 timeout=timeout,
                                 min_successes=min_successes,
-                                inputs= [inputs]*len(endpoints),
-                                splits=splits)
+                                inputs= inputs,
+                                splits=splits,
+                                soft_timeout=soft_timeout,
+                                receptor_pool=receptor_pool,
+                                stats=stats)
 
             elapsed_time = t.elapsed_time.total_seconds() 
 
-        io_2 = psutil.net_io_counters()
-        total_bytes_sent, total_bytes_recved = io_2.bytes_sent - start_bytes_sent, io_2.bytes_recv - start_bytes_recv
+        total_bytes_sent, total_bytes_recved = stats['request_bytes'], stats['response_bytes']
 
-        results = list(results) + [list(map(lambda e:e.uid, endpoints))]
         results = self.process_results(results)
 
 
@@ -316,6 +353,7 @@ class Sandbox(Module):
         metrics_dict['download_bytes_mb'] =total_bytes_recved / 1000
         metrics_dict['upload_rate_mb'] =metrics_dict['upload_bytes_mb']/elapsed_time 
         metrics_dict['download_rate_mb'] =metrics_dict['download_bytes_mb']/elapsed_time
+        metrics_dict['num_requests'] = stats['requests']
         metrics_dict['num_endpoints'] = num_endpoints
         metrics_dict['success_rate'] = metrics_dict['num_successes']/metrics_dict['num_endpoints']
         metrics_dict['splits'] = splits
@@ -351,40 +389,10 @@ class Sandbox(Module):
 
         output = dict(info=metrics_dict, output=results, input=input_dict)
 
-        singleton_result_dict = {}
-        for k,v in output['output'].items():
-            
-            if len(v.shape) == 1:
-                for endpoint_batch_tensor in torch.split(v, split_size_or_sections=1, dim=0 ):
-                    endpoint_batch_tensor = endpoint_batch_tensor.squeeze(0).item()
-                    if k in singleton_result_dict:
-                        singleton_result_dict[k].append( endpoint_batch_tensor)
-                    else:
-                        singleton_result_dict[k] = [ endpoint_batch_tensor]
-        single_results_dict = {}
-
-        for k,v in output['output'].items():
-            if len(v.shape)>1:
-                for endpoint_batch_tensor in torch.split(v, split_size_or_sections=1, dim=1 ):
-                    endpoint_batch_tensor = endpoint_batch_tensor.squeeze(1)
-                    endpoint_batch_list = torch.split(endpoint_batch_tensor, split_size_or_sections=1, dim=0 )
-                    if k in single_results_dict:
-                        single_results_dict[k].append( endpoint_batch_list)
-                    else:
-                        single_results_dict[k] = [endpoint_batch_list]
-
-        single_results_list = []
-
-        for i in range(len(list(single_results_dict.values())[0])):
-            row_dict = {**{k:v[i] for k,v in single_results_dict.items()} , **singleton_result_dict}
-            single_results_list.append(row_dict)
-            
-
-        for i in range(len(idx_list)):
-            idx = idx_list[i]
-            for e in range(len(list(single_results_list[i].values())[0])):
-                key = f'{self.dataset_id}.{idx}'
-                self.sampleidx2result[key] += [{k:v[e] for k,v in single_results_list[i].items()}]
+        if len(results['tensor']) > 0:
+            self.result_store.append(idx_list=idx_list,
+                                     tensor=results['tensor'],
+                                     columns={k:v for k,v in results.items() if k != 'tensor'})
         return output
 
     def sample_generator(self, num_endpoints=10, 
@@ -491,29 +499,18 @@ class Sandbox(Module):
                 splits=[1,2,4,8]
             ),
             experiment='experiment3',
-            sequence_length=[]):
-            
-        sample_kwargs_list = []
-        for sequence_length in params['sequence_length']:
-            for num_endpoints in params['num_endpoints']:
-                for timeout in params['timeout']:
-                    for synapse in params['synapse']:
-                        for batch_size in params['batch_size']:
-                            for splits in params['splits']:
-                                sample_kwargs_list += [dict(
-                                    sequence_length = sequence_length,
-                                    batch_size = batch_size,
-                                    timeout= timeout,
-                                    synapse = synapse,
-                                    num_endpoints = num_endpoints,
-                                    success_only= False,
-                                    splits=splits
-                                )]
-        random.shuffle(sample_kwargs_list)
-        for i,sample_kwargs in enumerate(tqdm(sample_kwargs_list)):
-            self.set_receptor_pool(refresh=True)         
-            trial_metrics_result = self.sample(**sample_kwargs)
-            self.put_json(f'{experiment}/{i}', trial_metrics_result)
+            max_concurrent_trials=1):
+        '''
+        Runs every combination of params as a trial. Trials already in the experiment are skipped,
+        so an interrupted sweep resumes by running it again.
+        Byte counts are per trial whatever max_concurrent_trials is, but concurrent trials share the event loop
+        and the network, so elapsed_time and the rates only measure a trial on its own with max_concurrent_trials=1.
+        '''
+        runner = ExperimentRunner(sandbox=self, path=self.experiment_path(experiment), max_concurrent_trials=max_concurrent_trials)
+        return runner.run(params=params)
+
+    def experiment_path(self, experiment='experiment3'):
+        return os.path.join(self.tmp_dir, experiment)
   
     # def streamlit(self):
     #     for k,v_list in params.items():
@@ -522,14 +519,7 @@ class Sandbox(Module):
 
 
     def load_experiment(self, path='experiment3'):
-        df = []
-        
-        for p in self.glob_json(path+'/*'):
-            df.append(self.client.local.get_json(p))
-
-        df =  pd.DataFrame(df)
-
-        return df
+        return ExperimentRunner(sandbox=self, path=self.experiment_path(path)).load()
 
     def streamlit_experiment(self, experiment= 'experiment3'):
         df = self.load_experiment(path=experiment)
@@ -673,7 +663,7 @@ if __name__ == '__main__':
                 total_bin_size = module.total_sample_size,
                 min_bin_size = module.min_sample_size, 
                 max_bin_size = module.max_sample_size,
-                num_samples = len(module.sampleidx2result)
+                num_samples = module.result_store.num_samples
                 
                 )
         metrics['mean_bin_size'] = metrics['total_bin_size'] / metrics['num_samples']
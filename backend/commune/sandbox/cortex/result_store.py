@@ -0,0 +1,153 @@
+import numpy as np
+import torch
+from typing import Dict, List, Union
+from commune.sandbox.cortex.coverage_sampler import CoverageSampler
+
+
+class SampleResultStore:
+    '''
+    Columnar store of endpoint responses, one row per (sample_idx, uid).
+
+    Rows are appended in bulk per batch into preallocated arrays that double when full.
+    Scalar columns are numpy arrays and the responses are torch tensors, one buffer per response shape
+    (e.g. per sequence length of a sweep), so per-sample queries are a mask over the filled rows
+    instead of a walk over python dicts.
+    '''
+
+    def __init__(self, idx_bounds:List[int], capacity:int=1024):
+        self.idx_bounds = idx_bounds
+        self.capacity = capacity
+        self.size = 0
+        self.sample_idx = np.zeros(capacity, dtype=np.int64)
+        self.columns = {}
+        # response shape -> buffer of the rows with that shape, tensor_shape and tensor_row locate a row's response
+        self.tensors = {}
+        self.tensor_sizes = {}
+        self.tensor_shapes = []
+        self.tensor_shape = np.zeros(capacity, dtype=np.int64)
+        self.tensor_row = np.zeros(capacity, dtype=np.int64)
+        # number of stored rows per sample index, offset by idx_bounds[0]
+        self.counts = np.zeros(idx_bounds[1] - idx_bounds[0], dtype=np.int64)
+        self.sampler = CoverageSampler(counts=self.counts)
+
+    @property
+    def num_samples(self) -> int:
+        return len(self.counts)
+
+    def __len__(self) -> int:
+        return self.size
+
+    def _grow(self, min_capacity:int):
+        if min_capacity <= self.capacity:
+            return
+        capacity = max(min_capacity, 2*self.capacity)
+        self.sample_idx = np.resize(self.sample_idx, capacity)
+        self.tensor_shape = np.resize(self.tensor_shape, capacity)
+        self.tensor_row = np.resize(self.tensor_row, capacity)
+        self.columns = {k: np.resize(v, capacity) for k,v in self.columns.items()}
+        self.capacity = capacity
+
+    def _append_tensor(self, responses:torch.Tensor) -> np.ndarray:
+        '''
+        Appends responses (num_rows, *response_shape) to the buffer of their shape, returns their rows in it.
+        '''
+        shape = tuple(responses.shape[1:])
+        if shape not in self.tensors:
+            self.tensor_shapes.append(shape)
+            self.tensors[shape] = torch.zeros((len(responses), *shape), dtype=responses.dtype)
+            self.tensor_sizes[shape] = 0
+        tensor, size = self.tensors[shape], self.tensor_sizes[shape]
+        if size + len(responses) > len(tensor):
+            grown = torch.zeros((max(size + len(responses), 2*len(tensor)), *shape), dtype=tensor.dtype)
+            grown[:size] = tensor[:size]
+            tensor = self.tensors[shape] = grown
+        tensor[size:size + len(responses)] = responses.to(tensor.dtype)
+        self.tensor_sizes[shape] = size + len(responses)
+        return np.arange(size, size + len(responses))
+
+    def append(self, idx_list:List[int], tensor:torch.Tensor, columns:Dict[str, Union[np.ndarray, torch.Tensor]]) -> np.ndarray:
+        '''
+        Args:
+            idx_list:
+                sample indices of the batch (batch_size)
+            tensor:
+                responses of shape (num_endpoints, batch_size, *response_shape)
+            columns:
+                per endpoint scalars such as code, uid or stake, each of shape (num_endpoints)
+        Returns:
+            rows: the row indices written, ordered sample-major like the batch
+        '''
+        num_endpoints, batch_size = tensor.shape[0], tensor.shape[1]
+        assert batch_size == len(idx_list), f'{batch_size} != {len(idx_list)}'
+        num_rows = num_endpoints * batch_size
+        if num_rows == 0:
+            return np.zeros(0, dtype=np.int64)
+
+        self._grow(self.size + num_rows)
+        rows = np.arange(self.size, self.size + num_rows)
+
+        idx_array = np.asarray(idx_list, dtype=np.int64)
+        self.sample_idx[rows] = np.repeat(idx_array, num_endpoints)
+
+        responses = tensor.detach().cpu().transpose(0, 1).reshape(num_rows, *tensor.shape[2:])
+        self.tensor_row[rows] = self._append_tensor(responses)
+        self.tensor_shape[rows] = self.tensor_shapes.index(tuple(tensor.shape[2:]))
+
+        for k, v in columns.items():
+            v = v.detach().cpu().numpy() if isinstance(v, torch.Tensor) else np.asarray(v)
+            if k not in self.columns:
+                self.columns[k] = np.zeros(self.capacity, dtype=v.dtype)
+            self.columns[k][rows] = np.tile(v, batch_size)
+
+        np.add.at(self.counts, idx_array - self.idx_bounds[0], num_endpoints)
+        self.sampler.update(idx_array - self.idx_bounds[0])
+        self.size += num_rows
+        return rows
+
+    def sample_idx_list(self, batch_size:int, rng:np.random.Generator=None) -> List[int]:
+        '''
+        Draws sample indices inversely to how many results they already have.
+        '''
+        return (self.sampler.sample(batch_size, rng=rng) + self.idx_bounds[0]).tolist()
+
+    def rows(self, idx:int) -> np.ndarray:
+        return np.flatnonzero(self.sample_idx[:self.size] == idx)
+
+    def gather_tensor(self, rows:np.ndarray) -> torch.Tensor:
+        '''
+        Stacks the responses of rows, which must share one response shape.
+        '''
+        if len(rows) == 0:
+            return torch.tensor([])
+        shape_ids = np.unique(self.tensor_shape[rows])
+        if len(shape_ids) > 1:
+            raise ValueError(f'rows have responses of shapes {[self.tensor_shapes[i] for i in shape_ids]}, query one shape at a time')
+        tensor = self.tensors[self.tensor_shapes[shape_ids[0]]]
+        return tensor[torch.from_numpy(self.tensor_row[rows])]
+
+    def select(self, rows:np.ndarray, shape:tuple=None) -> np.ndarray:
+        if shape is None:
+            return rows
+        if tuple(shape) not in self.tensors:
+            return rows[:0]
+        return rows[self.tensor_shape[rows] == self.tensor_shapes.index(tuple(shape))]
+
+    def get_sample(self, idx:int, shape:tuple=None) -> Dict[str, Union[np.ndarray, torch.Tensor]]:
+        '''
+        Returns every stored response for the sample index as columns.
+        Pass the response shape when the sample was queried with several.
+        '''
+        rows = self.select(self.rows(idx), shape=shape)
+        sample = {k: v[rows] for k,v in self.columns.items()}
+        sample['tensor'] = self.gather_tensor(rows)
+        return sample
+
+    def to_dict(self, shape:tuple=None) -> Dict[str, Union[np.ndarray, torch.Tensor]]:
+        '''
+        Every column over the filled rows (of one response shape when given).
+        '''
+        rows = self.select(np.arange(self.size), shape=shape)
+        data = {k: v[rows] for k,v in self.columns.items()}
+        data['sample_idx'] = self.sample_idx[rows]
+        data['tensor'] = self.gather_tensor(rows)
+        return data
@@ -38,6 +38,7 @@ class ServerClientModule(nn.Module, SerializerModule):
             ip: str ='localhost',
             port: int = 80 ,
             max_processes: 'int' = 1,
+            compression: str = None,
         ):
 
         super().__init__()
@@ -46,11 +47,20 @@ class ServerClientModule(nn.Module, SerializerModule):
         self.endpoint = ip + ':' + str(port)
 
 
+        # Determine the grpc compression algorithm
+        if compression == 'gzip':
+            compress_alg = grpc.Compression.Gzip
+        elif compression == 'deflate':
+            compress_alg = grpc.Compression.Deflate
+        else:
+            compress_alg = grpc.Compression.NoCompression
+
         channel = grpc.aio.insecure_channel(
             self.endpoint,
             options=[('grpc.max_send_message_length', -1),
                      ('grpc.max_receive_message_length', -1),
-                     ('grpc.keepalive_time_ms', 100000)])
+                     ('grpc.keepalive_time_ms', 100000)],
+            compression=compress_alg)
         stub = commune.grpc.CommuneStub( channel )
 
         self.loop = asyncio.get_event_loop()
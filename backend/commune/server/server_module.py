@@ -106,6 +106,7 @@ class ServerModule(CommuneServicer, SerializerModule):
             server = grpc.server( thread_pool,
                                 #   interceptors=(ServerInterceptor(blacklist=blacklist,receiver_hotkey=self.wallet.hotkey.ss58_address),),
                                   maximum_concurrent_rpcs = config.maximum_concurrent_rpcs,
+                                  compression = compress_alg,
                                   options = [('grpc.keepalive_time_ms', 100000),
                                              ('grpc.keepalive_timeout_ms', 500000)]
                                 )
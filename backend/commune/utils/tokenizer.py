@@ -0,0 +1,151 @@
+import os
+import json
+import sqlite3
+import hashlib
+import threading
+from collections import OrderedDict
+from typing import Dict, List, Optional, Union
+
+
+def fast_tokenizer(tokenizer:'transformers.PreTrainedTokenizerBase') -> 'transformers.PreTrainedTokenizerFast':
+    '''
+    Returns the rust (fast) version of the tokenizer with batch parallelism enabled.
+    Tokenizers without a fast version are returned as they are.
+    '''
+    os.environ.setdefault('TOKENIZERS_PARALLELISM', 'true')
+    if getattr(tokenizer, 'is_fast', False):
+        return tokenizer
+    from transformers import AutoTokenizer
+    try:
+        fast = AutoTokenizer.from_pretrained(tokenizer.name_or_path, use_fast=True)
+    except Exception:
+        return tokenizer
+    if not fast.is_fast:
+        return tokenizer
+    # keep the special tokens and padding side the slow tokenizer was prepared with
+    fast.add_special_tokens({k:v for k,v in tokenizer.special_tokens_map.items() if k != 'additional_special_tokens'})
+    fast.padding_side = tokenizer.padding_side
+    return fast
+
+
+class TokenizerCache:
+    '''
+    Content-hashed cache of per-text tokenizations in front of a HuggingFace tokenizer.
+
+    Called like the tokenizer. Every text is looked up by a hash of (tokenizer, text, per-text kwargs)
+    in an in-memory LRU and then in an optional sqlite file, and all misses are tokenized in one
+    batched call. Padding and tensor conversion are applied to the assembled batch with tokenizer.pad,
+    since they depend on the batch and not on the text.
+    '''
+
+    # kwargs that change the tokens of a single text, they are part of the cache key
+    text_kwargs = ['add_special_tokens', 'truncation', 'max_length', 'return_offsets_mapping', 'return_attention_mask']
+
+    def __init__(self, tokenizer:'transformers.PreTrainedTokenizerBase', max_size:int=100000, disk_path:Optional[str]=None, fast:bool=True):
+        self.tokenizer = fast_tokenizer(tokenizer) if fast else tokenizer
+        self.max_size = max_size
+        self.cache = OrderedDict()
+        self.lock = threading.Lock()
+        self.stats = dict(hits=0, disk_hits=0, misses=0)
+        self.tokenizer_id = f'{getattr(self.tokenizer, "name_or_path", "")}-{len(self.tokenizer)}'
+
+        self.disk = None
+        if disk_path != None:
+            os.makedirs(os.path.dirname(disk_path) or '.', exist_ok=True)
+            self.disk = sqlite3.connect(disk_path, check_same_thread=False)
+            self.disk.execute('CREATE TABLE IF NOT EXISTS tokens (key TEXT PRIMARY KEY, value TEXT)')
+
+    def key(self, text:str, text_kwargs:dict) -> str:
+        return hashlib.sha1(json.dumps([self.tokenizer_id, text, text_kwargs], sort_keys=True).encode()).hexdigest()
+
+    def _get(self, key:str) -> Optional[dict]:
+        with self.lock:
+            encoding = self.cache.get(key)
+            if encoding is not None:
+                self.cache.move_to_end(key)
+                self.stats['hits'] += 1
+                return encoding
+            if self.disk is not None:
+                row = self.disk.execute('SELECT value FROM tokens WHERE key = ?', (key,)).fetchone()
+                if row is not None:
+                    encoding = json.loads(row[0])
+                    self._put_memory(key, encoding)
+                    self.stats['disk_hits'] += 1
+                    return encoding
+        return None
+
+    def _put_memory(self, key:str, encoding:dict):
+        self.cache[key] = encoding
+        self.cache.move_to_end(key)
+        while len(self.cache) > self.max_size:
+            self.cache.popitem(last=False)
+
+    def _put(self, items:Dict[str, dict]):
+        with self.lock:
+            for key, encoding in items.items():
+                self._put_memory(key, encoding)
+            if self.disk is not None:
+                self.disk.executemany('INSERT OR REPLACE INTO tokens VALUES (?, ?)', [(k, json.dumps(v)) for k,v in items.items()])
+                self.disk.commit()
+
+    def encode(self, texts:List[str], **text_kwargs) -> List[dict]:
+        '''
+        Unpadded encodings of every text, tokenizing the misses in one batch.
+        '''
+        keys = [self.key(text, text_kwargs) for text in texts]
+        encodings = [self._get(key) for key in keys]
+
+        missing = {}
+        for i, encoding in enumerate(encodings):
+            if encoding is None:
+                missing.setdefault(keys[i], []).append(i)
+
+        if len(missing) > 0:
+            missing_texts = [texts[positions[0]] for positions in missing.values()]
+            batch = self.tokenizer(missing_texts, **text_kwargs)
+            new_items = {}
+            for j, (key, positions) in enumerate(missing.items()):
+                encoding = {k: [list(x) if isinstance(x, tuple) else x for x in v[j]] if k == 'offset_mapping' else list(v[j]) for k,v in batch.items()}
+                new_items[key] = encoding
+                for i in positions:
+                    encodings[i] = encoding
+            self._put(new_items)
+            self.stats['misses'] += len(missing)
+
+        return encodings
+
+    def __call__(self, text:Union[str, List[str]], padding:Union[bool, str]=False, return_tensors:Optional[str]=None, **kwargs) -> 'transformers.BatchEncoding':
+        from transformers import BatchEncoding
+        text_kwargs = {k: kwargs.pop(k) for k in self.text_kwargs if k in kwargs}
+        # anything the cache does not know how to split goes straight to the tokenizer
+        if len(kwargs) > 0:
+            return self.tokenizer(text, padding=padding, return_tensors=return_tensors, **text_kwargs, **kwargs)
+
+        single = isinstance(text, str)
+        encodings = self.encode([text] if single else list(text), **text_kwargs)
+
+        if single:
+            return BatchEncoding(dict(encodings[0]), tensor_type=return_tensors, prepend_batch_axis=return_tensors is not None)
+
+        # pad only the model inputs, offsets stay per text like the tokenizer returns them without padding
+        extra_keys = [k for k in encodings[0].keys() if k not in ['input_ids', 'attention_mask', 'token_type_ids']] if len(encodings) > 0 else []
+        if padding or return_tensors:
+            model_inputs = [{k:v for k,v in e.items() if k not in extra_keys} for e in encodings]
+            batch = self.tokenizer.pad(model_inputs, padding=padding, max_length=text_kwargs.get('max_length'), return_tensors=return_tensors)
+        else:
+            batch = BatchEncoding({k: [e[k] for e in encodings] for k in encodings[0].keys() if k not in extra_keys} if len(encodings) > 0 else {})
+        for k in extra_keys:
+            batch[k] = [e[k] for e in encodings]
+        return batch
+
+    @property
+    def hit_rate(self) -> float:
+        total = self.stats['hits'] + self.stats['disk_hits'] + self.stats['misses']
+        return (self.stats['hits'] + self.stats['disk_hits']) / total if total > 0 else 0.0
+
+    def __len__(self) -> int:
+        return len(self.cache)
+
+    def clear(self):
+        with self.lock:
+            self.cache.clear()